@@ -1,127 +1,2648 @@
-from flask import Flask, render_template, request, jsonify
-import markdown
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g, url_for, send_file, abort
 import os
-import requests
+from urllib.parse import urlsplit
 import json
 import base64
-import speech_recognition as sr
+import hashlib
+import sqlite3
 import io
-import tempfile
+import subprocess
+import shutil
+import wave
 import uuid
-from pydub import AudioSegment
-import google.generativeai as genai
+import tempfile
+import importlib
+import mimetypes
+import functools
+import gzip
 import re
-import traceback
+import sys
+import atexit
+import queue
+import logging
+import logging.handlers
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Set FFmpeg path explicitly
+class LazyModule:
+    """
+    Stands in for a module that is imported on first attribute access.
+    
+    Provider and audio libraries take most of the app's import time, so
+    they are only loaded when a route first needs them. An optional setup
+    hook runs once on the freshly imported module (e.g. to configure it).
+    """
+    
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.RLock()
+    
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                if self._setup is not None:
+                    self._setup(module)
+                self._module = module
+        return self._module
+    
+    def __getattr__(self, attribute):
+        return getattr(self._module or self._load(), attribute)
+    
+    @property
+    def loaded(self):
+        return self._module is not None
+
 try:
-    # Use the specific FFmpeg path from environment variable
-    ffmpeg_path = os.getenv("FFMPEG_PATH")
+    import brotli
+except ImportError:
+    brotli = None
+
+# Heavy modules, loaded on first use
+markdown = LazyModule("markdown")
+requests = LazyModule("requests")
+sr = LazyModule("speech_recognition")
+
+# API keys that must never reach logs or error messages
+SECRET_ENV_VARS = ("OPENWEATHER_API_KEY", "GEMINI_API_KEY", "AZURE_OPENAI_API_KEY")
+
+def redact_secrets(text):
+    """Replaces any configured API key in text with a placeholder (short placeholder values are left alone)"""
+    for name in SECRET_ENV_VARS:
+        secret = os.getenv(name)
+        if secret and len(secret) >= 8 and secret in text:
+            text = text.replace(secret, "[REDACTED]")
+    return text
+
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that scrubs API keys from the formatted record (message and traceback)"""
     
-    if os.path.isfile(ffmpeg_path):
-        AudioSegment.converter = ffmpeg_path
-        print(f"FFmpeg found at: {ffmpeg_path}")
-    else:
-        # Try to find ffmpeg in common Windows locations as fallback
-        possible_ffmpeg_paths = [
-            r"C:\Program Files\ffmpeg\bin\ffmpeg.exe",
-            r"C:\ffmpeg\bin\ffmpeg.exe",
-            os.path.expanduser("~") + r"\ffmpeg\bin\ffmpeg.exe"
-        ]
-        
-        ffmpeg_path = None
-        for path in possible_ffmpeg_paths:
-            if os.path.isfile(path):
-                ffmpeg_path = path
-                break
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.msg = redact_secrets(record.msg)
+        return record
+
+LOG_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def log_extra_fields(record):
+    """Returns the fields a log call passed through `extra`"""
+    return {key: value for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS}
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats log records as one JSON object per line, including fields passed as `extra`"""
+    
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        entry.update(log_extra_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """Formats log records as plain lines with `extra` fields appended as key=value"""
+    
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    
+    def format(self, record):
+        line = super().format(record)
+        fields = log_extra_fields(record)
+        if fields:
+            first, newline, rest = line.partition("\n")
+            line = first + " " + " ".join(f"{key}={value!r}" for key, value in fields.items()) + newline + rest
+        return line
+
+def configure_logging(level, log_format):
+    """
+    Sets up the app logger to write through a background thread.
+    
+    Records are formatted on the calling thread and handed to a
+    QueueListener, so request threads never block on stdout under load.
+    
+    Args:
+        level (str): Minimum level name (DEBUG, INFO, WARNING...)
+        log_format (str): 'json' for structured lines, 'text' for plain ones
         
-        if ffmpeg_path:
-            AudioSegment.converter = ffmpeg_path
-            print(f"FFmpeg found at: {ffmpeg_path}")
-        else:
-            print("FFmpeg not found in common locations. Relying on PATH environment variable.")
-except Exception as e:
-    print(f"Error setting FFmpeg path: {str(e)}")
+    Returns:
+        logging.Logger: The configured 'edubyte' logger
+    """
+    log_queue = queue.SimpleQueue()
+    queue_handler = RedactingQueueHandler(log_queue)
+    queue_handler.setFormatter(JsonLogFormatter() if log_format == "json" else TextLogFormatter())
+    
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    atexit.register(listener.stop)
+    
+    app_logger = logging.getLogger("edubyte")
+    app_logger.setLevel(level)
+    app_logger.addHandler(queue_handler)
+    app_logger.propagate = False
+    return app_logger
+
+logger = configure_logging(os.getenv("LOG_LEVEL", "INFO").upper(), os.getenv("LOG_FORMAT", "json").lower())
+
+# Common Windows install locations, checked when FFmpeg isn't on PATH
+FFMPEG_FALLBACK_PATHS = [
+    r"C:\Program Files\ffmpeg\bin\ffmpeg.exe",
+    r"C:\ffmpeg\bin\ffmpeg.exe",
+    os.path.expanduser("~") + r"\ffmpeg\bin\ffmpeg.exe"
+]
+
+@functools.lru_cache(maxsize=None)
+def find_ffmpeg():
+    """
+    Locates the FFmpeg binary on first use and remembers it.
+    
+    Checks FFMPEG_PATH, then PATH, then common Windows install locations.
+    
+    Returns:
+        str: The FFmpeg path, or "ffmpeg" to leave the lookup to the OS
+    """
+    configured = os.getenv("FFMPEG_PATH")
+    if configured:
+        if os.path.isfile(configured):
+            logger.info("FFmpeg found", extra={"path": configured})
+            return configured
+        logger.warning("FFMPEG_PATH is not a file, searching PATH instead", extra={"path": configured})
+    
+    found = shutil.which("ffmpeg") or next((path for path in FFMPEG_FALLBACK_PATHS if os.path.isfile(path)), None)
+    if found:
+        logger.info("FFmpeg found", extra={"path": found})
+        return found
+    logger.warning("FFmpeg not found; only 16-bit mono WAV audio can be transcribed")
+    return "ffmpeg"
+
+# Chat image settings (longest side in pixels, 0 disables downscaling)
+CHAT_IMAGE_MAX_DIMENSION = int(os.getenv("CHAT_IMAGE_MAX_DIMENSION", "1536"))
+CHAT_IMAGE_JPEG_QUALITY = int(os.getenv("CHAT_IMAGE_JPEG_QUALITY", "85"))
+
+# Audio transcoding settings
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_TRANSCODE_TIMEOUT = float(os.getenv("AUDIO_TRANSCODE_TIMEOUT", "60"))
 
 # Configure Google Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
+
+def configure_gemini(genai_module):
+    """Configures the Gemini client and its request options when google.generativeai is first loaded"""
+    from google.api_core import retry as api_retry
+    
+    # 'rest' keeps Gemini calls on plain HTTP so they cooperate with gevent (see serve_async.py)
+    # GEMINI_API_ENDPOINT (with the rest transport) points the client at another host, e.g. a local stub
+    genai_module.configure(
+        api_key=GEMINI_API_KEY,
+        transport=os.getenv("GEMINI_TRANSPORT") or None,
+        client_options={"api_endpoint": os.getenv("GEMINI_API_ENDPOINT")} if os.getenv("GEMINI_API_ENDPOINT") else None
+    )
+    if UPSTREAM_MAX_RETRIES > 0:
+        GEMINI_REQUEST_OPTIONS["retry"] = api_retry.Retry(
+            predicate=api_retry.if_transient_error,
+            initial=UPSTREAM_RETRY_BACKOFF,
+            timeout=UPSTREAM_READ_TIMEOUT
+        )
+
+# google.generativeai alone takes most of the import time; it loads with the first Gemini call
+genai = LazyModule("google.generativeai", setup=configure_gemini)
 
 # Configure OpenWeather API
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
-OPENWEATHER_BASE_URL = "https://api.openweathermap.org/data/2.5"
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "https://api.openweathermap.org/data/2.5")
 
-# Initializing the app
-app = Flask(__name__)
+# Weather cache settings (TTLs in seconds)
+WEATHER_CACHE_TTLS = {
+    "current": int(os.getenv("WEATHER_CACHE_CURRENT_TTL", "600")),
+    "forecast": int(os.getenv("WEATHER_CACHE_FORECAST_TTL", "1800"))
+}
+WEATHER_CACHE_STALE_TTL = int(os.getenv("WEATHER_CACHE_STALE_TTL", "3600"))
+WEATHER_CACHE_MAX_ENTRIES = int(os.getenv("WEATHER_CACHE_MAX_ENTRIES", "512"))
 
-@app.route('/', methods=["GET"])
-def home_page():
-    return render_template('index.html')
+# Upstream HTTP client settings
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.5"))
+UPSTREAM_HTTP_POOL_SIZE = int(os.getenv("UPSTREAM_HTTP_POOL_SIZE", "16"))
+
+# Gemini calls get the same bounds; the client's default retry would otherwise keep
+# retrying 5xx/429 responses for up to ten minutes (the retry is set by configure_gemini)
+GEMINI_REQUEST_OPTIONS = {
+    "timeout": UPSTREAM_READ_TIMEOUT,
+    "retry": None
+}
+
+class UpstreamClient:
+    """
+    Pooled, keep-alive HTTP client with one requests.Session per upstream host.
+    
+    Every session shares the same timeouts and retry policy (backoff on
+    connection errors, 429 and 5xx responses; POSTs are only retried on
+    connection errors and on 429 with Retry-After), and the client keeps
+    per-host counters for latency and connection reuse.
+    """
+    
+    def __init__(self, connect_timeout, read_timeout, max_retries, backoff_factor, pool_size):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+    
+    def _create_session(self):
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        
+        class UpstreamRetry(Retry):
+            def is_retry(self, method, status_code, has_retry_after=False):
+                # A POST that got a 5xx may already have been processed (and billed),
+                # so only replay it when the upstream explicitly asked us to come back
+                if method.upper() == "POST" and not (status_code == 429 and has_retry_after):
+                    return False
+                return super().is_retry(method, status_code, has_retry_after)
+        
+        retry = UpstreamRetry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,  # Never replay a request the upstream may already be processing
+            status=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
+    def session_for(self, host):
+        """Returns the pooled session for a host, creating it on first use"""
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = self._sessions[host] = self._create_session()
+                self._stats[host] = {"requests": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0}
+            return session
+    
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request through the pooled session for the URL's host.
+        
+        Args:
+            method (str): HTTP method
+            url (str): Full upstream URL
+            **kwargs: Passed through to requests.Session.request
+            
+        Returns:
+            requests.Response: The upstream response
+        """
+        host = urlsplit(url).netloc
+        session = self.session_for(host)
+        kwargs.setdefault("timeout", self.timeout)
+        
+        start = time.monotonic()
+        failed = True
+        try:
+            response = session.request(method, url, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                stats = self._stats[host]
+                stats["requests"] += 1
+                stats["errors"] += int(failed)
+                stats["total_latency"] += elapsed
+                stats["max_latency"] = max(stats["max_latency"], elapsed)
+    
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+    
+    def stats(self):
+        """Returns per-host latency and connection reuse counters"""
+        with self._lock:
+            sessions = dict(self._sessions)
+            stats = {host: dict(values) for host, values in self._stats.items()}
+        
+        for host, values in stats.items():
+            # urllib3 counts new connections and requests per connection pool
+            new_connections = pooled_requests = 0
+            for adapter in set(sessions[host].adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        new_connections += pool.num_connections
+                        pooled_requests += pool.num_requests
+            
+            count = values["requests"]
+            values["avg_latency_ms"] = round(values.pop("total_latency") / count * 1000, 1) if count else 0.0
+            values["max_latency_ms"] = round(values.pop("max_latency") * 1000, 1)
+            values["new_connections"] = new_connections
+            values["reused_connections"] = max(0, pooled_requests - new_connections)
+        return stats
+
+upstream_client = UpstreamClient(
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_READ_TIMEOUT,
+    UPSTREAM_MAX_RETRIES,
+    UPSTREAM_RETRY_BACKOFF,
+    UPSTREAM_HTTP_POOL_SIZE
+)
+
+class LatencyTracker:
+    """
+    Keeps a rolling window of latency samples per label (route, bot, provider...)
+    and summarizes them as count / p50 / p95 / max in milliseconds.
+    """
+    
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+    
+    def record(self, label, seconds):
+        with self._lock:
+            if label not in self._samples:
+                self._samples[label] = deque(maxlen=self.window)
+                self._counts[label] = 0
+            self._samples[label].append(seconds)
+            self._counts[label] += 1
+    
+    def stats(self):
+        """Returns latency summaries keyed by label"""
+        with self._lock:
+            snapshot = {label: (sorted(samples), self._counts[label]) for label, samples in self._samples.items()}
+        
+        summary = {}
+        for label, (samples, count) in snapshot.items():
+            summary[label] = {
+                "count": count,
+                "p50_ms": round(samples[int(0.50 * (len(samples) - 1))] * 1000, 1),
+                "p95_ms": round(samples[int(0.95 * (len(samples) - 1))] * 1000, 1),
+                "max_ms": round(samples[-1] * 1000, 1)
+            }
+        return summary
+
+METRIC_LABEL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n"})
+
+def format_metric_labels(names, values):
+    """Formats a Prometheus label set, escaping backslashes, quotes and newlines"""
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value).translate(METRIC_LABEL_ESCAPES)}"' for name, value in zip(names, values)) + "}"
+
+class Histogram:
+    """
+    Prometheus-style histogram with optional labels.
+    
+    Observations are counted into fixed upper-bound buckets per label set;
+    render() writes the cumulative buckets, sum and count in the text
+    exposition format.
+    """
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, *labels):
+        """Records one observation for the given label values (in labelnames order)"""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    @contextmanager
+    def time(self, *labels):
+        """Observes the duration of a with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+    
+    def render(self):
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                bucket_labels = format_metric_labels(self.labelnames + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = format_metric_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Collects the histograms and callback metrics served at /metrics.
+    
+    Callback metrics read existing counters (limiters, caches, breakers)
+    at scrape time instead of being updated on the hot path.
+    """
+    
+    def __init__(self):
+        self._histograms = []
+        self._callbacks = []
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=()):
+        histogram = Histogram(name, help_text, labelnames, buckets)
+        self._histograms.append(histogram)
+        return histogram
+    
+    def callback(self, name, metric_type, help_text, labelnames, collect):
+        """
+        Registers a gauge or counter whose samples come from collect().
+        
+        Args:
+            name (str): Metric name
+            metric_type (str): 'gauge' or 'counter'
+            help_text (str): HELP line
+            labelnames (tuple): Label names
+            collect (callable): Returns a dict of label value tuple -> number
+        """
+        self._callbacks.append((name, metric_type, help_text, tuple(labelnames), collect))
+    
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        for name, metric_type, help_text, labelnames, collect in self._callbacks:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in collect().items():
+                lines.append(f"{name}{format_metric_labels(labelnames, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+metrics = MetricsRegistry()
+http_request_duration_seconds = metrics.histogram(
+    "http_request_duration_seconds", "Request latency by route and chat bot (streams until the last event)",
+    ("route", "method", "status", "bot"), LATENCY_BUCKETS
+)
+http_request_size_bytes = metrics.histogram(
+    "http_request_size_bytes", "Request body size by route", ("route",), SIZE_BUCKETS
+)
+http_response_size_bytes = metrics.histogram(
+    "http_response_size_bytes", "Response body size by route (non-streamed responses)", ("route",), SIZE_BUCKETS
+)
+upstream_request_duration_seconds = metrics.histogram(
+    "upstream_request_duration_seconds", "Time holding an upstream slot (whole call, or whole stream)",
+    ("upstream",), LATENCY_BUCKETS
+)
+audio_decode_seconds = metrics.histogram(
+    "audio_decode_seconds", "Time decoding uploaded audio to PCM", (), LATENCY_BUCKETS
+)
+location_detection_seconds = metrics.histogram(
+    "location_detection_seconds", "Time detecting a location in an Articuno message", (),
+    (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+)
+markdown_render_seconds = metrics.histogram(
+    "markdown_render_seconds", "Time converting markdown to HTML (cache misses and stream blocks)", (),
+    (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+)
+
+# Time-to-first-token and total duration of streamed chat replies, per bot
+chat_ttft = LatencyTracker()
+chat_stream_duration = LatencyTracker()
+
+class JobQueue:
+    """
+    Bounded worker pool with job tracking for slow, self-contained tasks.
+    
+    At most `max_depth` jobs may be queued or running at once; further
+    submissions are rejected straight away so callers can answer with 503
+    instead of tying up a request thread. Finished jobs are kept for
+    `job_ttl` seconds so clients can poll for their result.
+    """
+    
+    def __init__(self, name, workers, max_depth, job_ttl):
+        self.name = name
+        self.workers = workers
+        self.max_depth = max_depth
+        self.job_ttl = job_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_times = LatencyTracker()
+        self.run_times = LatencyTracker()
+    
+    def submit(self, func, *args):
+        """
+        Queues func(*args) on the worker pool.
+        
+        Returns:
+            str or None: The job id, or None when the queue is full
+        """
+        with self._lock:
+            self._expire_jobs()
+            if self._active >= self.max_depth:
+                self.rejected += 1
+                return None
+            
+            job_id = uuid.uuid4().hex
+            job = {
+                "status": "queued",
+                "submitted_at": time.monotonic(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None,
+                "retry_after": None,
+                "done": threading.Event()
+            }
+            self._jobs[job_id] = job
+            self._active += 1
+            self.submitted += 1
+        
+        self._executor.submit(self._run, job, func, args)
+        return job_id
+    
+    def _run(self, job, func, args):
+        job["started_at"] = time.monotonic()
+        job["status"] = "running"
+        self.wait_times.record(self.name, job["started_at"] - job["submitted_at"])
+        with self._lock:
+            self._running += 1
+        
+        try:
+            job["result"] = func(*args)
+            job["status"] = "done"
+        except Exception as e:
+            job["error"] = str(e)
+            # Errors that say when to come back (e.g. a busy upstream) keep that hint
+            job["retry_after"] = getattr(e, "retry_after", None)
+            job["status"] = "failed"
+        finally:
+            job["finished_at"] = time.monotonic()
+            self.run_times.record(self.name, job["finished_at"] - job["started_at"])
+            with self._lock:
+                self._active -= 1
+                self._running -= 1
+                if job["status"] == "done":
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            job["done"].set()
+    
+    def _expire_jobs(self):
+        # Called with the lock held
+        cutoff = time.monotonic() - self.job_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["finished_at"] is not None and job["finished_at"] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+    
+    def get(self, job_id):
+        """Returns the public view of a job, or None if it is unknown or expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        
+        view = {"job_id": job_id, "status": job["status"]}
+        if job["started_at"] is not None:
+            view["queue_wait_ms"] = round((job["started_at"] - job["submitted_at"]) * 1000, 1)
+        if job["finished_at"] is not None:
+            view["processing_ms"] = round((job["finished_at"] - job["started_at"]) * 1000, 1)
+        if job["status"] == "done":
+            view["result"] = job["result"]
+        elif job["status"] == "failed":
+            view["error"] = job["error"]
+            if job["retry_after"] is not None:
+                view["retry_after"] = max(1, int(job["retry_after"] + 0.999))
+        return view
+    
+    def wait(self, job_id, timeout):
+        """Blocks until the job finishes or the timeout passes, then returns its view"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job["done"].wait(timeout)
+        return self.get(job_id)
+    
+    def retry_after(self):
+        """Estimates how many seconds a rejected client should wait before retrying"""
+        run_stats = self.run_times.stats().get(self.name)
+        typical_run = run_stats["p50_ms"] / 1000 if run_stats else 5
+        with self._lock:
+            backlog = self._active - self._running
+        return max(1, int(typical_run * (backlog / self.workers + 1)))
+    
+    def stats(self):
+        """Returns queue depth, throughput counters and wait/processing times"""
+        with self._lock:
+            stats = {
+                "workers": self.workers,
+                "max_depth": self.max_depth,
+                "queued": self._active - self._running,
+                "running": self._running,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed
+            }
+        stats["queue_wait"] = self.wait_times.stats().get(self.name)
+        stats["processing"] = self.run_times.stats().get(self.name)
+        return stats
+
+# Transcription runs on its own bounded pool so long voice notes can't starve /api/chat
+TRANSCRIBE_WAIT_TIMEOUT = float(os.getenv("TRANSCRIBE_WAIT_TIMEOUT", "25"))
+transcription_jobs = JobQueue(
+    "transcribe",
+    workers=int(os.getenv("TRANSCRIBE_WORKERS", "2")),
+    max_depth=int(os.getenv("TRANSCRIBE_QUEUE_DEPTH", "8")),
+    job_ttl=int(os.getenv("TRANSCRIBE_JOB_TTL", "300"))
+)
+
+class ResponseCache:
+    """
+    Base class for chat response caches with TTL expiry and hit/miss counters.
+    
+    Backends implement _get(key, now) and _set(key, value, expires_at).
+    """
+    
+    backend = None
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counter_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        """Returns the cached value for a key, or None if missing or expired"""
+        value = self._get(key, time.time())
+        with self._counter_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        self._set(key, value, time.time() + self.ttl)
+    
+    def stats(self):
+        with self._counter_lock:
+            return {
+                "backend": self.backend,
+                "ttl": self.ttl,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class MemoryResponseCache(ResponseCache):
+    """In-process LRU response cache"""
+    
+    backend = "memory"
+    
+    def __init__(self, ttl, max_entries):
+        super().__init__(ttl, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def _set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class ThreadLocalSQLite:
+    """Mixin giving each thread its own WAL-mode sqlite3 connection to one database file"""
+    
+    def _open_sqlite(self, path):
+        self.path = path
+        self._local = threading.local()
+    
+    def _connection(self):
+        # sqlite3 connections can't be shared across threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+class SQLiteResponseCache(ThreadLocalSQLite, ResponseCache):
+    """
+    SQLite-backed response cache so several worker processes can share hits.
+    
+    Entries are evicted least-recently-used once the table exceeds max_entries.
+    """
+    
+    backend = "sqlite"
+    
+    def __init__(self, ttl, max_entries, path):
+        super().__init__(ttl, max_entries)
+        self._open_sqlite(path)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS chat_responses_last_used ON chat_responses (last_used)")
+    
+    def _get(self, key, now):
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value FROM chat_responses WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE chat_responses SET last_used = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+    
+    def _set(self, key, value, expires_at):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_responses (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, expires_at, now)
+            )
+            conn.execute("DELETE FROM chat_responses WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM chat_responses WHERE key IN ("
+                "SELECT key FROM chat_responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+def create_response_cache(backend):
+    """
+    Creates the chat response cache selected by CHAT_RESPONSE_CACHE.
+    
+    Args:
+        backend (str): 'memory', 'sqlite' or 'off'
+        
+    Returns:
+        ResponseCache or None: None when response caching is disabled
+    """
+    ttl = int(os.getenv("CHAT_RESPONSE_CACHE_TTL", "3600"))
+    max_entries = int(os.getenv("CHAT_RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+    
+    if backend == "memory":
+        return MemoryResponseCache(ttl, max_entries)
+    if backend == "sqlite":
+        return SQLiteResponseCache(ttl, max_entries, os.getenv("CHAT_RESPONSE_CACHE_PATH", "chat_cache.sqlite3"))
+    return None
+
+# Chat response memoization is opt-in
+response_cache = create_response_cache(os.getenv("CHAT_RESPONSE_CACHE", "off").lower())
+
+def estimate_tokens(text):
+    """Rough token count for prompt budgeting (about four characters per token)"""
+    return len(text) // 4 + 1 if text else 0
+
+class ChatSessionStore:
+    """
+    Base class for server-side chat sessions with a token-budgeted history.
+    
+    A session keeps the recent turns verbatim. Once they exceed token_budget
+    the oldest user/assistant exchanges are folded into a short extractive
+    summary, which is itself capped at a quarter of the budget by dropping
+    its oldest lines. Backends implement _load(session_id, now),
+    _save(session_id, data, now), _delete(session_id) and _count() over
+    JSON-encoded sessions.
+    """
+    
+    backend = None
+    
+    def __init__(self, ttl, max_sessions, token_budget):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.token_budget = token_budget
+        self.summary_budget = token_budget // 4
+        self._lock = threading.Lock()
+    
+    def get(self, session_id):
+        """Returns the session dict for an id, or None if unknown or expired"""
+        data = self._load(session_id, time.time())
+        return json.loads(data) if data else None
+    
+    def get_or_create(self, session_id):
+        session = self.get(session_id)
+        if session is None:
+            session = {
+                "id": session_id,
+                "summary": [],
+                "history": [],
+                "stats": {
+                    "turns": 0,
+                    "summarized_turns": 0,
+                    "prompt_tokens_last": 0,
+                    "prompt_tokens_max": 0,
+                    "prompt_tokens_total": 0,
+                    "latency_ms_last": 0,
+                    "latency_ms_total": 0
+                }
+            }
+        return session
+    
+    def delete(self, session_id):
+        self._delete(session_id)
+    
+    def record_turn(self, session_id, user_text, reply_text, prompt_tokens, latency):
+        """
+        Appends a user/assistant exchange to a session and trims it to the token budget.
+        
+        Args:
+            session_id (str): The session id
+            user_text (str): The user message as it should be remembered
+            reply_text (str): The assistant reply
+            prompt_tokens (int): Estimated tokens of context plus message sent for this turn
+            latency (float): Seconds taken to produce the reply
+        """
+        # Load-modify-save under one lock so concurrent turns aren't lost
+        with self._lock:
+            session = self.get_or_create(session_id)
+            session["history"].append({"role": "user", "text": user_text, "tokens": estimate_tokens(user_text)})
+            session["history"].append({"role": "assistant", "text": reply_text, "tokens": estimate_tokens(reply_text)})
+            
+            # Fold the oldest exchanges into the summary until the history fits
+            history = session["history"]
+            while history and sum(turn["tokens"] for turn in history) > self.token_budget:
+                user_turn, reply_turn = history.pop(0), history.pop(0)
+                session["summary"].append(summarize_exchange(user_turn["text"], reply_turn["text"]))
+                session["stats"]["summarized_turns"] += 1
+            while session["summary"] and estimate_tokens("\n".join(session["summary"])) > self.summary_budget:
+                session["summary"].pop(0)
+            
+            stats = session["stats"]
+            stats["turns"] += 1
+            stats["prompt_tokens_last"] = prompt_tokens
+            stats["prompt_tokens_max"] = max(stats["prompt_tokens_max"], prompt_tokens)
+            stats["prompt_tokens_total"] += prompt_tokens
+            stats["latency_ms_last"] = round(latency * 1000, 1)
+            stats["latency_ms_total"] += round(latency * 1000, 1)
+            
+            self._save(session_id, json.dumps(session), time.time())
+    
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "sessions": self._count(),
+            "max_sessions": self.max_sessions,
+            "ttl": self.ttl,
+            "token_budget": self.token_budget
+        }
+
+class MemoryChatSessionStore(ChatSessionStore):
+    """In-process LRU session store"""
+    
+    backend = "memory"
+    
+    def __init__(self, ttl, max_sessions, token_budget):
+        super().__init__(ttl, max_sessions, token_budget)
+        self._sessions = OrderedDict()
+        self._entries_lock = threading.Lock()
+    
+    def _load(self, session_id, now):
+        with self._entries_lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            data, updated_at = entry
+            if updated_at + self.ttl <= now:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return data
+    
+    def _save(self, session_id, data, now):
+        with self._entries_lock:
+            self._sessions[session_id] = (data, now)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+    
+    def _delete(self, session_id):
+        with self._entries_lock:
+            self._sessions.pop(session_id, None)
+    
+    def _count(self):
+        with self._entries_lock:
+            return len(self._sessions)
+
+class SQLiteChatSessionStore(ThreadLocalSQLite, ChatSessionStore):
+    """SQLite-backed session store so sessions survive restarts and are shared by workers"""
+    
+    backend = "sqlite"
+    
+    def __init__(self, ttl, max_sessions, token_budget, path):
+        super().__init__(ttl, max_sessions, token_budget)
+        self._open_sqlite(path)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS chat_sessions_updated_at ON chat_sessions (updated_at)")
+    
+    def _load(self, session_id, now):
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT data FROM chat_sessions WHERE id = ? AND updated_at > ?", (session_id, now - self.ttl)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def _save(self, session_id, data, now):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_sessions (id, data, updated_at) VALUES (?, ?, ?)",
+                (session_id, data, now)
+            )
+            conn.execute("DELETE FROM chat_sessions WHERE updated_at <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM chat_sessions WHERE id IN ("
+                "SELECT id FROM chat_sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions,)
+            )
+    
+    def _delete(self, session_id):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+    
+    def _count(self):
+        with self._connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0]
+
+def summarize_exchange(user_text, reply_text):
+    """Condenses a dropped user/assistant exchange to one summary line"""
+    def first_sentence(text, limit):
+        text = " ".join(text.split())
+        match = re.match(r"(.+?[.!?])(\s|$)", text)
+        sentence = match.group(1) if match else text
+        return sentence if len(sentence) <= limit else sentence[:limit].rstrip() + "..."
+    
+    return f"User: {first_sentence(user_text, 160)} / Assistant: {first_sentence(reply_text, 200)}"
+
+def create_chat_session_store(backend):
+    """
+    Creates the chat session store selected by CHAT_SESSIONS.
+    
+    Args:
+        backend (str): 'memory', 'sqlite' or 'off'
+        
+    Returns:
+        ChatSessionStore or None: None when sessions are disabled
+    """
+    ttl = int(os.getenv("CHAT_SESSION_TTL", "86400"))
+    max_sessions = int(os.getenv("CHAT_SESSION_MAX", "1000"))
+    token_budget = int(os.getenv("CHAT_SESSION_TOKEN_BUDGET", "3000"))
+    
+    if backend == "memory":
+        return MemoryChatSessionStore(ttl, max_sessions, token_budget)
+    if backend == "sqlite":
+        return SQLiteChatSessionStore(ttl, max_sessions, token_budget, os.getenv("CHAT_SESSION_PATH", "chat_sessions.sqlite3"))
+    return None
+
+chat_sessions = create_chat_session_store(os.getenv("CHAT_SESSIONS", "memory").lower())
+
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls so only one reaches the upstream.
+    
+    The first caller for a (group, key) runs the function; callers arriving
+    while it is in flight wait for it and receive the same result or error.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+    
+    def do(self, group, key, fn):
+        """
+        Runs fn() once for all concurrent callers with the same group and key.
+        
+        Args:
+            group (str): Counter group, e.g. 'weather' or 'chat'
+            key (hashable): Identifies identical requests within the group
+            fn (callable): The upstream call
+            
+        Returns:
+            The result of fn(), shared with every waiting caller
+        """
+        flight_key = (group, key)
+        with self._lock:
+            stats = self._stats.setdefault(group, {"calls": 0, "deduplicated": 0})
+            call = self._calls.get(flight_key)
+            leader = call is None
+            if leader:
+                call = self._calls[flight_key] = {"done": threading.Event(), "result": None, "error": None}
+                stats["calls"] += 1
+            else:
+                stats["deduplicated"] += 1
+        
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[flight_key]
+            call["done"].set()
+    
+    def stats(self):
+        """Returns upstream calls made and calls deduplicated per group"""
+        with self._lock:
+            stats = {group: dict(values) for group, values in self._stats.items()}
+            for group, values in stats.items():
+                values["in_flight"] = sum(1 for flight_group, _ in self._calls if flight_group == group)
+        return stats
+
+single_flight = SingleFlight()
+
+class MarkdownRenderer:
+    """
+    Renders markdown to HTML with reusable Markdown instances and an LRU HTML cache.
+    
+    markdown.Markdown instances aren't thread-safe, so each conversion takes
+    an idle instance from the pool (creating one if none is free), resets it
+    and returns it afterwards. Rendered HTML is cached by the hash of the
+    markdown text.
+    """
+    
+    def __init__(self, cache_entries):
+        self.cache_entries = cache_entries
+        self._idle = []
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.instances = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def convert(self, text):
+        """Renders markdown with a pooled instance, bypassing the HTML cache"""
+        with self._lock:
+            if self._idle:
+                md = self._idle.pop()
+            else:
+                md = None
+                self.instances += 1
+        if md is None:
+            md = markdown.Markdown()
+        try:
+            with markdown_render_seconds.time():
+                return md.reset().convert(text)
+        finally:
+            with self._lock:
+                self._idle.append(md)
+    
+    def render(self, text):
+        """
+        Renders markdown to HTML, reusing the cached HTML for text seen before.
+        
+        Args:
+            text (str): Markdown text
+            
+        Returns:
+            str: The rendered HTML
+        """
+        key = hashlib.sha1(text.encode()).digest()
+        with self._lock:
+            html_output = self._cache.get(key)
+            if html_output is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return html_output
+            self.misses += 1
+        
+        html_output = self.convert(text)
+        with self._lock:
+            self._cache[key] = html_output
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return html_output
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "instances": self.instances,
+                "idle": len(self._idle),
+                "cache_entries": len(self._cache),
+                "max_cache_entries": self.cache_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+markdown_renderer = MarkdownRenderer(int(os.getenv("MARKDOWN_CACHE_MAX_ENTRIES", "512")))
+
+class IncrementalMarkdownRenderer:
+    """
+    Renders a growing markdown document for streaming.
+    
+    Text before the last safe block boundary is rendered once and committed;
+    each feed only re-renders the trailing, still-growing block. A boundary
+    is a blank line followed by a block that can't continue the previous one
+    (not indented, not a list item or quote) outside a code fence, so the
+    committed blocks render as they would in the whole document. Text is
+    held back while a raw HTML block is still open or while it uses a
+    reference link whose definition hasn't arrived yet; definitions already
+    committed are passed along with every later render.
+    """
+    
+    BOUNDARY_RE = re.compile(r"\n[ \t]*\n(?=[^\s>*+\-\d])")
+    HTML_BLOCK_TAG_RE = re.compile(r"^[ ]{0,3}<([A-Za-z][A-Za-z0-9-]*)", re.MULTILINE)
+    HTML_VOID_TAGS = frozenset(["area", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"])
+    REFERENCE_DEFINITION_RE = re.compile(r"^[ ]{0,3}\[([^\]\n]+)\]:[ \t]*\S.*$", re.MULTILINE)
+    # [text][label], [label][] and the shortcut [label]; not inline links, images' (url) or definitions
+    REFERENCE_USE_RE = re.compile(r"\[([^\]\n]+)\](?:[ ]?\[([^\]\n]*)\]|(?![(:\[]))")
+    
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.text = ""
+        self.committed = 0
+        self.definitions = []
+        self.labels = set()
+    
+    @staticmethod
+    def _label(text):
+        # Python-Markdown matches reference labels case- and whitespace-insensitively
+        return " ".join(text.lower().split())
+    
+    def _html_block_open(self, text):
+        """Whether text leaves a raw HTML block or comment unclosed"""
+        if text.count("<!--") > text.count("-->"):
+            return True
+        for tag in set(tag.lower() for tag in self.HTML_BLOCK_TAG_RE.findall(text)) - self.HTML_VOID_TAGS:
+            opened = len(re.findall(rf"<{tag}(?=[\s>/])", text, re.IGNORECASE))
+            closed = len(re.findall(rf"</{tag}\s*>", text, re.IGNORECASE)) + len(re.findall(rf"<{tag}\b[^>]*/>", text, re.IGNORECASE))
+            if opened > closed:
+                return True
+        return False
+    
+    def _can_commit(self, block):
+        """Whether block renders the same on its own as inside the whole document"""
+        if "<" in block and self._html_block_open(block):
+            return False
+        if "[" not in block:
+            return True
+        labels = self.labels | {self._label(match.group(1)) for match in self.REFERENCE_DEFINITION_RE.finditer(block)}
+        return all(
+            self._label(match.group(2) or match.group(1)) in labels
+            for match in self.REFERENCE_USE_RE.finditer(block)
+        )
+    
+    def _convert(self, text):
+        # Definitions render to nothing, so committed ones can be appended safely
+        # unless the text ends inside a code fence or HTML block
+        if self.definitions and text.count("```") % 2 == 0 and not self._html_block_open(text):
+            text = text + "\n\n" + "\n".join(self.definitions)
+        return self.renderer.convert(text)
+    
+    def feed(self, chunk):
+        """
+        Appends streamed text.
+        
+        Args:
+            chunk (str): The next markdown fragment
+            
+        Returns:
+            tuple: (appended_html, tail_html) - HTML for newly committed blocks,
+            to be appended to earlier output, and HTML for the open trailing block
+        """
+        self.text += chunk
+        pending = self.text[self.committed:]
+        
+        # Commit up to the last boundary that isn't inside a code fence and leaves nothing unresolved
+        boundaries = [match.end() for match in self.BOUNDARY_RE.finditer(pending)
+                      if pending.count("```", 0, match.start()) % 2 == 0]
+        split_at = next((end for end in reversed(boundaries) if self._can_commit(pending[:end])), None)
+        
+        appended_html = ""
+        if split_at is not None:
+            block = pending[:split_at]
+            # Markdown separates top-level blocks with a newline
+            appended_html = self._convert(block) + "\n"
+            for match in self.REFERENCE_DEFINITION_RE.finditer(block):
+                self.definitions.append(match.group(0).strip())
+                self.labels.add(self._label(match.group(1)))
+            self.committed += split_at
+            pending = pending[split_at:]
+        
+        return appended_html, self._convert(pending)
+
+class ImageStore:
+    """
+    Content-addressed store for prepared chat images.
+    
+    Images are keyed by the SHA-256 of the bytes the client uploaded, so a
+    client that already sent an image can refer to it by hash alone. Entries
+    expire after `ttl` seconds and the least recently used are evicted once
+    the total size (bytes plus any cached data URL) exceeds `max_bytes`. Each
+    entry can also remember provider file handles (e.g. Gemini File API
+    uploads) so the bytes aren't re-sent.
+    """
+    
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.provider_uploads = 0
+    
+    def get(self, image_hash):
+        """Returns the stored image dict for a hash, or None if unknown or expired"""
+        with self._lock:
+            image = self._entries.get(image_hash)
+            if image is not None and image["expires_at"] <= time.time():
+                self._remove(image_hash)
+                image = None
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(image_hash)
+            self.hits += 1
+            return image
+    
+    def put(self, image_hash, image):
+        """Stores a prepared image under its hash and returns the stored dict"""
+        image = dict(image, hash=image_hash, expires_at=time.time() + self.ttl, provider_files={})
+        with self._lock:
+            if image_hash in self._entries:
+                # Same bytes, so uploads already made to providers stay valid
+                image["provider_files"] = self._entries[image_hash]["provider_files"]
+                self._remove(image_hash)
+            self._entries[image_hash] = image
+            self._size += self._entry_size(image)
+            self._evict()
+        return image
+    
+    def set_data_url(self, image, data_url):
+        """Caches the base64 data URL on a stored image, counting it against max_bytes"""
+        with self._lock:
+            if "data_url" in image:
+                return
+            image["data_url"] = data_url
+            if self._entries.get(image.get("hash")) is image:
+                self._size += len(data_url)
+                self._evict()
+    
+    @staticmethod
+    def _entry_size(image):
+        return len(image["data"]) + len(image.get("data_url", ""))
+    
+    def _evict(self):
+        # Called with the lock held
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+    
+    def _remove(self, image_hash):
+        # Called with the lock held
+        image = self._entries.pop(image_hash)
+        self._size -= self._entry_size(image)
+    
+    def get_provider_file(self, image, provider):
+        """Returns a still-valid provider file handle for a stored image, or None"""
+        handle, expires_at = image["provider_files"].get(provider, (None, 0))
+        return handle if expires_at > time.time() else None
+    
+    def set_provider_file(self, image, provider, handle, ttl):
+        image["provider_files"][provider] = (handle, time.time() + ttl)
+        with self._lock:
+            self.provider_uploads += 1
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "provider_uploads": self.provider_uploads
+            }
+
+image_store = ImageStore(
+    max_bytes=int(os.getenv("IMAGE_STORE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=int(os.getenv("IMAGE_STORE_TTL", "3600"))
+)
+
+# Upload chat images to the Gemini File API once and reuse the handle on later turns
+GEMINI_IMAGE_FILE_UPLOADS = os.getenv("GEMINI_IMAGE_FILE_UPLOADS", "false").lower() in ("1", "true", "yes")
+GEMINI_FILE_TTL = 47 * 3600  # Gemini deletes uploaded files after 48 hours
+
+class UnknownImageError(Exception):
+    """Raised when a chat request refers to an image hash the server no longer has"""
+
+class InvalidImageError(Exception):
+    """Raised when a JSON chat request carries an image payload that can't be decoded"""
+
+# Overall deadline (seconds) for the combined current + forecast fetch
+WEATHER_FETCH_DEADLINE = float(os.getenv("WEATHER_FETCH_DEADLINE", "10"))
+WEATHER_BATCH_MAX_LOCATIONS = int(os.getenv("WEATHER_BATCH_MAX_LOCATIONS", "20"))
+WEATHER_BATCH_CONCURRENCY = int(os.getenv("WEATHER_BATCH_CONCURRENCY", "8"))
+WEATHER_TYPES = ("current", "forecast")
+# 'slim' trims weather payloads to what the weather modal reads (see project_weather)
+WEATHER_FIELDS = ("full", "slim")
+WEATHER_SLIM_FORECAST_DAYS = 3
+WEATHER_SLIM_DAY_FIELDS = ("day", "date_label", "temp_avg", "description", "icon")
+
+# Shared thread pool for issuing upstream calls concurrently
+upstream_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("UPSTREAM_POOL_SIZE", "16")),
+    thread_name_prefix="upstream"
+)
+
+class UpstreamUnavailableError(Exception):
+    """Raised when an upstream can't take a call right now; retry_after is in seconds"""
+    
+    def __init__(self, provider, retry_after, message=None):
+        super().__init__(message or f"{provider} is temporarily unavailable, please retry in {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+class CircuitOpenError(UpstreamUnavailableError):
+    """Raised when a chat provider's circuit breaker is open and nothing else can serve the request"""
+
+class UpstreamBusyError(UpstreamUnavailableError):
+    """Raised when an upstream's concurrency limit and wait queue are both full"""
+    
+    def __init__(self, provider, retry_after):
+        super().__init__(provider, retry_after, f"{provider} is at capacity, please retry shortly")
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker for one upstream provider.
+    
+    The breaker opens when, over the last `window` calls (once there are at
+    least `min_calls`), the error rate reaches `error_rate` or the p95 latency
+    exceeds `p95_latency` seconds. Calls are then rejected for `cooldown`
+    seconds, after which a single trial call is let through (half-open):
+    success closes the breaker, failure opens it again.
+    """
+    
+    def __init__(self, name, window, min_calls, error_rate, p95_latency, cooldown):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.p95_latency = p95_latency
+        self.cooldown = cooldown
+        self._calls = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self._opened_at = 0
+        self._trial_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+    
+    def allow(self):
+        """Returns True if a call may go to this provider now (claiming the trial call when half-open)"""
+        with self._lock:
+            if self.state == "open" and time.monotonic() >= self._opened_at + self.cooldown:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "closed" or (self.state == "half_open" and not self._trial_in_flight):
+                self._trial_in_flight = self.state == "half_open"
+                return True
+            self.rejected += 1
+            return False
+    
+    def is_open(self):
+        """Returns True while calls are being rejected, without claiming a trial call"""
+        with self._lock:
+            return self.state == "open" and time.monotonic() < self._opened_at + self.cooldown
+    
+    def retry_after(self):
+        """Seconds until the breaker lets a trial call through"""
+        with self._lock:
+            return max(0.0, self._opened_at + self.cooldown - time.monotonic()) if self.state == "open" else 0.0
+    
+    def record(self, ok, latency):
+        """Records the outcome and latency (seconds) of a call allowed by allow()"""
+        with self._lock:
+            if self.state == "half_open":
+                if ok:
+                    self.state = "closed"
+                    self._calls.clear()
+                else:
+                    self._open()
+                return
+            
+            self._calls.append((ok, latency))
+            if self.state == "closed" and len(self._calls) >= self.min_calls:
+                error_rate, p95 = self._window_stats()
+                if error_rate >= self.error_rate or p95 > self.p95_latency:
+                    self._open()
+    
+    def release(self):
+        """Gives back a call allowed by allow() that never reached the provider"""
+        with self._lock:
+            if self.state == "half_open":
+                self._trial_in_flight = False
+    
+    def _open(self):
+        # Called with the lock held
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+        self.opened += 1
+    
+    def _window_stats(self):
+        # Called with the lock held
+        if not self._calls:
+            return 0.0, 0.0
+        latencies = sorted(latency for _, latency in self._calls)
+        errors = sum(1 for ok, _ in self._calls if not ok)
+        return errors / len(self._calls), latencies[int(0.95 * (len(latencies) - 1))]
+    
+    def p95(self):
+        with self._lock:
+            return self._window_stats()[1]
+    
+    def stats(self):
+        with self._lock:
+            error_rate, p95 = self._window_stats()
+            return {
+                "state": self.state,
+                "calls": len(self._calls),
+                "error_rate": round(error_rate, 3),
+                "p95_ms": round(p95 * 1000, 1),
+                "opened": self.opened,
+                "rejected": self.rejected
+            }
+
+class ChatRouter:
+    """
+    Routes chat model calls through per-provider circuit breakers.
+    
+    Each call names its primary provider and gives a callable per provider
+    that can serve it. With fallback enabled, a call whose primary is open or
+    fails goes to the next provider. With a hedge delay set, the next
+    provider is also called if the primary hasn't answered within that many
+    seconds, and the first successful answer wins.
+    """
+    
+    def __init__(self, breakers, fallback, hedge_delay, executor):
+        self.breakers = breakers
+        self.fallback = fallback
+        self.hedge_delay = hedge_delay
+        self.executor = executor
+        self._lock = threading.Lock()
+        self.served = {name: 0 for name in breakers}
+        self.fallbacks = 0
+        self.hedges = 0
+    
+    def _order(self, primary, providers):
+        return [primary] + ([provider for provider in providers if provider != primary] if self.fallback else [])
+    
+    def _run(self, provider, fn):
+        start = time.monotonic()
+        try:
+            result = fn()
+        except UpstreamBusyError:
+            # Our own concurrency limit, not a provider failure
+            self.breakers[provider].release()
+            raise
+        except Exception:
+            self.breakers[provider].record(False, time.monotonic() - start)
+            raise
+        self.breakers[provider].record(True, time.monotonic() - start)
+        return result
+    
+    def _served(self, primary, provider):
+        with self._lock:
+            self.served[provider] += 1
+            if provider != primary:
+                self.fallbacks += 1
+    
+    def check(self, primary, providers, limiters=None):
+        """
+        Raises CircuitOpenError if every provider that could serve a call is
+        open, or UpstreamBusyError if every one that isn't is at capacity.
+        """
+        order = self._order(primary, providers)
+        if all(self.breakers[provider].is_open() for provider in order):
+            raise CircuitOpenError(primary, min(self.breakers[provider].retry_after() for provider in order))
+        if limiters is not None:
+            error = None
+            for provider in order:
+                if self.breakers[provider].is_open():
+                    continue
+                try:
+                    limiters[provider].check()
+                    return
+                except UpstreamBusyError as e:
+                    error = error or e
+            raise error
+    
+    def call(self, primary, calls):
+        """
+        Runs a call on the best available provider.
+        
+        Args:
+            primary (str): The provider the bot normally uses
+            calls (dict): Provider name -> zero-argument callable returning the reply
+            
+        Returns:
+            tuple: (result, provider) - the reply and the provider that produced it
+            
+        Raises:
+            CircuitOpenError: If every eligible provider is open
+            UpstreamBusyError: If the providers tried were at their concurrency limit
+            Exception: The last provider error if every attempt failed
+        """
+        order = self._order(primary, calls)
+        error = None
+        index = 0
+        while index < len(order):
+            provider = order[index]
+            index += 1
+            breaker = self.breakers[provider]
+            if not breaker.allow():
+                error = error or CircuitOpenError(provider, breaker.retry_after())
+                continue
+            
+            if not self.hedge_delay or index >= len(order):
+                try:
+                    result = self._run(provider, calls[provider])
+                except Exception as e:
+                    error = e
+                    continue
+                self._served(primary, provider)
+                return result, provider
+            
+            # Hedged: give the provider a head start, then race the next one
+            futures = {self.executor.submit(self._run, provider, calls[provider]): provider}
+            done, _ = wait(futures, timeout=self.hedge_delay)
+            if not done and self.breakers[order[index]].allow():
+                hedge_provider = order[index]
+                index += 1
+                with self._lock:
+                    self.hedges += 1
+                futures[self.executor.submit(self._run, hedge_provider, calls[hedge_provider])] = hedge_provider
+            
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        self._served(primary, futures[future])
+                        return future.result(), futures[future]
+                    error = future.exception()
+        raise error
+    
+    def stream(self, primary, streams):
+        """
+        Streams a reply from the best available provider.
+        
+        Fails over only before the first chunk; once text has been sent the
+        stream stays with its provider. Latency is recorded as time to first
+        chunk so long answers don't count as slow.
+        
+        Args:
+            primary (str): The provider the bot normally uses
+            streams (dict): Provider name -> zero-argument callable returning a chunk iterator
+            
+        Yields:
+            tuple: (provider, text) for each chunk
+        """
+        error = None
+        for provider in self._order(primary, streams):
+            breaker = self.breakers[provider]
+            if not breaker.allow():
+                error = error or CircuitOpenError(provider, breaker.retry_after())
+                continue
+            
+            start = time.monotonic()
+            first_chunk_latency = None
+            try:
+                for text in streams[provider]():
+                    if first_chunk_latency is None:
+                        first_chunk_latency = time.monotonic() - start
+                    yield provider, text
+            except GeneratorExit:
+                # The client went away; that says nothing about the provider
+                breaker.record(True, first_chunk_latency or time.monotonic() - start)
+                raise
+            except UpstreamBusyError as e:
+                # No slot before the first chunk; try the next provider
+                breaker.release()
+                error = e
+                continue
+            except Exception as e:
+                breaker.record(False, first_chunk_latency or time.monotonic() - start)
+                if first_chunk_latency is not None:
+                    raise
+                error = e
+                continue
+            
+            breaker.record(True, first_chunk_latency if first_chunk_latency is not None else time.monotonic() - start)
+            self._served(primary, provider)
+            return
+        raise error
+    
+    def stats(self):
+        with self._lock:
+            stats = {
+                "fallback": self.fallback,
+                "hedge_delay": self.hedge_delay,
+                "served": dict(self.served),
+                "fallbacks": self.fallbacks,
+                "hedges": self.hedges
+            }
+        stats["breakers"] = {name: breaker.stats() for name, breaker in self.breakers.items()}
+        return stats
+
+def create_circuit_breaker(name):
+    """Creates a provider circuit breaker configured from the CIRCUIT_* settings"""
+    return CircuitBreaker(
+        name,
+        window=int(os.getenv("CIRCUIT_WINDOW", "20")),
+        min_calls=int(os.getenv("CIRCUIT_MIN_CALLS", "5")),
+        error_rate=float(os.getenv("CIRCUIT_ERROR_RATE", "0.5")),
+        p95_latency=float(os.getenv("CIRCUIT_P95_LATENCY", "20")),
+        cooldown=float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+    )
+
+# Chat calls go through per-provider breakers; failover and hedging are opt-in
+chat_router = ChatRouter(
+    {"gemini": create_circuit_breaker("gemini"), "azure": create_circuit_breaker("azure")},
+    fallback=os.getenv("CHAT_FALLBACK", "false").lower() in ("1", "true", "yes"),
+    hedge_delay=float(os.getenv("CHAT_HEDGE_DELAY", "0")),
+    executor=upstream_executor
+)
+
+class RateLimiter:
+    """
+    Per-client token-bucket rate limiter.
+    
+    Each client key gets a bucket of `burst` tokens refilled at `per_minute`
+    tokens per minute; a request takes one token. Buckets are kept in LRU
+    order and the least recently seen are dropped past `max_clients`.
+    A per_minute of 0 disables the limiter.
+    """
+    
+    def __init__(self, name, per_minute, burst, max_clients):
+        self.name = name
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+    
+    def acquire(self, key):
+        """
+        Takes a token from the client's bucket.
+        
+        Args:
+            key (str): Client identifier (IP address)
+            
+        Returns:
+            float: 0 if the request may proceed, otherwise seconds until a token is available
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                self.allowed += 1
+                retry_after = 0
+            else:
+                self.rejected += 1
+                retry_after = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return retry_after
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "per_minute": round(self.rate * 60, 2),
+                "burst": self.burst,
+                "clients": len(self._buckets),
+                "allowed": self.allowed,
+                "rejected": self.rejected
+            }
+
+class ConcurrencyLimiter:
+    """
+    Caps concurrent calls to one upstream with a short, bounded wait queue.
+    
+    Up to `limit` calls run at once. Further calls wait up to `queue_timeout`
+    seconds for a slot, but only `max_queue` may wait; anything beyond that
+    (or a wait that runs out) raises UpstreamBusyError straight away so the
+    route can answer 503 instead of piling up threads.
+    """
+    
+    def __init__(self, name, limit, max_queue, queue_timeout):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._avg_hold = 1.0
+    
+    def acquire(self):
+        """Claims a slot, waiting in the queue if needed; raises UpstreamBusyError when it can't"""
+        start = time.monotonic()
+        with self._cond:
+            if self.in_flight >= self.limit or self.waiting:
+                if self.waiting >= self.max_queue or self.queue_timeout <= 0:
+                    self.rejected += 1
+                    raise UpstreamBusyError(self.name, self._retry_after())
+                
+                self.waiting += 1
+                self.queued += 1
+                self.peak_waiting = max(self.peak_waiting, self.waiting)
+                deadline = start + self.queue_timeout
+                try:
+                    while self.in_flight >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.timed_out += 1
+                            raise UpstreamBusyError(self.name, self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+        admission_wait.record(self.name, time.monotonic() - start)
+    
+    def release(self, held):
+        """Frees a slot claimed by acquire(); held is how long it was used, in seconds"""
+        with self._cond:
+            self.in_flight -= 1
+            self._avg_hold += (held - self._avg_hold) * 0.1
+            self._cond.notify()
+    
+    def check(self):
+        """Raises UpstreamBusyError if a call made now would be rejected without waiting"""
+        with self._cond:
+            if self.in_flight >= self.limit and (self.waiting >= self.max_queue or self.queue_timeout <= 0):
+                self.rejected += 1
+                raise UpstreamBusyError(self.name, self._retry_after())
+    
+    @contextmanager
+    def slot(self):
+        """Holds a slot for the duration of a with block"""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - start
+            self.release(held)
+            upstream_request_duration_seconds.observe(held, self.name)
+    
+    def _retry_after(self):
+        # Called with the lock held: time for the queue ahead to drain
+        return max(1.0, self._avg_hold * (self.waiting + 1) / self.limit)
+    
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "peak_waiting": self.peak_waiting,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out
+            }
+
+def create_rate_limiter(name, per_minute, burst):
+    """Creates a per-client rate limiter configured from the <NAME>_RATE_LIMIT_* settings"""
+    prefix = name.upper()
+    return RateLimiter(
+        name,
+        per_minute=float(os.getenv(f"{prefix}_RATE_LIMIT_PER_MINUTE", per_minute)),
+        burst=int(os.getenv(f"{prefix}_RATE_LIMIT_BURST", burst)),
+        max_clients=int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+    )
+
+def create_concurrency_limiter(name, limit, min_limit=1):
+    """
+    Creates an upstream concurrency limiter configured from the <NAME>_MAX_CONCURRENCY/QUEUE settings.
+    
+    Args:
+        name (str): The upstream name, also the setting prefix
+        limit (str): Default concurrency limit
+        min_limit (int): Floor for the configured limit
+        
+    Returns:
+        ConcurrencyLimiter: The limiter
+    """
+    prefix = name.upper()
+    limit = max(int(os.getenv(f"{prefix}_MAX_CONCURRENCY", limit)), min_limit)
+    return ConcurrencyLimiter(
+        name,
+        limit=limit,
+        max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", limit * 2)),
+        queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+    )
+
+# Time calls spent waiting for an upstream slot, per upstream
+admission_wait = LatencyTracker()
+
+# Per-client request rates for the expensive endpoints
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() in ("1", "true", "yes")
+rate_limiters = {
+    "chat": create_rate_limiter("chat", "30", "10"),
+    "transcribe": create_rate_limiter("transcribe", "12", "4")
+}
+
+# Concurrent calls per upstream service
+upstream_limiters = {
+    "gemini": create_concurrency_limiter("gemini", "16"),
+    "azure": create_concurrency_limiter("azure", "16"),
+    "openweather": create_concurrency_limiter("openweather", "32"),
+    # Every transcription worker must get a slot, or the app would reject its own queued jobs
+    "speech": create_concurrency_limiter("speech", "4", min_limit=transcription_jobs.workers)
+}
+
+class WeatherCache:
+    """
+    Thread-safe LRU cache for OpenWeather responses with stale-while-revalidate.
+    
+    Entries are fresh for the TTL of their request type. Once expired they are
+    still served for up to `stale_ttl` seconds while a background thread
+    refreshes them, after which they are dropped and fetched synchronously.
+    """
+    
+    def __init__(self, ttls, stale_ttl, max_entries):
+        self.ttls = ttls
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+    
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns cached data for a key, calling `fetch` when it is missing or expired.
+        
+        Args:
+            key (tuple): Cache key in the form (request_type, location_key)
+            fetch (callable): Returns a (status_code, data) tuple from OpenWeather
+            
+        Returns:
+            tuple: (status_code, data) - only successful responses are cached
+        """
+        now = time.monotonic()
+        start_refresh = False
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                data, fetched_at = entry
+                age = now - fetched_at
+                ttl = self.ttls.get(key[0], 0)
+                
+                if age < ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return 200, data
+                
+                if age < ttl + self.stale_ttl:
+                    # Serve the stale copy and refresh it in the background
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        start_refresh = True
+                else:
+                    del self._entries[key]
+                    entry = None
+            
+            if entry is None:
+                self.misses += 1
+        
+        if entry is not None:
+            if start_refresh:
+                threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+            return 200, data
+        
+        status_code, data = fetch()
+        if status_code == 200:
+            self._store(key, data)
+        return status_code, data
+    
+    def _refresh(self, key, fetch):
+        """Refreshes a stale entry, keeping the old copy if the refresh fails"""
+        try:
+            status_code, data = fetch()
+            if status_code == 200:
+                self._store(key, data)
+            else:
+                with self._lock:
+                    self.refresh_errors += 1
+        except Exception as e:
+            logger.warning("Error refreshing weather cache entry %s: %s", key, e)
+            with self._lock:
+                self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+    
+    def _store(self, key, data):
+        with self._lock:
+            self._entries[key] = (data, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self):
+        """Returns the cache counters as a dict"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "refresh_errors": self.refresh_errors
+            }
+
+weather_cache = WeatherCache(WEATHER_CACHE_TTLS, WEATHER_CACHE_STALE_TTL, WEATHER_CACHE_MAX_ENTRIES)
+
+# Initializing the app
+app = Flask(__name__)
+
+# Fingerprinted, precompressed assets written by build_assets.py
+ASSET_DIR = os.getenv("ASSET_DIR") or os.path.join(app.static_folder, "dist")
+# Built file names change with their content, so browsers may keep them for a year
+ASSET_MAX_AGE = int(os.getenv("ASSET_MAX_AGE", "31536000"))
+# Precompressed variants, in order of preference
+ASSET_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+mimetypes.add_type("image/webp", ".webp")
+
+# Dynamic JSON and HTML bodies of at least COMPRESS_MIN_SIZE bytes are compressed on the fly
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_MIMETYPES = {"application/json", "text/html"}
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+def load_asset_manifest(asset_dir):
+    """
+    Reads the manifest written by build_assets.py.
+    
+    Args:
+        asset_dir (str): Folder holding the built assets and manifest.json
+        
+    Returns:
+        dict: Source file names (relative to static/) mapped to built names,
+              or an empty dict when no build exists. Sources changed since
+              the build are left out so they're served unbuilt.
+    """
+    manifest_path = os.path.join(asset_dir, "manifest.json")
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        logger.info("No asset build found, serving unbuilt static files", extra={"path": manifest_path})
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read asset manifest, serving unbuilt static files: %s", e)
+        return {}
+    
+    # Sources edited since the last build would otherwise be hidden behind their old fingerprints
+    built_at = os.path.getmtime(manifest_path)
+    stale = {name for name in manifest
+             if os.path.exists(os.path.join(app.static_folder, name))
+             and os.path.getmtime(os.path.join(app.static_folder, name)) > built_at}
+    # The built stylesheet points at the built icons, so a changed icon makes it stale too
+    if any(os.path.splitext(name)[1] not in (".css", ".js") for name in stale):
+        stale.add("styles.css")
+    if stale:
+        logger.warning("Static assets changed since the last build, serving them unbuilt; run build_assets.py",
+                       extra={"assets": sorted(stale)})
+    return {name: built for name, built in manifest.items() if name not in stale}
+
+asset_manifest = load_asset_manifest(ASSET_DIR)
+built_assets = set(asset_manifest.values())
+
+@app.template_global()
+def asset_url(filename):
+    """Returns the URL of a static file, using its fingerprinted build when there is one"""
+    if filename in asset_manifest:
+        return url_for("built_asset", filename=asset_manifest[filename])
+    return url_for("static", filename=filename)
+
+@app.route('/assets/<path:filename>', methods=["GET"])
+def built_asset(filename):
+    """Serves a built asset with immutable caching, precompressed when the client accepts it"""
+    if filename not in built_assets:
+        abort(404)
+    
+    path = os.path.join(ASSET_DIR, filename)
+    encoding = None
+    for name, suffix in ASSET_ENCODINGS:
+        if request.accept_encodings[name] and os.path.isfile(path + suffix):
+            encoding, path = name, path + suffix
+            break
+    
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], max_age=ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
+@app.route('/', methods=["GET"])
+def home_page():
+    return render_template('index.html')
+
+def weather_cache_key(request_type, location=None, lat=None, lon=None):
+    """
+    Builds the weather cache key for a location or a pair of coordinates.
+    
+    Location names are lower-cased with whitespace collapsed, and coordinates
+    are rounded to 2 decimals (~1 km) so nearby lookups share an entry.
+    """
+    if location:
+        return (request_type, "q:" + " ".join(location.lower().split()))
+    return (request_type, f"coord:{round(float(lat), 2)},{round(float(lon), 2)}")
+
+def fetch_openweather(request_type, location=None, lat=None, lon=None):
+    """
+    Fetches current weather or forecast data from OpenWeather through the shared cache.
+    
+    Args:
+        request_type (str): 'current' or 'forecast'
+        location (str, optional): The location name to query
+        lat (str, optional): Latitude, used when no location is given
+        lon (str, optional): Longitude, used when no location is given
+        
+    Returns:
+        tuple: (status_code, data) where data is the decoded JSON response
+    """
+    # Build API URL based on request type
+    if request_type == 'current':
+        endpoint = f"{OPENWEATHER_BASE_URL}/weather"
+    else:
+        request_type = 'forecast'
+        endpoint = f"{OPENWEATHER_BASE_URL}/forecast"
+    
+    # Build request parameters
+    params = {
+        "appid": OPENWEATHER_API_KEY,
+        "units": "metric"  # Use metric units (Celsius)
+    }
+    
+    # Add location or coordinates to the parameters
+    if location:
+        params["q"] = location
+    else:
+        params["lat"] = lat
+        params["lon"] = lon
+    
+    def fetch():
+        # Log the query without the appid key
+        logger.info("OpenWeather request", extra={"endpoint": endpoint, "query": location or f"{lat},{lon}"})
+        with upstream_limiters["openweather"].slot():
+            try:
+                response = upstream_client.get(endpoint, params=params)
+            except requests.RequestException as e:
+                # The error text includes the request URL, appid and all
+                raise requests.RequestException(redact_secrets(str(e))) from None
+            data = response.json()
+        
+        # Daily aggregates and the revision are computed once per fetch and cached with the data
+        if response.status_code == 200:
+            if request_type == 'forecast':
+                data["summary"] = summarize_forecast(data)
+            data["revision"] = weather_revision(request_type, data)
+        return response.status_code, data
+    
+    # Concurrent misses and refreshes for the same key share one upstream call
+    cache_key = weather_cache_key(request_type, location, lat, lon)
+    return weather_cache.get_or_fetch(cache_key, lambda: single_flight.do("weather", cache_key, fetch))
+
+def weather_revision(request_type, data):
+    """
+    Returns a short validator for an OpenWeather payload, used to build ETags.
+    
+    Current conditions only change with a new observation, so their revision
+    comes from the observation time (dt) and location. Forecasts carry no
+    observation time, so their entries are hashed instead.
+    
+    Args:
+        request_type (str): 'current' or 'forecast'
+        data (dict): The decoded OpenWeather response
+        
+    Returns:
+        str: 16 hex characters that change whenever the data does
+    """
+    if request_type == 'current':
+        source = [data.get("id"), data.get("coord"), data.get("dt")]
+    else:
+        source = data.get("list")
+    return hashlib.sha1(json.dumps(source, sort_keys=True).encode()).hexdigest()[:16]
+
+def project_weather(request_type, data, fields):
+    """
+    Trims a weather payload to the requested fields.
+    
+    'slim' keeps only what the weather modal reads (updateWeatherCardsWithAPIData
+    and processForcastData in static/script.js): current conditions without
+    station metadata, and the first days of the forecast summary without the
+    3-hourly entries. 'full' returns the payload unchanged.
+    
+    Args:
+        request_type (str): 'current' or 'forecast'
+        data (dict): Weather data from fetch_openweather
+        fields (str): 'full' or 'slim'
+        
+    Returns:
+        dict: The projected payload
+    """
+    if fields != "slim" or data is None:
+        return data
+    
+    if request_type == 'current':
+        main = data.get("main", {})
+        return {
+            "name": data.get("name"),
+            "dt": data.get("dt"),
+            "main": {"temp": main.get("temp"), "humidity": main.get("humidity")},
+            "weather": [{"description": condition.get("description"), "icon": condition.get("icon")}
+                        for condition in data.get("weather", [])[:1]],
+            "wind": {"speed": data.get("wind", {}).get("speed")},
+            "revision": data.get("revision")
+        }
+    return {
+        "summary": [{field: day.get(field) for field in WEATHER_SLIM_DAY_FIELDS}
+                    for day in data.get("summary", [])[:WEATHER_SLIM_FORECAST_DAYS]],
+        "revision": data.get("revision")
+    }
+
+def conditional_json(payload, etag, last_modified=None):
+    """
+    Returns payload as JSON with validators, or an empty 304 when the client's copy is current.
+    
+    The check runs before the payload is serialized, so revalidations skip
+    the JSON encoding and compression entirely.
+    
+    Args:
+        payload (dict): The response body
+        etag (str): Validator for the payload; sent as a weak ETag
+        last_modified (datetime, optional): When the data last changed
+        
+    Returns:
+        Response: 200 with the JSON body, or 304 without one
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+    
+    response = Response(status=304) if fresh else jsonify(payload)
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # Clients may keep the data but must revalidate it before reuse
+    response.cache_control.no_cache = True
+    return response
+
+def parse_weather_query(query):
+    """
+    Normalizes one batch entry into (location, lat, lon).
+    
+    Args:
+        query (str or dict): A location name, or a dict with 'location' or 'lat' and 'lon'
+        
+    Returns:
+        tuple: (location, lat, lon) with either location or both coordinates set
+        
+    Raises:
+        ValueError: If the entry names neither a location nor valid coordinates
+    """
+    if isinstance(query, str):
+        query = {"location": query}
+    if not isinstance(query, dict):
+        raise ValueError("Each location must be a name or an object with location or lat/lon")
+    
+    location = query.get("location")
+    if isinstance(location, str) and location.strip():
+        return location.strip(), None, None
+    if query.get("lat") in (None, "") or query.get("lon") in (None, ""):
+        raise ValueError("Missing location or coordinates")
+    try:
+        lat, lon = float(query["lat"]), float(query["lon"])
+    except (TypeError, ValueError):
+        raise ValueError("Coordinates must be numbers")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("Coordinates out of range")
+    return None, str(lat), str(lon)
+
+def fetch_weather_batch(queries, types):
+    """
+    Fetches several weather types for several locations in one go.
+    
+    Identical lookups are made once. The rest run on the upstream executor,
+    at most WEATHER_BATCH_CONCURRENCY at a time, within WEATHER_FETCH_DEADLINE.
+    Lookups still running at the deadline keep going in the background and
+    land in the weather cache for the next request.
+    
+    Args:
+        queries (list): Location names or {'location'} / {'lat', 'lon'} dicts
+        types (list): Weather types to fetch ('current', 'forecast')
+        
+    Returns:
+        list: One result per query, in order, with the data for each type
+        (None if it failed) and an errors dict of type -> {status, error}
+    """
+    parsed = []
+    jobs = {}
+    for query in queries:
+        try:
+            location, lat, lon = parse_weather_query(query)
+        except ValueError as e:
+            parsed.append((query, e))
+            continue
+        keys = {}
+        for request_type in types:
+            key = weather_cache_key(request_type, location, lat, lon)
+            jobs.setdefault(key, (request_type, location, lat, lon))
+            keys[request_type] = key
+        parsed.append((location, lat, lon, keys))
+    
+    # Fan out with a bound on how many of this batch's fetches run at once
+    deadline = time.monotonic() + WEATHER_FETCH_DEADLINE
+    outcomes = {}
+    waiting = list(jobs.items())
+    running = {}
+    while waiting or running:
+        while waiting and len(running) < WEATHER_BATCH_CONCURRENCY:
+            key, args = waiting.pop(0)
+            running[upstream_executor.submit(fetch_openweather, *args)] = key
+        remaining = deadline - time.monotonic()
+        done = wait(running, timeout=remaining, return_when=FIRST_COMPLETED)[0] if remaining > 0 else ()
+        if not done:
+            break
+        for future in done:
+            key = running.pop(future)
+            try:
+                outcomes[key] = future.result()
+            except Exception as e:
+                outcomes[key] = e
+    
+    results = []
+    for entry in parsed:
+        if len(entry) == 2:
+            query, error = entry
+            results.append({"query": query, "errors": {"query": {"status": 400, "error": str(error)}}})
+            continue
+        
+        location, lat, lon, keys = entry
+        result = {"query": {"location": location} if location else {"lat": float(lat), "lon": float(lon)}, "errors": {}}
+        for request_type, key in keys.items():
+            outcome = outcomes.get(key)
+            result[request_type] = None
+            if outcome is None:
+                result["errors"][request_type] = {
+                    "status": 504,
+                    "error": f"Weather API error: no response within {WEATHER_FETCH_DEADLINE:g}s"
+                }
+            elif isinstance(outcome, UpstreamUnavailableError):
+                result["errors"][request_type] = {
+                    "status": 503,
+                    "error": str(outcome),
+                    "retry_after": max(1, int(outcome.retry_after + 0.999))
+                }
+            elif isinstance(outcome, Exception):
+                result["errors"][request_type] = {"status": 500, "error": str(outcome)}
+            elif outcome[0] != 200:
+                status_code, data = outcome
+                result["errors"][request_type] = {
+                    "status": status_code,
+                    "error": f"Weather API error: {status_code} - {data.get('message', 'Unknown error')}"
+                }
+            else:
+                result[request_type] = outcome[1]
+        results.append(result)
+    return results
 
 @app.route('/api/weather', methods=["GET"])
 def get_weather():
     """API endpoint for fetching weather data"""
     # Get request parameters
-    location = request.args.get('location')
-    lat = request.args.get('lat')
-    lon = request.args.get('lon')
-    request_type = request.args.get('type', 'current')  # 'current' or 'forecast'
+    request_type = 'current' if request.args.get('type', 'current') == 'current' else 'forecast'
+    fields = request.args.get('fields', 'full')  # 'full' or 'slim'
     
-    if not location and not (lat and lon):
-        return jsonify({"error": "Missing location or coordinates"}), 400
+    # Coordinates are parsed and range-checked before they reach the cache key
+    try:
+        location, lat, lon = parse_weather_query({
+            "location": request.args.get('location'),
+            "lat": request.args.get('lat'),
+            "lon": request.args.get('lon')
+        })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if fields not in WEATHER_FIELDS:
+        return jsonify({"error": f"fields must be one of {', '.join(WEATHER_FIELDS)}"}), 400
     
     try:
-        # Build API URL based on request type
-        if request_type == 'current':
-            endpoint = f"{OPENWEATHER_BASE_URL}/weather"
-        else:
-            endpoint = f"{OPENWEATHER_BASE_URL}/forecast"
-        
-        # Build request parameters
-        params = {
-            "appid": OPENWEATHER_API_KEY,
-            "units": "metric"  # Use metric units (Celsius)
-        }
-        
-        # Add location or coordinates to the parameters
-        if location:
-            params["q"] = location
-        else:
-            params["lat"] = lat
-            params["lon"] = lon
-        
-        # Make the request to the OpenWeather API
-        print(f"Making request to {endpoint} with params: {params}")
-        response = requests.get(endpoint, params=params)
+        # Fetch from OpenWeather (or the weather cache)
+        status_code, data = fetch_openweather(request_type, location, lat, lon)
         
         # Check for errors
-        if response.status_code != 200:
-            error_message = response.json().get('message', 'Unknown error')
-            print(f"Error from OpenWeather API: {response.status_code} - {error_message}")
+        if status_code != 200:
+            error_message = data.get('message', 'Unknown error')
+            logger.warning("Error from OpenWeather API: %s - %s", status_code, error_message)
             return jsonify({
-                "error": f"Weather API error: {response.status_code} - {error_message}",
+                "error": f"Weather API error: {status_code} - {error_message}",
                 "success": False
-            }), response.status_code
+            }), status_code
         
-        # Return the weather data
-        data = response.json()
-        return jsonify(data)
+        # Return the weather data, or 304 if the client already has this revision
+        last_modified = None
+        if request_type == 'current' and data.get("dt"):
+            last_modified = datetime.fromtimestamp(data["dt"], timezone.utc)
+        return conditional_json(
+            project_weather(request_type, data, fields),
+            f"{request_type}-{fields}-{data.get('revision')}",
+            last_modified
+        )
+    
+    except UpstreamUnavailableError as e:
+        return retry_later_response(e)
+    except Exception as e:
+        logger.exception("Error fetching weather data: %s", e)
+        return jsonify({"error": str(e), "success": False}), 500
+
+def limiter_samples(limiters, field):
+    return {(name,): getattr(limiter, field) for name, limiter in limiters.items()}
+
+metrics.callback("upstream_in_flight", "gauge", "Calls holding an upstream slot", ("upstream",),
+                 lambda: limiter_samples(upstream_limiters, "in_flight"))
+metrics.callback("upstream_queue_waiting", "gauge", "Calls waiting for an upstream slot", ("upstream",),
+                 lambda: limiter_samples(upstream_limiters, "waiting"))
+metrics.callback("upstream_rejected_total", "counter", "Calls rejected or timed out waiting for an upstream slot", ("upstream",),
+                 lambda: {(name,): limiter.rejected + limiter.timed_out for name, limiter in upstream_limiters.items()})
+metrics.callback("rate_limit_rejected_total", "counter", "Requests rejected by per-client rate limits", ("limiter",),
+                 lambda: limiter_samples(rate_limiters, "rejected"))
+metrics.callback("circuit_breaker_open", "gauge", "1 while a chat provider's circuit breaker is open", ("provider",),
+                 lambda: {(name,): int(breaker.state != "closed") for name, breaker in chat_router.breakers.items()})
+metrics.callback("cache_hits_total", "counter", "Cache hits", ("cache",), lambda: {
+    ("weather",): weather_cache.hits,
+    ("markdown",): markdown_renderer.hits,
+    ("weather_context",): weather_context_cache.hits
+})
+metrics.callback("transcription_queue_depth", "gauge", "Transcription jobs waiting for a worker", (),
+                 lambda: {(): transcription_jobs.stats()["queued"]})
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Observes latency and payload sizes per route; streams are timed until they close"""
+    start = g.get("request_start")
+    if start is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    labels = (route, request.method, str(response.status_code), g.get("metrics_bot", ""))
+    if request.content_length:
+        http_request_size_bytes.observe(request.content_length, route)
+    
+    if response.is_streamed:
+        response.call_on_close(lambda: http_request_duration_seconds.observe(time.perf_counter() - start, *labels))
+    else:
+        http_request_duration_seconds.observe(time.perf_counter() - start, *labels)
+        http_response_size_bytes.observe(response.calculate_content_length() or 0, route)
+    return response
+
+# Registered after record_request_metrics so it runs first and the metrics see the compressed size
+@app.after_request
+def compress_response(response):
+    """Compresses JSON and HTML bodies for clients that accept it, preferring brotli over gzip"""
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.is_streamed
+            or response.direct_passthrough or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    
+    response.vary.add("Accept-Encoding")
+    if brotli is not None and request.accept_encodings["br"]:
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+        response.content_encoding = "br"
+    elif request.accept_encodings["gzip"]:
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+        response.content_encoding = "gzip"
+    return response
+
+@app.route('/metrics', methods=["GET"])
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/api/weather/batch', methods=["GET", "POST"])
+def get_weather_batch():
+    """
+    API endpoint fetching weather for several locations in one request.
+    
+    Takes JSON {"locations": [...], "types": [...], "fields": "full"} where
+    each location is a name or {"lat", "lon"}, types defaults to both current
+    and forecast, and fields is 'full' or 'slim' (see project_weather).
+    GET takes the same as query parameters (location, repeatable, or lat and
+    lon; comma-separated types; fields) so browsers can cache and revalidate it.
+    Answers 200 with one result per location, each holding its data per type
+    or an error for that type, so one bad location doesn't fail the batch.
+    """
+    if request.method == "GET":
+        locations = request.args.getlist("location")
+        if request.args.get("lat") and request.args.get("lon"):
+            locations.append({"lat": request.args["lat"], "lon": request.args["lon"]})
+        types = request.args["types"].split(",") if request.args.get("types") else list(WEATHER_TYPES)
+        fields = request.args.get("fields", "full")
+    else:
+        body = request.get_json(silent=True) or {}
+        locations = body.get("locations")
+        types = body.get("types") or list(WEATHER_TYPES)
+        fields = body.get("fields", "full")
     
+    if not isinstance(locations, list) or not locations:
+        return jsonify({"error": "locations must be a non-empty list", "success": False}), 400
+    if len(locations) > WEATHER_BATCH_MAX_LOCATIONS:
+        return jsonify({
+            "error": f"At most {WEATHER_BATCH_MAX_LOCATIONS} locations per batch",
+            "success": False
+        }), 400
+    if not isinstance(types, list) or any(request_type not in WEATHER_TYPES for request_type in types):
+        return jsonify({"error": f"types must be a list of {', '.join(WEATHER_TYPES)}", "success": False}), 400
+    if fields not in WEATHER_FIELDS:
+        return jsonify({"error": f"fields must be one of {', '.join(WEATHER_FIELDS)}", "success": False}), 400
+    
+    types = list(dict.fromkeys(types))
+    try:
+        results = fetch_weather_batch(locations, types)
     except Exception as e:
-        print(f"Error fetching weather data: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error fetching weather batch: %s", e)
         return jsonify({"error": str(e), "success": False}), 500
+    
+    for result in results:
+        for request_type in types:
+            if request_type in result:
+                result[request_type] = project_weather(request_type, result[request_type], fields)
+    payload = {"results": results, "success": True}
+    
+    # Fully successful batches get an ETag from the revisions they contain
+    if any(result["errors"] for result in results):
+        return jsonify(payload)
+    revisions = [[result["query"], [result[request_type]["revision"] for request_type in types]] for result in results]
+    etag = hashlib.sha1(json.dumps([fields, types, revisions]).encode()).hexdigest()[:16]
+    return conditional_json(payload, etag)
+
+@app.route('/api/stats', methods=["GET"])
+def get_stats():
+    """API endpoint exposing cache and performance counters"""
+    return jsonify({
+        "weather_cache": weather_cache.stats(),
+        "upstream": upstream_client.stats(),
+        "transcription_queue": transcription_jobs.stats(),
+        "response_cache": response_cache.stats() if response_cache else None,
+        "single_flight": single_flight.stats(),
+        "image_store": image_store.stats(),
+        "weather_context": weather_context_cache.stats(),
+        "markdown": markdown_renderer.stats(),
+        "chat_routing": chat_router.stats(),
+        "admission": {
+            "rate_limits": {name: limiter.stats() for name, limiter in rate_limiters.items()},
+            "upstreams": {name: limiter.stats() for name, limiter in upstream_limiters.items()},
+            "queue_wait": admission_wait.stats()
+        },
+        "chat_sessions": chat_sessions.stats() if chat_sessions is not None else None,
+        "chat_stream": {
+            "time_to_first_token": chat_ttft.stats(),
+            "total": chat_stream_duration.stats()
+        }
+    })
+
+def client_key():
+    """Identifies the client for rate limiting: its IP, or the first X-Forwarded-For hop behind a trusted proxy"""
+    if RATE_LIMIT_TRUST_FORWARDED and request.headers.get("X-Forwarded-For"):
+        return request.headers["X-Forwarded-For"].split(",")[0].strip()
+    return request.remote_addr or "unknown"
+
+def rate_limit_response(name):
+    """
+    Takes a request from the client's bucket on the named rate limiter.
+    
+    Returns:
+        tuple or None: A 429 response with Retry-After if the client is over the limit, else None
+    """
+    retry_after = rate_limiters[name].acquire(client_key())
+    if not retry_after:
+        return None
+    retry_after = max(1, int(retry_after + 0.999))
+    return jsonify({
+        "error": "Too many requests, please slow down",
+        "retry_after": retry_after
+    }), 429, {"Retry-After": str(retry_after)}
 
 def get_image_data_url(image_data, image_format):
     """
     Converts image binary data to a data URL string.
     
     Args:
-        image_data (bytes): The binary audio data
+        image_data (bytes): The binary image data
         image_format (str): The format of the image file (jpg, png, etc)
         
     Returns:
@@ -130,6 +2651,243 @@ def get_image_data_url(image_data, image_format):
     encoded_image = base64.b64encode(image_data).decode("utf-8")
     return f"data:image/{image_format};base64,{encoded_image}"
 
+def prepare_chat_image(image_bytes, image_format):
+    """
+    Downscales an uploaded chat image so upstream payloads stay small.
+    
+    Images whose longest side exceeds CHAT_IMAGE_MAX_DIMENSION are resized
+    and re-encoded (JPEG, or PNG when the image has transparency). Smaller
+    images, or anything Pillow can't open, are passed through unchanged.
+    
+    Args:
+        image_bytes (bytes): The raw image bytes
+        image_format (str): The format reported by the client (jpeg, png, etc)
+        
+    Returns:
+        dict: Decoded image with 'data' (bytes) and 'format' keys
+    """
+    image = {"data": image_bytes, "format": (image_format or "jpeg").lower().replace("jpg", "jpeg")}
+    if CHAT_IMAGE_MAX_DIMENSION <= 0:
+        return image
+    
+    try:
+        from PIL import Image
+    except ImportError:
+        return image
+    
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            if max(img.size) <= CHAT_IMAGE_MAX_DIMENSION:
+                return image
+            
+            img.thumbnail((CHAT_IMAGE_MAX_DIMENSION, CHAT_IMAGE_MAX_DIMENSION))
+            output = io.BytesIO()
+            if img.mode in ("RGBA", "LA", "P"):
+                img.save(output, format="PNG", optimize=True)
+                image_format = "png"
+            else:
+                img.convert("RGB").save(output, format="JPEG", quality=CHAT_IMAGE_JPEG_QUALITY, optimize=True)
+                image_format = "jpeg"
+    except Exception as e:
+        logger.warning("Could not downscale image, sending original: %s", e)
+        return image
+    
+    logger.debug("Downscaled chat image", extra={"bytes_in": len(image_bytes), "bytes_out": output.tell()})
+    return {"data": output.getvalue(), "format": image_format}
+
+def load_chat_image(image_bytes, image_format):
+    """
+    Returns the stored image for uploaded bytes, preparing and storing it on first sight.
+    
+    Args:
+        image_bytes (bytes): The raw uploaded image
+        image_format (str): The format reported by the client
+        
+    Returns:
+        dict: Stored image with 'data', 'format' and 'hash' keys
+    """
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    image = image_store.get(image_hash)
+    if image is None:
+        image = image_store.put(image_hash, prepare_chat_image(image_bytes, image_format))
+    return image
+
+def lookup_chat_image(image_hash):
+    """Returns a previously uploaded image by hash, or raises UnknownImageError"""
+    image = image_store.get(image_hash.lower())
+    if image is None:
+        raise UnknownImageError(f"Unknown image {image_hash}, please upload it again")
+    return image
+
+def parse_chat_request():
+    """
+    Reads a chat request sent either as JSON or as multipart/form-data.
+    
+    Multipart requests carry the image as a binary 'image' file part, which
+    avoids base64 inflation. JSON requests may still send a base64 data URL
+    under image.data, which is decoded once here. Either form may instead
+    send 'image_hash' to reuse an image uploaded on an earlier turn.
+    
+    Returns:
+        tuple: (user_input, image_data, bot_name, stream, session_id) where
+        image_data is a dict with 'data' (bytes), 'format' and 'hash' keys,
+        or None
+        
+    Raises:
+        UnknownImageError: If image_hash refers to an image that isn't stored
+        InvalidImageError: If a JSON image payload is malformed or not valid base64
+    """
+    image_data = None
+    
+    if request.mimetype == "multipart/form-data":
+        form = request.form
+        user_input = form.get('message', '')
+        bot_name = form.get('bot', 'Articuno.AI')
+        stream = form.get('stream', '').lower() in ('1', 'true', 'yes')
+        session_id = form.get('session_id')
+        
+        upload = request.files.get('image')
+        if upload:
+            image_format = form.get('image_format') or (upload.mimetype or "image/jpeg").split("/")[-1]
+            image_data = load_chat_image(upload.read(), image_format)
+        elif form.get('image_hash'):
+            image_data = lookup_chat_image(form['image_hash'])
+    else:
+        data = request.json
+        user_input = data.get('message', '')
+        bot_name = data.get('bot', 'Articuno.AI')
+        stream = bool(data.get('stream'))
+        session_id = data.get('session_id')
+        
+        image_payload = data.get('image', None)
+        if image_payload:
+            if not isinstance(image_payload, dict) or not isinstance(image_payload.get("data"), str):
+                raise InvalidImageError("image must be an object with a base64 'data' string")
+            image_format = image_payload.get("format") or "jpeg"
+            if not isinstance(image_format, str):
+                raise InvalidImageError("image.format must be a string")
+            data_url = image_payload["data"]
+            try:
+                image_bytes = base64.b64decode(data_url[data_url.find(",") + 1:], validate=True)
+            except ValueError:
+                raise InvalidImageError("image.data is not valid base64")
+            image_data = load_chat_image(image_bytes, image_format)
+        elif data.get('image_hash'):
+            image_data = lookup_chat_image(data['image_hash'])
+    
+    return user_input, image_data, bot_name, stream, session_id
+
+def gemini_image_part(image_data):
+    """
+    Returns the Gemini content part for a chat image.
+    
+    With GEMINI_IMAGE_FILE_UPLOADS enabled the image is uploaded to the Gemini
+    File API once and later turns reuse the file handle; otherwise the bytes
+    are sent inline.
+    """
+    inline_part = {
+        "mime_type": f"image/{image_data['format']}",
+        "data": image_data["data"]
+    }
+    if not GEMINI_IMAGE_FILE_UPLOADS or "provider_files" not in image_data:
+        return inline_part
+    
+    handle = image_store.get_provider_file(image_data, "gemini")
+    if handle is not None:
+        return handle
+    
+    def upload():
+        # upload_file only takes a path, so write the bytes out for this one-time upload
+        temp_path = os.path.join(tempfile.gettempdir(), f"chat_image_{image_data['hash']}.{image_data['format']}")
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(image_data["data"])
+            return genai.upload_file(temp_path, mime_type=inline_part["mime_type"])
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    try:
+        handle = single_flight.do("gemini_file", image_data["hash"], upload)
+    except Exception as e:
+        logger.warning("Gemini file upload failed, sending image inline: %s", e)
+        return inline_part
+    
+    image_store.set_provider_file(image_data, "gemini", handle, GEMINI_FILE_TTL)
+    return handle
+
+def azure_image_url(image_data):
+    """Returns the base64 data URL for a chat image, encoding it only once per stored image"""
+    if "data_url" not in image_data:
+        # Azure only accepts inline images as base64 data URLs
+        image_store.set_data_url(image_data, get_image_data_url(image_data["data"], image_data["format"]))
+    return image_data["data_url"]
+
+def sniff_audio_format(audio_data):
+    """
+    Detects the audio container from its magic bytes.
+    
+    Args:
+        audio_data (bytes): The binary audio data
+        
+    Returns:
+        str or None: The FFmpeg demuxer name, or None to let FFmpeg probe the input
+    """
+    header = audio_data[:16]
+    if header.startswith(b"\x1a\x45\xdf\xa3"):
+        return "matroska"  # WebM / Matroska (browser MediaRecorder default)
+    if header.startswith(b"OggS"):
+        return "ogg"
+    if header.startswith(b"RIFF") and header[8:12] == b"WAVE":
+        return "wav"
+    if header[4:8] == b"ftyp":
+        return "mov"  # MP4 / M4A (Safari MediaRecorder)
+    if header.startswith(b"fLaC"):
+        return "flac"
+    if header.startswith(b"ID3") or header[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "mp3"
+    return None
+
+def decode_audio_to_pcm(audio_data):
+    """
+    Converts uploaded audio into 16 kHz mono 16-bit PCM entirely in memory.
+    
+    Mono 16-bit WAV input is used as-is. Everything else goes through a
+    single FFmpeg process reading from stdin and writing raw PCM to stdout.
+    
+    Args:
+        audio_data (bytes): The binary audio data
+        
+    Returns:
+        sr.AudioData: Audio ready for the speech recognizer
+    """
+    audio_format = sniff_audio_format(audio_data)
+    
+    if audio_format == "wav":
+        try:
+            with wave.open(io.BytesIO(audio_data), "rb") as wav_file:
+                if wav_file.getnchannels() == 1 and wav_file.getsampwidth() == 2:
+                    frames = wav_file.readframes(wav_file.getnframes())
+                    return sr.AudioData(frames, wav_file.getframerate(), 2)
+        except (wave.Error, EOFError):
+            pass  # Unusual WAV encodings are left to FFmpeg
+    
+    command = [find_ffmpeg(), "-hide_banner", "-loglevel", "error"]
+    if audio_format:
+        command += ["-f", audio_format]
+    command += [
+        "-i", "pipe:0",
+        "-ar", str(AUDIO_SAMPLE_RATE), "-ac", "1",
+        "-f", "s16le", "pipe:1"
+    ]
+    
+    result = subprocess.run(command, input=audio_data, capture_output=True, timeout=AUDIO_TRANSCODE_TIMEOUT)
+    if result.returncode != 0 or not result.stdout:
+        error_output = result.stderr.decode("utf-8", errors="replace").strip()
+        raise Exception(f"Failed to convert audio file ({audio_format or 'unknown format'}): {error_output}")
+    
+    return sr.AudioData(result.stdout, AUDIO_SAMPLE_RATE, 2)
+
 def transcribe_audio(audio_data):
     """
     Transcribes audio data to text using SpeechRecognition.
@@ -139,116 +2897,52 @@ def transcribe_audio(audio_data):
         
     Returns:
         str: The transcribed text
+        
+    Raises:
+        UpstreamUnavailableError: If the speech service is at capacity
     """
     recognizer = sr.Recognizer()
     
-    # Generate temporary filenames with random UUID to avoid conflicts
-    temp_input_filename = os.path.join(tempfile.gettempdir(), f"audio_input_{uuid.uuid4().hex}.webm")
-    temp_wav_filename = os.path.join(tempfile.gettempdir(), f"audio_converted_{uuid.uuid4().hex}.wav")
-    
     try:
-        # Write the input audio data to a temporary file
-        with open(temp_input_filename, 'wb') as f:
-            f.write(audio_data)
-        
-        print(f"Audio file saved to: {temp_input_filename}")
-        print(f"Audio file size: {os.path.getsize(temp_input_filename)} bytes")
+        # Decode straight to PCM without touching the disk
+        with audio_decode_seconds.time():
+            audio = decode_audio_to_pcm(audio_data)
+        logger.debug("Decoded audio", extra={"bytes_in": len(audio_data), "pcm_bytes": len(audio.frame_data)})
         
-        # Try multiple approaches to convert the audio
-        try:
-            print("Attempting to convert audio with pydub...")
-            
-            # Tell pydub where to find FFmpeg explicitly if not set yet
-            if not hasattr(AudioSegment, 'converter') or not AudioSegment.converter:
-                # Try to locate ffmpeg in system PATH
-                import subprocess
-                try:
-                    ffmpeg_path = subprocess.check_output(['where', 'ffmpeg'], text=True).strip().split('\n')[0]
-                    AudioSegment.converter = ffmpeg_path
-                    print(f"Found ffmpeg at: {ffmpeg_path}")
-                except Exception as e:
-                    print(f"Could not find ffmpeg in PATH: {str(e)}")
-            
-            # Try to read as WebM (most common browser recording format)
-            audio = AudioSegment.from_file(temp_input_filename, format="webm")
-            print("Successfully read as WebM")
-        except Exception as webm_error:
-            print(f"Error reading as WebM: {str(webm_error)}")
-            try:
-                # Try to read as Ogg
-                audio = AudioSegment.from_file(temp_input_filename, format="ogg")
-                print("Successfully read as Ogg")
-            except Exception as ogg_error:
-                print(f"Error reading as Ogg: {str(ogg_error)}")
-                try:
-                    # Try to read as WAV
-                    audio = AudioSegment.from_wav(temp_input_filename)
-                    print("Successfully read as WAV")
-                except Exception as wav_error:
-                    print(f"Error reading as WAV: {str(wav_error)}")
-                    # Try as a generic file and let pydub detect format
-                    try:
-                        audio = AudioSegment.from_file(temp_input_filename)
-                        print("Successfully read as generic file")
-                    except Exception as generic_error:
-                        # As a last resort, try direct conversion with ffmpeg
-                        print(f"Error reading as generic file: {str(generic_error)}")
-                        print("Attempting direct conversion with ffmpeg subprocess...")
-                        import subprocess
-                        try:
-                            subprocess.run([
-                                'ffmpeg', '-y',
-                                '-i', temp_input_filename,
-                                '-ar', '16000', '-ac', '1',
-                                temp_wav_filename
-                            ], check=True)
-                            print("Successfully converted with ffmpeg subprocess")
-                        except Exception as ffmpeg_error:
-                            print(f"Error with ffmpeg subprocess: {str(ffmpeg_error)}")
-                            raise Exception(f"Failed to convert audio file: {str(generic_error)}")
-        
-        # Export to WAV if we didn't already use the subprocess approach
-        if 'audio' in locals():
-            print("Exporting to WAV format...")
-            audio.export(temp_wav_filename, format="wav")
-            print(f"Exported to {temp_wav_filename}")
-        
-        print(f"Converted WAV file size: {os.path.getsize(temp_wav_filename)} bytes")
-        
-        # Use the converted WAV file for recognition
-        with sr.AudioFile(temp_wav_filename) as source:
-            print("Loading audio into recognizer...")
-            audio_data = recognizer.record(source)
-            
-            # Use Google's speech recognition service
-            print("Sending to Google speech recognition...")
-            text = recognizer.recognize_google(audio_data)
-            print(f"Transcription result: {text}")
-            return text
+        # Use Google's speech recognition service
+        with upstream_limiters["speech"].slot():
+            text = recognizer.recognize_google(audio)
+        logger.debug("Transcription result", extra={"chars": len(text)})
+        return text
+    except UpstreamUnavailableError:
+        # Fail the job so the client gets a 503 with Retry-After, not the message as a transcription
+        raise
     except sr.UnknownValueError:
-        print("Speech Recognition could not understand the audio")
+        logger.info("Speech Recognition could not understand the audio")
         return "Speech Recognition could not understand the audio"
     except sr.RequestError as e:
-        print(f"Could not request results from Speech Recognition service: {str(e)}")
+        logger.warning("Could not request results from Speech Recognition service: %s", e)
         return f"Could not request results from Speech Recognition service: {str(e)}"
     except Exception as e:
-        print(f"Error processing audio: {str(e)}")
+        logger.exception("Error processing audio: %s", e)
         return f"Error processing audio: {str(e)}"
-    finally:
-        # Clean up the temporary files
-        try:
-            if os.path.exists(temp_input_filename):
-                os.remove(temp_input_filename)
-                print(f"Removed temporary input file: {temp_input_filename}")
-            if os.path.exists(temp_wav_filename):
-                os.remove(temp_wav_filename)
-                print(f"Removed temporary WAV file: {temp_wav_filename}")
-        except Exception as e:
-            print(f"Error cleaning up temporary files: {str(e)}")
 
 @app.route('/api/transcribe', methods=["POST"])
 def transcribe():
-    """API endpoint for handling audio transcription"""
+    """
+    API endpoint for handling audio transcription.
+    
+    The audio is queued on the transcription worker pool. By default the
+    request waits up to TRANSCRIBE_WAIT_TIMEOUT seconds for the result;
+    with wait=false (or if the wait runs out) it answers 202 with a job id
+    to poll at /api/transcribe/<job_id>. A full queue or a speech service
+    at capacity answers 503 with Retry-After, and a client over its rate
+    limit 429.
+    """
+    limited = rate_limit_response("transcribe")
+    if limited:
+        return limited
+    
     try:
         # Get audio data from request
         if 'audio' not in request.files:
@@ -260,38 +2954,252 @@ def transcribe():
         if len(audio_data) == 0:
             return jsonify({"error": "Empty audio file"}), 400
         
-        # Process the audio data
-        transcribed_text = transcribe_audio(audio_data)
+        # Queue the audio for processing
+        job_id = transcription_jobs.submit(transcribe_audio, audio_data)
+        if job_id is None:
+            retry_after = transcription_jobs.retry_after()
+            return jsonify({
+                "error": "Transcription queue is full, please try again shortly",
+                "retry_after": retry_after
+            }), 503, {"Retry-After": str(retry_after)}
+        
+        wait = request.values.get('wait', 'true').lower() not in ('false', '0', 'no')
+        if wait:
+            job = transcription_jobs.wait(job_id, TRANSCRIBE_WAIT_TIMEOUT)
+        else:
+            job = transcription_jobs.get(job_id)
         
-        return jsonify({"transcription": transcribed_text})
+        return transcription_job_response(job)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/transcribe/<job_id>', methods=["GET"])
+def transcribe_status(job_id):
+    """API endpoint for polling a queued transcription job"""
+    job = transcription_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired transcription job"}), 404
+    return transcription_job_response(job)
+
+def transcription_job_response(job):
+    """Turns a transcription job view into the API response"""
+    if job["status"] == "done":
+        job["transcription"] = job.pop("result")
+        return jsonify(job)
+    if job["status"] == "failed":
+        if "retry_after" in job:
+            return jsonify(job), 503, {"Retry-After": str(job["retry_after"])}
+        return jsonify(job), 500
+    
+    # Still queued or running - tell the client where to poll
+    job["status_url"] = f"/api/transcribe/{job['job_id']}"
+    return jsonify(job), 202
+
 @app.route('/api/chat', methods=["POST"])
 def chat():
-    # Get JSON data from the request
-    data = request.json
-    user_input = data.get('message', '')
-    image_data = data.get('image', None)
-    bot_name = data.get('bot', 'Articuno.AI')
+    # Reject clients over their rate limit before reading the body
+    limited = rate_limit_response("chat")
+    if limited:
+        return limited
+    
+    # Get the message, bot and (optional) image from the JSON or multipart request
+    try:
+        user_input, image_data, bot_name, stream, session_id = parse_chat_request()
+        # Label metrics with the registry key, never the raw client string
+        g.metrics_bot = resolve_bot(bot_name)
+    except UnknownImageError as e:
+        return jsonify({"error": str(e), "image_missing": True}), 404
+    except InvalidImageError as e:
+        return jsonify({"error": str(e)}), 400
     
     if not user_input and not image_data:
         return jsonify({"error": "No message or image provided"}), 400
     
+    # Requests with a session id carry the conversation so far
+    try:
+        session = open_chat_session(session_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Clients can opt into Server-Sent Events with a stream flag
+    if stream:
+        return stream_chat_response(user_input, image_data, bot_name, session)
+    
     try:
         # Check which bot is selected and use appropriate API
-        if bot_name == "Articuno.AI":
+        bot = resolve_bot(bot_name)
+        if bot == "articuno":
             # Use Gemini with special weather-focused system prompt
-            return process_articuno_weather_request(user_input, image_data)
-        elif bot_name == "Gemini 2.0 Flash" or bot_name.lower() == "gemini":
-            return process_gemini_request(user_input, image_data)
+            return process_articuno_weather_request(user_input, image_data, session)
+        elif bot == "gemini":
+            return process_gemini_request(user_input, image_data, session)
         else:
             # Use Azure OpenAI API as fallback
-            return process_azure_openai_request(user_input, image_data)
+            return process_azure_openai_request(user_input, image_data, session)
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/sessions/<session_id>', methods=["GET", "DELETE"])
+def chat_session(session_id):
+    """
+    API endpoint to inspect or reset a chat session.
+    
+    GET returns the session's context size and per-turn prompt/latency
+    stats; DELETE forgets the session.
+    """
+    if chat_sessions is None:
+        return jsonify({"error": "Chat sessions are disabled"}), 404
+    
+    if request.method == "DELETE":
+        chat_sessions.delete(session_id)
+        return "", 204
+    
+    session = chat_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown session"}), 404
+    
+    stats = session["stats"]
+    turns = stats["turns"] or 1
+    return jsonify({
+        "session_id": session_id,
+        "history_turns": len(session["history"]),
+        "history_tokens": sum(turn["tokens"] for turn in session["history"]),
+        "summary_lines": len(session["summary"]),
+        "summary_tokens": estimate_tokens("\n".join(session["summary"])),
+        "token_budget": chat_sessions.token_budget,
+        "stats": dict(
+            stats,
+            prompt_tokens_avg=round(stats["prompt_tokens_total"] / turns, 1),
+            latency_ms_avg=round(stats["latency_ms_total"] / turns, 1)
+        )
+    })
+
+# Location query patterns, tried in order. Free-text spans are bounded so long
+# messages can't trigger heavy backtracking.
+LOCATION_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r"weather\s+(?:in|at|for)\s+([A-Za-z\s,]+)",  # "weather in London"
+    r"(?:in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "in Paris weather"
+    r"^([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "Tokyo weather"
+    r"^([A-Za-z\s,]+?)$",  # Just the location name
+    r"weather (?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "weather of Tokyo"
+    r"weather(?:.{1,80}?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "weather report of London"
+    r"(?:show|get|tell|give)(?:.{1,80}?)weather(?:.{1,80}?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "give me weather of London"
+    r"(?:show|get|tell|give)(?:.{1,80}?)(?:of|for|in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "give me of London weather"
+    r"(?:how is|what is|what's)(?:.{1,80}?)weather(?:.{1,80}?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "how is the weather in London"
+    r"(?:how's|what's)(?:.{1,80}?)(?:of|for|in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "what's in London weather like"
+    r"(?:temperature|forecast|climate|humidity|wind|conditions)(?:.{1,80}?)(?:in|at|for)\s+([A-Za-z\s,]+)",  # "temperature in Berlin"
+    r"(?:will it rain|is it sunny|is it hot|is it cold)(?:.{1,80}?)(?:in|at)\s+([A-Za-z\s,]+)",  # "will it rain in Seattle"
+    r"what's the (?:weather|temperature|forecast)(?:.{1,80}?)(?:in|at|for)\s+([A-Za-z\s,]+)"  # "what's the forecast for Chicago"
+]]
+
+# Words that start with a capital letter but are never locations
+LOCATION_STOPWORDS = frozenset([
+    "what", "where", "when", "why", "how", "can", "could", "would",
+    "should", "will", "shall", "the", "this", "that", "these", "those",
+    "give", "show", "tell", "about", "weather", "forecast", "temperature",
+    "conditions", "articuno", "hello", "thanks", "thank", "please", "good",
+    "morning", "afternoon", "evening", "night", "today", "tomorrow", "yesterday"
+])
+
+TRAILING_PUNCTUATION_RE = re.compile(r'[.,;:!?]+$')
+
+# Splits text into gazetteer words with str.translate + split (much faster than a
+# regex). Punctuation becomes whitespace, except commas, which stay as their own
+# token so a "City, Region" qualifier can be recognized.
+GAZETTEER_TOKEN_TABLE = str.maketrans(
+    {char: " " for char in "!\"#$%&()*+-./:;<=>?@[\\]^_`{|}~0123456789"} | {",": " , "}
+)
+
+def tokenize_for_gazetteer(text):
+    return text.translate(GAZETTEER_TOKEN_TABLE).split()
+
+def load_location_gazetteer(path):
+    """
+    Loads known place names into a word-level trie.
+    
+    Each node is a dict keyed by lower-cased word; the None key marks the end
+    of a name and holds (canonical spelling, words to match case-sensitively
+    or None). Scanning a message against the trie is linear in the number of
+    words it contains.
+    
+    Args:
+        path (str): Text file with one place name per line ('#' starts a comment,
+            a trailing ' *' marks a name that must be capitalized as written)
+        
+    Returns:
+        dict: The root node of the trie (empty if the file is missing)
+    """
+    trie = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                name = line.strip()
+                if not name or name.startswith("#"):
+                    continue
+                cased = name.endswith(" *")
+                if cased:
+                    name = name[:-2].rstrip()
+                node = trie
+                for word in tokenize_for_gazetteer(name.lower()):
+                    node = node.setdefault(word, {})
+                node[None] = (name, tokenize_for_gazetteer(name) if cased else None)
+    except OSError as e:
+        logger.warning("Location gazetteer not loaded: %s", e)
+    return trie
+
+LOCATION_GAZETTEER = load_location_gazetteer(os.getenv(
+    "LOCATION_GAZETTEER_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.txt")
+))
+
+def find_known_location(message):
+    """
+    Finds the first known place name in a message using the gazetteer trie.
+    
+    Longer names win over their prefixes ("New York City" over "New York").
+    A capitalized qualifier after a comma is kept ("Paris, Texas"). Names
+    that are also ordinary words or person names only match when they are
+    capitalized as in the gazetteer.
+    
+    Args:
+        message (str): The user message to scan
+        
+    Returns:
+        str or None: The matched place name or None
+    """
+    # One pass over the original text; case is folded per word while scanning
+    words = tokenize_for_gazetteer(message)
+    for start, word in enumerate(words):
+        node = LOCATION_GAZETTEER.get(word.lower())
+        if node is None:
+            continue
+        
+        # Follow the trie as far as the message allows, remembering the longest name
+        match_end = name = None
+        index = start
+        while True:
+            entry = node.get(None)
+            if entry is not None and (entry[1] is None or words[start:index + 1] == entry[1]):
+                match_end, name = index, entry[0]
+            index += 1
+            if index == len(words):
+                break
+            node = node.get(words[index].lower())
+            if node is None:
+                break
+        
+        if name is None:
+            continue
+        
+        # Keep a state/country qualifier such as "Paris, Texas" or "Portland, OR"
+        if match_end + 2 < len(words) and words[match_end + 1] == ",":
+            qualifier = words[match_end + 2]
+            if qualifier[0].isupper():
+                return f"{name}, {qualifier}"
+        return name
+    return None
+
 def detect_location_from_message(message):
     """
     Extracts location information from a user message.
@@ -302,45 +3210,37 @@ def detect_location_from_message(message):
     Returns:
         str or None: Detected location name or None if no location found
     """
-    # Enhanced location detection - look for common location query patterns
-    location_patterns = [
-        r"weather\s+(?:in|at|for)\s+([A-Za-z\s,]+)",  # "weather in London"
-        r"(?:in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "in Paris weather"
-        r"^([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "Tokyo weather"
-        r"^([A-Za-z\s,]+?)$",  # Just the location name
-        r"weather (?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "weather of Tokyo"
-        r"weather(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "weather report of London"
-        r"(?:show|get|tell|give)(?:.+?)weather(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "give me weather of London"
-        r"(?:show|get|tell|give)(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "give me of London weather"
-        r"(?:how is|what is|what's)(?:.+?)weather(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",  # "how is the weather in London"
-        r"(?:how's|what's)(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",  # "what's in London weather like"
-        r"(?:temperature|forecast|climate|humidity|wind|conditions)(?:.+?)(?:in|at|for)\s+([A-Za-z\s,]+)",  # "temperature in Berlin"
-        r"(?:will it rain|is it sunny|is it hot|is it cold)(?:.+?)(?:in|at)\s+([A-Za-z\s,]+)",  # "will it rain in Seattle"
-        r"what's the (?:weather|temperature|forecast)(?:.+?)(?:in|at|for)\s+([A-Za-z\s,]+)"  # "what's the forecast for Chicago"
-    ]
-    
-    for pattern in location_patterns:
-        match = re.search(pattern, message, re.IGNORECASE)
+    # Enhanced location detection - look for common location query patterns.
+    # A known place name inside a captured span is the most reliable signal;
+    # otherwise the first span wins, as the patterns are ordered by precedence.
+    known_location = find_known_location(message)
+    first_span = None
+    for pattern in LOCATION_PATTERNS:
+        match = pattern.search(message)
         if match:
-            location = match.group(1).strip()
-            # Remove trailing punctuation if any
-            location = re.sub(r'[.,;:!?]+$', '', location)
-            return location
+            if known_location is None:
+                first_span = match.group(1)
+                break
+            location = find_known_location(match.group(1))
+            if location:
+                return location
+            if first_span is None:
+                first_span = match.group(1)
+    if first_span is not None:
+        # Remove trailing punctuation if any
+        return TRAILING_PUNCTUATION_RE.sub('', first_span.strip())
+    
+    # Messages that match no pattern may still name a known place
+    if known_location:
+        return known_location
     
     # As a fallback, try to find any city name mentioned in the query
     # This is a simple approach - in a production system, you might use NER (Named Entity Recognition)
-    words = message.split()
-    for word in words:
+    for word in message.split():
         # Clean the word of punctuation
-        clean_word = re.sub(r'[.,;:!?]+$', '', word)
+        clean_word = TRAILING_PUNCTUATION_RE.sub('', word)
         # If the word starts with a capital letter and is at least 3 characters, it might be a location
-        if len(clean_word) >= 3 and clean_word[0].isupper() and clean_word.lower() not in [
-            "what", "where", "when", "why", "how", "can", "could", "would", 
-            "should", "will", "shall", "the", "this", "that", "these", "those",
-            "give", "show", "tell", "about", "weather", "forecast", "temperature",
-            "conditions", "articuno", "hello", "thanks", "thank", "please", "good",
-            "morning", "afternoon", "evening", "night", "today", "tomorrow", "yesterday"
-        ]:
+        if len(clean_word) >= 3 and clean_word[0].isupper() and clean_word.lower() not in LOCATION_STOPWORDS:
             return clean_word
     
     return None
@@ -356,31 +3256,38 @@ def fetch_weather_data(location):
         dict: Weather data for the location or error information
     """
     try:
-        # Fetch current weather
-        current_url = f"{OPENWEATHER_BASE_URL}/weather"
-        params = {
-            "q": location,
-            "appid": OPENWEATHER_API_KEY,
-            "units": "metric"  # Use metric units (Celsius)
-        }
-        
-        response = requests.get(current_url, params=params)
-        if response.status_code != 200:
-            return {"error": f"Weather API error: {response.status_code} - {response.json().get('message', 'Unknown error')}"}
+        # Fetch current weather and forecast (5 days / 3 hours) concurrently
+        deadline = time.monotonic() + WEATHER_FETCH_DEADLINE
+        current_future = upstream_executor.submit(fetch_openweather, 'current', location)
+        forecast_future = upstream_executor.submit(fetch_openweather, 'forecast', location)
         
-        current_data = response.json()
+        try:
+            status_code, current_data = current_future.result(timeout=WEATHER_FETCH_DEADLINE)
+        except FutureTimeoutError:
+            return {"error": f"Weather API error: no response within {WEATHER_FETCH_DEADLINE:g}s"}
         
-        # Fetch forecast (5 days / 3 hours)
-        forecast_url = f"{OPENWEATHER_BASE_URL}/forecast"
-        forecast_response = requests.get(forecast_url, params=params)
+        if status_code != 200:
+            return {"error": f"Weather API error: {status_code} - {current_data.get('message', 'Unknown error')}"}
         
-        if forecast_response.status_code != 200:
+        # The forecast only gets whatever is left of the overall deadline
+        try:
+            forecast_status, forecast_data = forecast_future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
             return {
                 "current": current_data,
-                "forecast_error": f"Forecast API error: {forecast_response.status_code}"
+                "forecast_error": f"Forecast API error: no response within {WEATHER_FETCH_DEADLINE:g}s"
+            }
+        except Exception as e:
+            return {
+                "current": current_data,
+                "forecast_error": f"Forecast API error: {str(e)}"
             }
         
-        forecast_data = forecast_response.json()
+        if forecast_status != 200:
+            return {
+                "current": current_data,
+                "forecast_error": f"Forecast API error: {forecast_status}"
+            }
         
         # Return combined weather data
         return {
@@ -390,140 +3297,233 @@ def fetch_weather_data(location):
     except Exception as e:
         return {"error": f"Error fetching weather data: {str(e)}"}
 
-def format_weather_data_for_gemini(weather_data, location):
+WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+MONTH_ABBREVIATIONS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def most_frequent(values):
+    """Returns the most frequent value, preferring the earliest on ties"""
+    # A day has only a handful of distinct values, so counting each is cheaper than a Counter
+    return max(dict.fromkeys(values), key=values.count)
+
+def summarize_forecast(forecast):
     """
-    Formats weather data into a structured prompt for Gemini model.
+    Aggregates an OpenWeather 5-day/3-hour forecast into daily summaries.
+    
+    The entries are parsed once into per-field columns. Each day is then
+    aggregated with builtin sum/min/max/count over a slice of those
+    columns, so there is no per-entry Python work beyond the parse. Entries
+    are grouped by calendar day in the city's own time zone and are expected
+    in chronological order, as OpenWeather returns them. The result is used
+    for the Articuno weather prompt and by the weather modal, which reads it
+    from the /api/weather forecast response.
     
     Args:
-        weather_data (dict): Weather data from OpenWeather API
-        location (str): The location name
+        forecast (dict): OpenWeather /forecast response
         
     Returns:
-        str: Formatted weather data prompt
+        list: One dict per day, in order, with 'date' (ISO), 'day', 'date_label',
+        'temp_avg', 'temp_min', 'temp_max', 'description' and 'icon' (the most
+        frequent of each) and 'precipitation' (mean probability in percent,
+        or None)
     """
-    if "error" in weather_data:
-        return f"Error: {weather_data['error']}"
+    items = forecast.get("list") or []
+    utc_offset = (forecast.get("city") or {}).get("timezone", 0)
     
-    try:
-        current = weather_data["current"]
+    # Parse once into columns
+    day_numbers = [(item["dt"] + utc_offset) // 86400 for item in items]
+    mains = [item["main"] for item in items]
+    temps = [main["temp"] for main in mains]
+    temp_mins = [main["temp_min"] for main in mains]
+    temp_maxs = [main["temp_max"] for main in mains]
+    weathers = [item["weather"][0] for item in items]
+    descriptions = [weather["description"] for weather in weathers]
+    icons = [weather.get("icon") for weather in weathers]
+    pops = [item.get("pop") for item in items]
+    
+    # Find the [start, end) run of entries for each day
+    boundaries = [0] + [i for i in range(1, len(items)) if day_numbers[i] != day_numbers[i - 1]] + [len(items)]
+    
+    summary = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        if start == end:
+            continue
+        day = slice(start, end)
+        day_date = date.fromordinal(EPOCH_ORDINAL + day_numbers[start])
+        weekday = WEEKDAY_NAMES[day_date.weekday()]
+        day_pops = [pop for pop in pops[day] if pop is not None]
+        summary.append({
+            "date": day_date.isoformat(),
+            "day": weekday[:3],
+            "date_label": f"{weekday}, {MONTH_ABBREVIATIONS[day_date.month - 1]} {day_date.day}",
+            "temp_avg": round(sum(temps[day]) / (end - start), 2),
+            "temp_min": min(temp_mins[day]),
+            "temp_max": max(temp_maxs[day]),
+            "description": most_frequent(descriptions[day]),
+            "icon": most_frequent(icons[day]),
+            "precipitation": round(sum(day_pops) / len(day_pops) * 100, 1) if day_pops else None
+        })
+    return summary
+
+WIND_DIRECTIONS = ("N", "NE", "E", "SE", "S", "SW", "W", "NW")
+
+class WeatherContextCache:
+    """
+    Rendered Articuno weather context per resolved city.
+    
+    Entries are keyed by the OpenWeather city id and remember a fingerprint of
+    the weather snapshot they were rendered from, so the context is only
+    re-rendered after the weather cache has fetched new data for that city.
+    """
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get_or_render(self, weather_data, render):
+        """
+        Returns the rendered context for a weather snapshot, rendering it if it changed.
         
-        # Extract current weather data
-        temp = current["main"]["temp"]
-        feels_like = current["main"]["feels_like"]
-        humidity = current["main"]["humidity"]
-        weather_desc = current["weather"][0]["description"]
-        weather_main = current["weather"][0]["main"]
-        wind_speed = current["wind"]["speed"]
-        
-        # Get pressure and visibility if available
-        pressure = current["main"].get("pressure", "N/A")
-        visibility = current.get("visibility", "N/A")
-        if visibility != "N/A":
-            visibility = visibility / 1000  # Convert from meters to kilometers
-        
-        # Extract sunrise and sunset times if available
-        sunrise = sunset = "N/A"
-        if "sys" in current and "sunrise" in current["sys"] and "sunset" in current["sys"]:
-            sunrise_timestamp = current["sys"]["sunrise"]
-            sunset_timestamp = current["sys"]["sunset"]
-            from datetime import datetime
-            sunrise = datetime.fromtimestamp(sunrise_timestamp).strftime('%H:%M')
-            sunset = datetime.fromtimestamp(sunset_timestamp).strftime('%H:%M')
-        
-        # Extract location data
-        city_name = current["name"]
-        country = current["sys"]["country"]
-        
-        # Extract forecast if available
-        forecast_text = ""
-        if "forecast" in weather_data:
-            forecast = weather_data["forecast"]
-            forecast_text = "\n\nForecast for next few days:\n"
-            
-            # Group forecast by day
-            day_forecasts = {}
-            for item in forecast["list"]:
-                dt = item["dt"]
-                date = item["dt_txt"].split(" ")[0]
-                
-                if date not in day_forecasts:
-                    day_forecasts[date] = []
-                
-                day_forecasts[date].append(item)
+        Args:
+            weather_data (dict): Output of fetch_weather_data (without an error)
+            render (callable): Renders the context text from weather_data
             
-            # Generate a summary for each day
-            for date, items in list(day_forecasts.items())[:3]:  # Limit to 3 days
-                # Calculate average temp for the day
-                avg_temp = sum(item["main"]["temp"] for item in items) / len(items)
-                
-                # Calculate min and max temps
-                min_temp = min(item["main"]["temp_min"] for item in items)
-                max_temp = max(item["main"]["temp_max"] for item in items)
-                
-                # Find most common weather condition
-                conditions = [item["weather"][0]["main"] for item in items]
-                most_common_condition = max(set(conditions), key=conditions.count)
-                
-                # Get detailed description of most common condition
-                condition_desc = next((item["weather"][0]["description"] for item in items 
-                                      if item["weather"][0]["main"] == most_common_condition), most_common_condition)
-                
-                # Calculate average precipitation probability if available
-                precipitation_prob = 0
-                precipitation_count = 0
-                for item in items:
-                    if "pop" in item:
-                        precipitation_prob += item["pop"]
-                        precipitation_count += 1
-                
-                if precipitation_count > 0:
-                    avg_precipitation_prob = (precipitation_prob / precipitation_count) * 100  # Convert to percentage
-                    precipitation_text = f", {avg_precipitation_prob:.0f}% chance of precipitation"
-                else:
-                    precipitation_text = ""
-                
-                forecast_text += f"- {date}: {min_temp:.1f}°C to {max_temp:.1f}°C (avg: {avg_temp:.1f}°C), {condition_desc}{precipitation_text}\n"
-        
-        # Format the weather data as a prompt for Gemini
-        prompt = f"""Weather data for {city_name}, {country} (User asked about: {location}):
-        
-Current conditions:
-- Temperature: {temp}°C (feels like {feels_like}°C)
-- Weather: {weather_desc} ({weather_main})
-- Humidity: {humidity}%
-- Wind speed: {wind_speed} m/s
-- Air pressure: {pressure} hPa
-- Visibility: {visibility if visibility != "N/A" else "N/A"} km
-- Sunrise: {sunrise}
-- Sunset: {sunset}
-{forecast_text}
-
-Now, provide a friendly and helpful response about this weather information to the user. Be conversational and engaging. Use emojis appropriately to enhance the message. Include practical advice based on the weather conditions (what to wear, precautions to take, etc.). End with a friendly follow-up question.
-
-Remember to present the information in a well-structured way, including:
-1. A warm greeting that references the location
-2. Current weather conditions with a friendly tone
-3. Forecast information for the next few days
-4. Practical advice based on the conditions
-5. A friendly question or suggestion to keep the conversation going
-"""
-        return prompt
+        Returns:
+            str: The rendered context
+        """
+        current = weather_data["current"]
+        key = current.get("id") or (current.get("name"), current.get("sys", {}).get("country"))
+        fingerprint = weather_snapshot_fingerprint(weather_data)
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == fingerprint:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        context = render(weather_data)
+        with self._lock:
+            self._entries[key] = (fingerprint, context)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return context
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+weather_context_cache = WeatherContextCache(WEATHER_CACHE_MAX_ENTRIES)
+
+def weather_snapshot_fingerprint(weather_data):
+    """Identifies a weather snapshot by the observation and forecast times OpenWeather reports"""
+    forecast = weather_data.get("forecast") or {}
+    forecast_list = forecast.get("list") or [{}]
+    return (
+        weather_data["current"].get("dt"),
+        forecast_list[0].get("dt"),
+        len(forecast_list),
+        weather_data.get("forecast_error")
+    )
+
+def render_weather_context(weather_data):
+    """
+    Renders the compact weather context sent to Articuno.AI.
+    
+    Only the fields the system prompt's report format asks for are kept, with
+    times in the city's own time zone and wind already in km/h. How to present
+    them is left to ARTICUNO_SYSTEM_PROMPT.
+    
+    Args:
+        weather_data (dict): Output of fetch_weather_data (without an error)
+        
+    Returns:
+        str: The weather context
+    """
+    current = weather_data["current"]
+    main = current["main"]
+    utc_offset = current.get("timezone", 0)
+    
+    def local_time(timestamp, time_format):
+        return (datetime(1970, 1, 1) + timedelta(seconds=timestamp + utc_offset)).strftime(time_format)
+    
+    wind = current.get("wind", {})
+    wind_text = f"{wind.get('speed', 0) * 3.6:.0f} km/h"
+    if "deg" in wind:
+        wind_text += f" {WIND_DIRECTIONS[round(wind['deg'] / 45) % 8]}"
+    
+    now = [
+        current["weather"][0]["description"],
+        f"{main['temp']:.1f}°C (feels {main['feels_like']:.1f}°C)",
+        f"humidity {main['humidity']}%",
+        f"wind {wind_text}"
+    ]
+    sys_info = current.get("sys", {})
+    if "sunrise" in sys_info and "sunset" in sys_info:
+        now.append(f"sunrise {local_time(sys_info['sunrise'], '%H:%M')}, sunset {local_time(sys_info['sunset'], '%H:%M')}")
+    
+    lines = [
+        f"Weather for {current['name']}, {sys_info.get('country', '')} on {local_time(current.get('dt', time.time()), '%a %Y-%m-%d')}",
+        "Now: " + ", ".join(now)
+    ]
+    
+    if "forecast" in weather_data:
+        # Forecasts fetched through the weather cache already carry their summary
+        forecast = weather_data["forecast"]
+        summary = forecast.get("summary") or summarize_forecast(forecast)
+        lines.append("Forecast:")
+        for day in summary[:3]:  # Limit to 3 days
+            precipitation = f", {day['precipitation']:.0f}% precip" if day["precipitation"] is not None else ""
+            lines.append(
+                f"{day['day']} {day['date']}: {day['temp_min']:.0f} to {day['temp_max']:.0f}°C "
+                f"(avg {day['temp_avg']:.0f}), {day['description']}{precipitation}"
+            )
+    else:
+        lines.append("Forecast: unavailable")
+    
+    return "\n".join(lines)
+
+def format_weather_data_for_gemini(weather_data, location):
+    """
+    Formats weather data into a compact context for the Gemini model.
+    
+    The rendered context is cached per city and reused until the underlying
+    weather snapshot changes.
+    
+    Args:
+        weather_data (dict): Weather data from OpenWeather API
+        location (str): The location name the user asked about
+        
+    Returns:
+        str: Formatted weather context
+    """
+    if "error" in weather_data:
+        return f"Error fetching weather for {location}: {weather_data['error']}"
+    
+    try:
+        return weather_context_cache.get_or_render(weather_data, render_weather_context)
     except Exception as e:
         return f"Error formatting weather data: {str(e)}"
 
-def process_articuno_weather_request(user_input, image_data=None):
-    """Process chat request specifically for Articuno.AI as a weather assistant"""
-    try:
-        # Configure the model
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 1,
-            "top_k": 32,
-            "max_output_tokens": 1000,
-        }
-        
-        # Create weather-focused system prompt
-        weather_system_prompt = """Welcome to Articuno.AI – your friendly weather assistant! ❄️
+# Articuno.AI generation settings and weather-focused system prompt
+ARTICUNO_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 1000,
+}
+
+ARTICUNO_SYSTEM_PROMPT = """Welcome to Articuno.AI – your friendly weather assistant! ❄️
 You're here to help users explore weather updates with style, clarity, and a touch of personality 😊
 
 Your Role:
@@ -584,103 +3584,16 @@ Special Cases:
 If the user asks about weather but doesn't specify a location, politely ask them for a location.
 If the user asks about non-weather topics, gently remind them that you're a weather specialist but still try to help.
 """
-        
-        # Create the model
-        model = genai.GenerativeModel(model_name="gemini-1.5-flash", generation_config=generation_config)
-        
-        # Check if the user input contains a location
-        location = detect_location_from_message(user_input)
-        
-        # If location found, fetch weather data
-        weather_data = None
-        weather_prompt = None
-        
-        if location:
-            print(f"Detected location: {location}")
-            weather_data = fetch_weather_data(location)
-            weather_prompt = format_weather_data_for_gemini(weather_data, location)
-            print(f"Formatted weather data: {weather_prompt}")
-        
-        # Handle messages with images
-        if image_data:
-            # Process the image data
-            image_format = image_data.get("format", "jpeg")
-            image_binary = base64.b64decode(image_data.get("data").split(",")[1])
-            
-            # Create image part for multimodal request
-            image_parts = [
-                {
-                    "mime_type": f"image/{image_format}",
-                    "data": image_binary
-                }
-            ]
-            
-            # Prepare content parts with system instructions and weather data if available
-            if weather_prompt:
-                # Include weather data in the prompt
-                content_parts = [
-                    {"role": "user", "parts": [{"text": weather_system_prompt}]},
-                    {"role": "model", "parts": [{"text": "I understand. I'll be Articuno.AI, your weather assistant."}]},
-                    {"role": "user", "parts": [{"text": f"{user_input}\n\n{weather_prompt}"}, image_parts[0]]}
-                ]
-            else:
-                # No weather data, just use system prompt and user input
-                content_parts = [
-                    {"role": "user", "parts": [{"text": weather_system_prompt}]},
-                    {"role": "model", "parts": [{"text": "I understand. I'll be Articuno.AI, your weather assistant."}]},
-                    {"role": "user", "parts": [{"text": user_input}, image_parts[0]]}
-                ]
-            
-            # Generate response with both text and image
-            response = model.generate_content(content_parts)
-        else:
-            # Text-only request
-            # If we have weather data, include it in the prompt
-            if weather_prompt:
-                content_parts = [
-                    {"role": "user", "parts": [{"text": weather_system_prompt}]},
-                    {"role": "model", "parts": [{"text": "I understand. I'll be Articuno.AI, your weather assistant."}]},
-                    {"role": "user", "parts": [{"text": f"{user_input}\n\n{weather_prompt}"}]}
-                ]
-            else:
-                # No location detected or weather data available
-                if not any(term in user_input.lower() for term in ['weather', 'temperature', 'forecast', 'rain', 'sunny', 'cloudy', 'wind', 'humidity', 'climate']):
-                    enhanced_input = f"Regarding weather information: {user_input}"
-                else:
-                    enhanced_input = user_input
-                
-                content_parts = [
-                    {"role": "user", "parts": [{"text": weather_system_prompt}]},
-                    {"role": "model", "parts": [{"text": "I understand. I'll be Articuno.AI, your weather assistant."}]},
-                    {"role": "user", "parts": [{"text": enhanced_input}]}
-                ]
-            
-            response = model.generate_content(content_parts)
-        
-        # Extract response text
-        markdown_output = response.text
-        html_response = markdown.markdown(markdown_output)
-        
-        return jsonify({"response": html_response})
-    
-    except Exception as e:
-        print(f"Articuno Weather API error: {str(e)}")
-        traceback.print_exc()  # Print the full stack trace for debugging
-        return jsonify({"error": f"Error with Articuno Weather API: {str(e)}"}), 500
 
-def process_gemini_request(user_input, image_data=None):
-    """Process chat request using Google Gemini API"""
-    try:
-        # Configure the model
-        generation_config = {
-            "temperature": 0.9,
-            "top_p": 1,
-            "top_k": 32,
-            "max_output_tokens": 1000,
-        }
-        
-        # Create system prompt
-        system_prompt = """You are Articuno.AI, a friendly virtual assistant thoughtfully developed by the Edubyte Team to provide 
+# General Gemini generation settings and system prompt
+GEMINI_GENERATION_CONFIG = {
+    "temperature": 0.9,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 1000,
+}
+
+GEMINI_SYSTEM_PROMPT = """You are Articuno.AI, a friendly virtual assistant thoughtfully developed by the Edubyte Team to provide 
         intelligent, user-friendly, and context-aware support. As a helpful assistant, your primary goal is 
         to deliver accurate, concise, and engaging responses.
 
@@ -700,149 +3613,702 @@ def process_gemini_request(user_input, image_data=None):
         - Be concise, yet ensure clarity and completeness.
         - Adapt your communication style based on the user's intent and tone.
         """
+
+# Azure OpenAI system message and sampling settings
+AZURE_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": (
+        "You are Eubyte, a friendly virtual assistant thoughtfully developed by the Edubyte Team to provide "
+        "intelligent, user-friendly, and context-aware support. As a helpful assistant, your primary goal is "
+        "to deliver accurate, concise, and engaging responses.\n\n"
+
+        "🧠 Identity\n"
+        "Name: Eubyte\n"
+        "Developed by: Edubyte Team\n"
+        "Role: Friendly, fast, intelligent and supportive virtual assistant\n\n"
+
+        "📝 Response Structure\n"
+        "- Use clear headings (H1, H2, etc.) to organize information logically.\n"
+        "- Present details using bullet points or numbered lists where appropriate for readability.\n"
+        "- Include spaces after headings and between paragraphs for improved visual clarity.\n"
+        "- Integrate appropriate emojis (e.g., ✅📌🚀) to enhance interactivity and user engagement, without overwhelming the message.\n\n"
+
+        "🌟 Tone and Style\n"
+        "- Maintain a professional yet friendly tone.\n"
+        "- Be concise, yet ensure clarity and completeness.\n"
+        "- Adapt your communication style based on the user's intent and tone."
+    )
+}
+
+AZURE_PAYLOAD_SETTINGS = {
+    "temperature": 1.0,
+    "top_p": 1.0,
+    "max_tokens": 1000
+}
+
+def build_bot_registry():
+    """
+    Builds the per-bot model settings and static prompt parts once at startup.
+    
+    Per-request work is then limited to adding the conversation turns to
+    the prebuilt model (see gemini_model) or payload template.
+    
+    Returns:
+        dict: Registry entries keyed by bot ('articuno', 'gemini', 'azure')
+    """
+    # OpenAI API Configuration from environment variables
+    azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    azure_model = os.getenv("AZURE_OPENAI_MODEL")
+    
+    return {
+        "articuno": {
+            "model_settings": {
+                "model_name": "gemini-1.5-flash",
+                "generation_config": ARTICUNO_GENERATION_CONFIG,
+                "system_instruction": ARTICUNO_SYSTEM_PROMPT
+            }
+        },
+        "gemini": {
+            "model_settings": {
+                "model_name": "gemini-1.5-flash",
+                "generation_config": GEMINI_GENERATION_CONFIG,
+                "system_instruction": GEMINI_SYSTEM_PROMPT
+            }
+        },
+        "azure": {
+            "api_url": f"{azure_endpoint}/openai/deployments/{azure_model}/chat/completions?api-version=2024-02-15-preview",
+            "headers": {
+                "Content-Type": "application/json",
+                "api-key": os.getenv("AZURE_OPENAI_API_KEY")
+            },
+            "payload_template": dict(AZURE_PAYLOAD_SETTINGS, model=azure_model)
+        }
+    }
+
+BOT_REGISTRY = build_bot_registry()
+
+def resolve_bot(bot_name):
+    """
+    Maps the bot name a client sent to its BOT_REGISTRY key.
+    
+    Anything that isn't Articuno.AI or Gemini is served by Azure OpenAI, so
+    the result is always one of the registry keys and safe to use as a
+    metrics label.
+    
+    Args:
+        bot_name (str): The 'bot' field of the chat request
+        
+    Returns:
+        str: 'articuno', 'gemini' or 'azure'
+    """
+    if bot_name == "Articuno.AI":
+        return "articuno"
+    if bot_name == "Gemini 2.0 Flash" or (isinstance(bot_name, str) and bot_name.lower() == "gemini"):
+        return "gemini"
+    return "azure"
+gemini_model_lock = threading.Lock()
+
+def gemini_model(bot):
+    """
+    Returns the GenerativeModel for a Gemini-backed bot, building it on first use.
+    
+    Args:
+        bot (str): Registry name of the bot ('articuno' or 'gemini')
+        
+    Returns:
+        genai.GenerativeModel: The shared model client for that bot
+    """
+    entry = BOT_REGISTRY[bot]
+    if "model" not in entry:
+        with gemini_model_lock:
+            if "model" not in entry:
+                entry["model"] = genai.GenerativeModel(**entry["model_settings"])
+    return entry["model"]
+
+def get_articuno_weather_prompt(user_input):
+    """
+    Detects a location in the message and formats its weather data for the model.
+    
+    Args:
+        user_input (str): The user message
+        
+    Returns:
+        str or None: The weather prompt, or None if no location was detected
+    """
+    with location_detection_seconds.time():
+        location = detect_location_from_message(user_input)
+    if not location:
+        return None
+    
+    logger.debug("Detected location", extra={"location": location})
+    weather_data = fetch_weather_data(location)
+    weather_prompt = format_weather_data_for_gemini(weather_data, location)
+    logger.debug("Formatted weather data", extra={"weather_prompt": weather_prompt})
+    return weather_prompt
+
+def open_chat_session(session_id):
+    """
+    Returns the chat session for a request, creating it on first use.
+    
+    Args:
+        session_id (str or None): Client-chosen session id
+        
+    Returns:
+        dict or None: The session, or None if no id was sent or sessions are off
+        
+    Raises:
+        ValueError: If the session id is malformed
+    """
+    if not session_id or chat_sessions is None:
+        return None
+    if not SESSION_ID_RE.match(session_id):
+        raise ValueError("Invalid session_id")
+    return chat_sessions.get_or_create(session_id)
+
+def session_context_key(session):
+    """Returns a string identifying a session's context, for response cache keys"""
+    if not session or not (session["history"] or session["summary"]):
+        return ""
+    return json.dumps([session["summary"], [turn["text"] for turn in session["history"]]])
+
+def gemini_session_contents(session, user_parts):
+    """
+    Builds Gemini contents from a session's history followed by the current user turn.
+    
+    The running summary of older turns is prepended to the first user turn so
+    the contents still alternate between user and model.
+    """
+    contents = []
+    if session:
+        contents = [
+            {"role": "user" if turn["role"] == "user" else "model", "parts": [{"text": turn["text"]}]}
+            for turn in session["history"]
+        ]
+    contents.append({"role": "user", "parts": user_parts})
+    if session and session["summary"]:
+        contents[0]["parts"].insert(0, {"text": "Summary of the earlier conversation:\n" + "\n".join(session["summary"])})
+    return contents
+
+def record_session_turn(session, user_input, image_data, reply_text, start, weather_prompt=None):
+    """
+    Records a finished exchange in its chat session, if there is one.
+    
+    Args:
+        session (dict or None): The session the request was made in
+        user_input (str): The user message
+        image_data (dict or None): The attached image, noted but not stored
+        reply_text (str): The assistant reply
+        start (float): time.monotonic() when the request started
+        weather_prompt (str, optional): Weather data sent along with the message
+    """
+    if session is None:
+        return
+    
+    prompt_tokens = (
+        estimate_tokens("\n".join(session["summary"]))
+        + sum(turn["tokens"] for turn in session["history"])
+        + estimate_tokens(user_input)
+        + estimate_tokens(weather_prompt)
+    )
+    user_text = f"{user_input} [image]" if image_data else user_input
+    chat_sessions.record_turn(session["id"], user_text, reply_text, prompt_tokens, time.monotonic() - start)
+
+def build_articuno_request(user_input, image_data=None, weather_prompt=None, session=None):
+    """
+    Builds the Gemini model and conversation for an Articuno.AI weather request.
+    
+    Args:
+        user_input (str): The user message
+        image_data (dict, optional): Decoded image with 'data' (bytes) and 'format' keys
+        weather_prompt (str, optional): Output of get_articuno_weather_prompt
+        session (dict, optional): Chat session whose history is sent first
+        
+    Returns:
+        tuple: (model, content_parts) ready for model.generate_content
+    """
+    # Include weather data in the prompt if we have it
+    if weather_prompt:
+        user_parts = [{"text": f"{user_input}\n\n{weather_prompt}"}]
+    elif image_data:
+        user_parts = [{"text": user_input}]
+    else:
+        # No location detected or weather data available
+        if not any(term in user_input.lower() for term in ['weather', 'temperature', 'forecast', 'rain', 'sunny', 'cloudy', 'wind', 'humidity', 'climate']):
+            enhanced_input = f"Regarding weather information: {user_input}"
+        else:
+            enhanced_input = user_input
+        user_parts = [{"text": enhanced_input}]
+    
+    # Handle messages with images
+    if image_data:
+        # Create image part for multimodal request
+        user_parts.append(gemini_image_part(image_data))
+    
+    return gemini_model("articuno"), gemini_session_contents(session, user_parts)
+
+def chat_cache_key(bot, user_input, image_data=None, weather_prompt=None, session=None):
+    """
+    Builds the response cache key for a chat request.
+    
+    Args:
+        bot (str): Registry name of the bot ('articuno', 'gemini', 'azure')
+        user_input (str): The user message (normalized for case and whitespace)
+        image_data (dict, optional): Decoded image; its bytes are hashed
+        weather_prompt (str, optional): Articuno weather snapshot
+        session (dict, optional): Chat session whose history the reply depends on
+        
+    Returns:
+        str: Hex digest identifying the request
+    """
+    image_hash = (image_data.get("hash") or hashlib.sha256(image_data["data"]).hexdigest()) if image_data else ""
+    key = hashlib.sha256()
+    for part in (bot, " ".join(user_input.lower().split()), image_hash, weather_prompt or "", session_context_key(session)):
+        key.update(part.encode())
+        key.update(b"\0")
+    return key.hexdigest()
+
+def get_cached_chat_response(cache_key):
+    """
+    Looks up a memoized chat reply.
+    
+    Returns:
+        dict or None: {'markdown': ..., 'html': ...}, or None if caching is off or it's a miss
+    """
+    if response_cache is None:
+        return None
+    value = response_cache.get(cache_key)
+    if value is None:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        # An entry written before the markdown source was cached alongside the HTML
+        return None
+
+def store_chat_response(cache_key, markdown_output, html_response):
+    # The markdown source is kept so cache hits record the same session history as live replies
+    if response_cache is not None:
+        response_cache.set(cache_key, json.dumps({"markdown": markdown_output, "html": html_response}))
+
+def chat_json_response(html_response, session, cached=False, fallback=None):
+    """Builds the JSON body for a chat reply"""
+    body = {"response": html_response}
+    if cached:
+        body["cached"] = True
+    if fallback:
+        body["fallback"] = fallback
+    if session is not None:
+        body["session_id"] = session["id"]
+    return jsonify(body)
+
+def retry_later_response(error, status=503):
+    """Builds a 503 (or 429) response telling the client when to retry"""
+    retry_after = max(1, int(error.retry_after + 0.999))
+    return jsonify({"error": str(error), "retry_after": retry_after}), status, {"Retry-After": str(retry_after)}
+
+def gemini_reply(model, contents):
+    """Returns the markdown reply from a Gemini model"""
+    with upstream_limiters["gemini"].slot():
+        return model.generate_content(contents, request_options=GEMINI_REQUEST_OPTIONS).text
+
+def azure_openai_reply(api_url, headers, payload):
+    """Returns the markdown reply from Azure OpenAI chat completions"""
+    with upstream_limiters["azure"].slot():
+        response = upstream_client.post(api_url, headers=headers, json=payload)
+    if response.status_code != 200:
+        raise Exception(f"Azure OpenAI API error: {response.status_code} - {response.text}")
+    return response.json()["choices"][0]["message"]["content"]
+
+def chat_provider_requests(bot, user_input, image_data=None, session=None, weather_prompt=None):
+    """
+    Returns the primary provider for a bot and how to build the request for each provider.
+    
+    Articuno.AI and Gemini run on Gemini, everything else on Azure OpenAI. When
+    the router fails over, the other provider gets the same message, history
+    and image (and Articuno's weather data, inlined into the message for Azure).
+    
+    Args:
+        bot (str): Registry name of the bot ('articuno', 'gemini', 'azure')
+        user_input (str): The user message
+        image_data (dict, optional): Decoded image
+        session (dict, optional): Chat session
+        weather_prompt (str, optional): Articuno weather context
+        
+    Returns:
+        tuple: (primary, builders) where builders maps provider to a zero-argument
+        function returning the arguments for that provider's reply/stream call
+    """
+    if bot == "articuno":
+        gemini_builder = lambda: build_articuno_request(user_input, image_data, weather_prompt, session)
+    else:
+        gemini_builder = lambda: build_gemini_request(user_input, image_data, session)
+    azure_input = f"{user_input}\n\n{weather_prompt}" if weather_prompt else user_input
+    builders = {
+        "gemini": gemini_builder,
+        "azure": lambda: build_azure_openai_request(azure_input, image_data, session)
+    }
+    return ("azure" if bot == "azure" else "gemini"), builders
+
+PROVIDER_REPLY = {"gemini": gemini_reply, "azure": azure_openai_reply}
+
+def routed_chat_reply(bot, user_input, image_data=None, session=None, weather_prompt=None):
+    """
+    Generates the reply for a chat request through the chat router.
+    
+    Returns:
+        tuple: (markdown_output, html_response, provider, primary)
+    """
+    primary, builders = chat_provider_requests(bot, user_input, image_data, session, weather_prompt)
+    calls = {
+        provider: (lambda provider=provider: PROVIDER_REPLY[provider](*builders[provider]()))
+        for provider in builders
+    }
+    markdown_output, provider = chat_router.call(primary, calls)
+    return markdown_output, markdown_renderer.render(markdown_output), provider, primary
+
+def finish_routed_chat(cache_key, markdown_output, html_response, provider, primary):
+    """Caches a routed reply unless it came from a fallback, and returns the fallback provider if any"""
+    if provider != primary:
+        return provider
+    store_chat_response(cache_key, markdown_output, html_response)
+    return None
+
+def process_articuno_weather_request(user_input, image_data=None, session=None):
+    """Process chat request specifically for Articuno.AI as a weather assistant"""
+    start = time.monotonic()
+    try:
+        weather_prompt = get_articuno_weather_prompt(user_input)
         
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash",
-            generation_config=generation_config,
-            system_instruction=system_prompt
+        cache_key = chat_cache_key("articuno", user_input, image_data, weather_prompt, session)
+        cached_response = get_cached_chat_response(cache_key)
+        if cached_response is not None:
+            record_session_turn(session, user_input, image_data, cached_response["markdown"], start, weather_prompt)
+            return chat_json_response(cached_response["html"], session, cached=True)
+        
+        # Identical requests already in flight share the same model call
+        markdown_output, html_response, provider, primary = single_flight.do(
+            "chat", cache_key, lambda: routed_chat_reply("articuno", user_input, image_data, session, weather_prompt)
         )
+        fallback = finish_routed_chat(cache_key, markdown_output, html_response, provider, primary)
+        record_session_turn(session, user_input, image_data, markdown_output, start, weather_prompt)
+        
+        return chat_json_response(html_response, session, fallback=fallback)
+    
+    except UpstreamUnavailableError as e:
+        return retry_later_response(e)
+    except Exception as e:
+        logger.exception("Articuno Weather API error: %s", e)
+        return jsonify({"error": f"Error with Articuno Weather API: {str(e)}"}), 500
+
+def build_gemini_request(user_input, image_data=None, session=None):
+    """
+    Builds the Gemini model and contents for a general Gemini chat request.
+    
+    Args:
+        user_input (str): The user message
+        image_data (dict, optional): Decoded image with 'data' (bytes) and 'format' keys
+        session (dict, optional): Chat session whose history is sent first
         
-        # Handle messages with images
+    Returns:
+        tuple: (model, contents) ready for model.generate_content
+    """
+    model = gemini_model("gemini")
+    
+    if session is not None:
+        user_parts = [{"text": user_input}]
         if image_data:
-            # Process the image data
-            image_format = image_data.get("format", "jpeg")
-            image_binary = base64.b64decode(image_data.get("data").split(",")[1])
-            
-            # Create a temporary file to save the image
-            temp_image_path = os.path.join(tempfile.gettempdir(), f"image_{uuid.uuid4().hex}.{image_format}")
-            with open(temp_image_path, "wb") as f:
-                f.write(image_binary)
-            
-            # Create image part for multimodal request
-            image_parts = [
-                {
-                    "mime_type": f"image/{image_format}",
-                    "data": image_binary
-                }
-            ]
-            
-            # Generate response with both text and image
-            response = model.generate_content([user_input, image_parts[0]])
-            
-            # Clean up temp file
-            try:
-                os.remove(temp_image_path)
-            except:
-                pass
-        else:
-            # Text-only request
-            response = model.generate_content(user_input)
+            user_parts.append(gemini_image_part(image_data))
+        return model, gemini_session_contents(session, user_parts)
+    
+    # Handle messages with images
+    if image_data:
+        # Create image part for multimodal request
+        return model, [user_input, gemini_image_part(image_data)]
+    
+    # Text-only request
+    return model, user_input
+
+def process_gemini_request(user_input, image_data=None, session=None):
+    """Process chat request using Google Gemini API"""
+    start = time.monotonic()
+    try:
+        cache_key = chat_cache_key("gemini", user_input, image_data, session=session)
+        cached_response = get_cached_chat_response(cache_key)
+        if cached_response is not None:
+            record_session_turn(session, user_input, image_data, cached_response["markdown"], start)
+            return chat_json_response(cached_response["html"], session, cached=True)
         
-        # Extract response text
-        markdown_output = response.text
-        html_response = markdown.markdown(markdown_output)
+        # Identical requests already in flight share the same model call
+        markdown_output, html_response, provider, primary = single_flight.do(
+            "chat", cache_key, lambda: routed_chat_reply("gemini", user_input, image_data, session)
+        )
+        fallback = finish_routed_chat(cache_key, markdown_output, html_response, provider, primary)
+        record_session_turn(session, user_input, image_data, markdown_output, start)
         
-        return jsonify({"response": html_response})
+        return chat_json_response(html_response, session, fallback=fallback)
     
+    except UpstreamUnavailableError as e:
+        return retry_later_response(e)
     except Exception as e:
-        print(f"Gemini API error: {str(e)}")
+        logger.exception("Gemini API error: %s", e)
         return jsonify({"error": f"Error with Gemini API: {str(e)}"}), 500
 
-def process_azure_openai_request(user_input, image_data=None):
-    """Process chat request using Azure OpenAI API"""
-    # OpenAI API Configuration from environment variables
-    token = os.getenv("AZURE_OPENAI_API_KEY")
-    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-    model_name = os.getenv("AZURE_OPENAI_MODEL")
+def build_azure_openai_request(user_input, image_data=None, session=None):
+    """
+    Builds the Azure OpenAI chat completions URL, headers and payload.
     
-    try:
-        # Prepare headers
-        headers = {
-            "Content-Type": "application/json",
-            "api-key": token
-        }
+    Args:
+        user_input (str): The user message
+        image_data (dict, optional): Decoded image with 'data' (bytes) and 'format' keys
+        session (dict, optional): Chat session whose history is sent first
         
-        # Prepare messages
-        system_message = {
-            "role": "system",
-            "content": (
-                "You are Eubyte, a friendly virtual assistant thoughtfully developed by the Edubyte Team to provide "
-                "intelligent, user-friendly, and context-aware support. As a helpful assistant, your primary goal is "
-                "to deliver accurate, concise, and engaging responses.\n\n"
-
-                "🧠 Identity\n"
-                "Name: Eubyte\n"
-                "Developed by: Edubyte Team\n"
-                "Role: Friendly, fast, intelligent and supportive virtual assistant\n\n"
-
-                "📝 Response Structure\n"
-                "- Use clear headings (H1, H2, etc.) to organize information logically.\n"
-                "- Present details using bullet points or numbered lists where appropriate for readability.\n"
-                "- Include spaces after headings and between paragraphs for improved visual clarity.\n"
-                "- Integrate appropriate emojis (e.g., ✅📌🚀) to enhance interactivity and user engagement, without overwhelming the message.\n\n"
-
-                "🌟 Tone and Style\n"
-                "- Maintain a professional yet friendly tone.\n"
-                "- Be concise, yet ensure clarity and completeness.\n"
-                "- Adapt your communication style based on the user's intent and tone."
-            )
+    Returns:
+        tuple: (api_url, headers, payload)
+    """
+    bot = BOT_REGISTRY["azure"]
+    
+    # Handle regular text messages
+    if image_data is None:
+        user_message = {
+            "role": "user",
+            "content": user_input
         }
+    # Handle messages with images
+    else:
+        image_url = azure_image_url(image_data)
         
-        # Handle regular text messages
-        if image_data is None:
-            user_message = {
-                "role": "user",
-                "content": user_input
-            }
-            messages = [system_message, user_message]
-        # Handle messages with images
-        else:
-            # Process the image data
-            image_format = image_data.get("format", "jpeg")
-            image_binary = base64.b64decode(image_data.get("data").split(",")[1])
-            image_url = get_image_data_url(image_binary, image_format)
-            
-            # Create multimodal message with both text and image
-            user_message = {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": user_input
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": image_url,
-                            "detail": "auto"
-                        }
+        # Create multimodal message with both text and image
+        user_message = {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": user_input
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url,
+                        "detail": "auto"
                     }
-                ]
-            }
-            messages = [system_message, user_message]
-        
-        # Create the payload
-        payload = {
-            "messages": messages,
-            "temperature": 1.0,
-            "top_p": 1.0,
-            "max_tokens": 1000,
-            "model": model_name
+                }
+            ]
         }
+    
+    messages = [AZURE_SYSTEM_MESSAGE]
+    if session is not None:
+        if session["summary"]:
+            messages.append({
+                "role": "system",
+                "content": "Summary of the earlier conversation:\n" + "\n".join(session["summary"])
+            })
+        messages.extend({"role": turn["role"], "content": turn["text"]} for turn in session["history"])
+    messages.append(user_message)
+    
+    payload = dict(bot["payload_template"], messages=messages)
+    return bot["api_url"], bot["headers"], payload
+
+def process_azure_openai_request(user_input, image_data=None, session=None):
+    """Process chat request using Azure OpenAI API"""
+    start = time.monotonic()
+    try:
+        cache_key = chat_cache_key("azure", user_input, image_data, session=session)
+        cached_response = get_cached_chat_response(cache_key)
+        if cached_response is not None:
+            record_session_turn(session, user_input, image_data, cached_response["markdown"], start)
+            return chat_json_response(cached_response["html"], session, cached=True)
+        
+        # Identical requests already in flight share the same model call
+        markdown_output, html_response, provider, primary = single_flight.do(
+            "chat", cache_key, lambda: routed_chat_reply("azure", user_input, image_data, session)
+        )
+        fallback = finish_routed_chat(cache_key, markdown_output, html_response, provider, primary)
+        record_session_turn(session, user_input, image_data, markdown_output, start)
         
-        # Make direct API call
-        api_url = f"{endpoint}/openai/deployments/{model_name}/chat/completions?api-version=2024-02-15-preview"
-        response = requests.post(api_url, headers=headers, json=payload)
-        response_data = response.json()
+        return chat_json_response(html_response, session, fallback=fallback)
+    
+    except UpstreamUnavailableError as e:
+        return retry_later_response(e)
+    except Exception as e:
+        logger.exception("Azure OpenAI API error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def sse_event(event, data):
+    """Formats a Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_gemini_chunks(model, contents):
+    """
+    Streams a Gemini reply as text chunks.
+    
+    Args:
+        model (genai.GenerativeModel): The configured model
+        contents: Contents accepted by model.generate_content
         
-        # Extract response text
-        markdown_output = response_data["choices"][0]["message"]["content"]
-        html_response = markdown.markdown(markdown_output)
+    Yields:
+        str: Markdown text fragments in the order they are generated
+    """
+    # The slot is held until the stream ends
+    with upstream_limiters["gemini"].slot():
+        for chunk in model.generate_content(contents, stream=True, request_options=GEMINI_REQUEST_OPTIONS):
+            # Skip chunks that only carry metadata (e.g. the final finish reason)
+            if chunk.parts and chunk.text:
+                yield chunk.text
+
+def stream_azure_openai_chunks(api_url, headers, payload):
+    """
+    Streams an Azure OpenAI chat completion as text chunks.
+    
+    Args:
+        api_url (str): Chat completions URL
+        headers (dict): Request headers
+        payload (dict): Chat completions payload (stream is switched on here)
         
-        return jsonify({"response": html_response})
+    Yields:
+        str: Markdown text fragments in the order they are generated
+    """
+    # The slot is held until the stream ends
+    with upstream_limiters["azure"].slot():
+        response = upstream_client.post(api_url, headers=headers, json=dict(payload, stream=True), stream=True)
+        try:
+            if response.status_code != 200:
+                raise Exception(f"Azure OpenAI API error: {response.status_code} - {response.text}")
+            
+            for line in response.iter_lines(decode_unicode=True):
+                # Azure sends "data: {json}" lines and ends with "data: [DONE]"
+                if not line or not line.startswith("data:"):
+                    continue
+                event_data = line[len("data:"):].strip()
+                if event_data == "[DONE]":
+                    break
+                
+                choices = json.loads(event_data).get("choices") or []
+                if choices:
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        yield content
+        finally:
+            response.close()
+
+PROVIDER_STREAM = {"gemini": stream_gemini_chunks, "azure": stream_azure_openai_chunks}
+
+@app.route('/api/chat/stream', methods=["POST"])
+def chat_stream():
+    """
+    API endpoint streaming the chat reply as Server-Sent Events.
+    
+    Emits "delta" events with markdown text fragments as they arrive, along
+    with HTML for newly finished blocks (html_append) and for the block still
+    being written (html_tail), then a single "done" event with the full
+    rendered HTML and timings,
+    or an "error" event if generation fails part way through.
+    """
+    limited = rate_limit_response("chat")
+    if limited:
+        return limited
+    
+    try:
+        user_input, image_data, bot_name, _, session_id = parse_chat_request()
+        # Label metrics with the registry key, never the raw client string
+        g.metrics_bot = resolve_bot(bot_name)
+    except UnknownImageError as e:
+        return jsonify({"error": str(e), "image_missing": True}), 404
+    except InvalidImageError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if not user_input and not image_data:
+        return jsonify({"error": "No message or image provided"}), 400
+    
+    try:
+        session = open_chat_session(session_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return stream_chat_response(user_input, image_data, bot_name, session)
+
+def stream_chat_response(user_input, image_data, bot_name, session=None):
+    """
+    Builds the Server-Sent Events response for a chat request.
     
+    Args:
+        user_input (str): The user message
+        image_data (dict or None): Decoded image with 'data' and 'format' keys
+        bot_name (str): The selected bot
+        session (dict, optional): Chat session the request belongs to
+        
+    Returns:
+        Response: A text/event-stream response, or a JSON error if setup fails
+    """
+    start = time.monotonic()
+    weather_prompt = None
+    try:
+        # Check which bot is selected and use appropriate API
+        bot = resolve_bot(bot_name)
+        if bot == "articuno":
+            weather_prompt = get_articuno_weather_prompt(user_input)
+        cache_key = chat_cache_key(bot, user_input, image_data, weather_prompt, session)
+        cached_response = get_cached_chat_response(cache_key)
+        if cached_response is None:
+            primary, builders = chat_provider_requests(bot, user_input, image_data, session, weather_prompt)
+            chat_router.check(primary, builders, upstream_limiters)
+            streams = {
+                provider: (lambda provider=provider: PROVIDER_STREAM[provider](*builders[provider]()))
+                for provider in builders
+            }
+            chunks = chat_router.stream(primary, streams)
+    except UpstreamUnavailableError as e:
+        return retry_later_response(e)
     except Exception as e:
+        logger.exception("Chat stream setup error: %s", e)
         return jsonify({"error": str(e)}), 500
+    
+    session_fields = {"session_id": session["id"]} if session is not None else {}
+    
+    # Memoized replies are sent as a single done event
+    if cached_response is not None:
+        record_session_turn(session, user_input, image_data, cached_response["markdown"], start, weather_prompt)
+        total_ms = round((time.monotonic() - start) * 1000, 1)
+        return Response(
+            sse_event("done", {"response": cached_response["html"], "cached": True, "ttft_ms": total_ms, "total_ms": total_ms, **session_fields}),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"}
+        )
+    
+    def generate():
+        first_token_at = None
+        parts = []
+        renderer = IncrementalMarkdownRenderer(markdown_renderer)
+        try:
+            for provider, text in chunks:
+                if first_token_at is None:
+                    first_token_at = time.monotonic() - start
+                    chat_ttft.record(bot, first_token_at)
+                parts.append(text)
+                html_append, html_tail = renderer.feed(text)
+                yield sse_event("delta", {"text": text, "html_append": html_append, "html_tail": html_tail})
+            
+            markdown_output = "".join(parts)
+            html_response = markdown_renderer.render(markdown_output)
+            fallback = finish_routed_chat(cache_key, markdown_output, html_response, provider, primary) if parts else None
+            record_session_turn(session, user_input, image_data, markdown_output, start, weather_prompt)
+            total = time.monotonic() - start
+            chat_stream_duration.record(bot, total)
+            yield sse_event("done", {
+                "response": html_response,
+                "ttft_ms": round((first_token_at if first_token_at is not None else total) * 1000, 1),
+                "total_ms": round(total * 1000, 1),
+                **({"fallback": fallback} if fallback else {}),
+                **session_fields
+            })
+        except Exception as e:
+            logger.exception("Chat stream error: %s", e)
+            yield sse_event("error", {"error": str(e)})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Measures the per-request setup cost of the chat processors.
+
+Compares rebuilding the generation config, system prompt and
+genai.GenerativeModel / Azure payload on every request (the original
+behaviour) with the prebuilt BOT_REGISTRY used by the build_*_request
+helpers. No upstream calls are made: weather lookups are replaced with a
+canned result and models are only constructed, never invoked.
+
+Usage:
+    python benchmarks/chat_setup.py [--repeat 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google.generativeai as genai  # noqa: E402
+
+import app  # noqa: E402
+
+CANNED_WEATHER = {"error": "offline benchmark"}
+
+
+def legacy_articuno_setup(user_input):
+    generation_config = dict(app.ARTICUNO_GENERATION_CONFIG)
+    weather_system_prompt = "".join([app.ARTICUNO_SYSTEM_PROMPT])
+    model = genai.GenerativeModel(model_name="gemini-1.5-flash", generation_config=generation_config)
+
+    # Same per-request weather work as the registry path, so only setup differs
+    location = app.detect_location_from_message(user_input)
+    weather_prompt = app.format_weather_data_for_gemini(app.fetch_weather_data(location), location)
+    return model, [
+        {"role": "user", "parts": [{"text": weather_system_prompt}]},
+        {"role": "model", "parts": [{"text": "I understand. I'll be Articuno.AI, your weather assistant."}]},
+        {"role": "user", "parts": [{"text": f"{user_input}\n\n{weather_prompt}"}]}
+    ]
+
+
+def legacy_gemini_setup(user_input):
+    generation_config = dict(app.GEMINI_GENERATION_CONFIG)
+    system_prompt = "".join([app.GEMINI_SYSTEM_PROMPT])
+    model = genai.GenerativeModel(
+        model_name="gemini-1.5-flash",
+        generation_config=generation_config,
+        system_instruction=system_prompt
+    )
+    return model, user_input
+
+
+def legacy_azure_setup(user_input):
+    token = os.getenv("AZURE_OPENAI_API_KEY")
+    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    model_name = os.getenv("AZURE_OPENAI_MODEL")
+    headers = {"Content-Type": "application/json", "api-key": token}
+    system_message = {"role": "system", "content": "".join([app.AZURE_SYSTEM_MESSAGE["content"]])}
+    payload = {
+        "messages": [system_message, {"role": "user", "content": user_input}],
+        "temperature": 1.0,
+        "top_p": 1.0,
+        "max_tokens": 1000,
+        "model": model_name
+    }
+    api_url = f"{endpoint}/openai/deployments/{model_name}/chat/completions?api-version=2024-02-15-preview"
+    return api_url, headers, payload
+
+
+def time_per_call(func, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(f"hello there {i}")
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    # Keep the Articuno path offline
+    app.fetch_weather_data = lambda location: CANNED_WEATHER
+
+    cases = [
+        ("articuno", legacy_articuno_setup,
+         lambda user_input: app.build_articuno_request(user_input, None, app.get_articuno_weather_prompt(user_input))),
+        ("gemini", legacy_gemini_setup, app.build_gemini_request),
+        ("azure", legacy_azure_setup, app.build_azure_openai_request),
+    ]
+    print(f"{'bot':<10} {'legacy us/req':>14} {'registry us/req':>16} {'saved':>8}")
+    for name, legacy, current in cases:
+        legacy_us = time_per_call(legacy, args.repeat)
+        current_us = time_per_call(current, args.repeat)
+        print(f"{name:<10} {legacy_us:>14.1f} {current_us:>16.1f} {1 - current_us / legacy_us:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
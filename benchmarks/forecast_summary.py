@@ -0,0 +1,177 @@
+"""
+Micro-benchmark for the forecast daily aggregation.
+
+The original code aggregated the forecast twice: on the server in
+format_weather_data_for_gemini (dt_txt string splitting, separate
+avg/min/max passes, max(set(...), key=list.count)) on every Articuno chat
+turn, and again in the browser (processForcastData) every time the weather
+modal opened. Both are reproduced here as the baseline ("legacy", with the
+browser half ported to Python) and compared with summarize_forecast, which
+now runs once per upstream forecast fetch and whose result is cached with
+it. "per chat turn" is the aggregation cost of each Articuno prompt for a
+forecast already in the weather cache. Also checks that both produce the
+same daily temperatures.
+
+Usage:
+    python benchmarks/forecast_summary.py [--sizes 40,400,4000] [--repeat 200]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import format_weather_data_for_gemini, summarize_forecast  # noqa: E402
+
+CONDITIONS = [
+    ("Clear", "clear sky", "01d"),
+    ("Clouds", "few clouds", "02d"),
+    ("Clouds", "broken clouds", "04d"),
+    ("Rain", "light rain", "10d"),
+    ("Rain", "moderate rain", "10d"),
+    ("Snow", "light snow", "13d"),
+]
+
+
+CURRENT = {
+    "main": {"temp": 20.0, "feels_like": 19.0, "humidity": 50, "pressure": 1012},
+    "weather": [{"main": "Clear", "description": "clear sky"}],
+    "wind": {"speed": 3.0},
+    "visibility": 10000,
+    "sys": {"country": "GB", "sunrise": 1700000000, "sunset": 1700030000},
+    "name": "Benchmark",
+}
+
+
+def make_forecast(entries, seed=0):
+    """Builds a synthetic 3-hourly /forecast response in UTC"""
+    rng = random.Random(seed)
+    start = 1700000000 - 1700000000 % 86400
+    items = []
+    for i in range(entries):
+        dt = start + i * 3 * 3600
+        temp = rng.uniform(-5, 30)
+        main, description, icon = rng.choice(CONDITIONS)
+        items.append({
+            "dt": dt,
+            "dt_txt": datetime.fromtimestamp(dt, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "main": {"temp": temp, "temp_min": temp - rng.uniform(0, 2), "temp_max": temp + rng.uniform(0, 2)},
+            "weather": [{"main": main, "description": description, "icon": icon}],
+            "pop": rng.random(),
+        })
+    return {"list": items, "city": {"timezone": 0}}
+
+
+def legacy_summarize(forecast):
+    """The original aggregation, kept here as the baseline (all days, not just 3)."""
+    day_forecasts = {}
+    for item in forecast["list"]:
+        date = item["dt_txt"].split(" ")[0]
+        if date not in day_forecasts:
+            day_forecasts[date] = []
+        day_forecasts[date].append(item)
+
+    summary = []
+    for date, items in day_forecasts.items():
+        avg_temp = sum(item["main"]["temp"] for item in items) / len(items)
+        min_temp = min(item["main"]["temp_min"] for item in items)
+        max_temp = max(item["main"]["temp_max"] for item in items)
+        conditions = [item["weather"][0]["main"] for item in items]
+        most_common_condition = max(set(conditions), key=conditions.count)
+        condition_desc = next((item["weather"][0]["description"] for item in items
+                               if item["weather"][0]["main"] == most_common_condition), most_common_condition)
+        precipitation_prob = 0
+        precipitation_count = 0
+        for item in items:
+            if "pop" in item:
+                precipitation_prob += item["pop"]
+                precipitation_count += 1
+        summary.append((date, avg_temp, min_temp, max_temp, condition_desc,
+                        precipitation_prob / precipitation_count * 100 if precipitation_count else None))
+    return summary
+
+
+def legacy_client_summarize(forecast):
+    """Python port of the original processForcastData from static/script.js."""
+    daily = {}
+    for item in forecast["list"]:
+        date = datetime.fromtimestamp(item["dt"])
+        day = date.strftime("%a")
+        if day not in daily:
+            daily[day] = {"temps": [], "descriptions": [], "icons": [], "date": date.strftime("%A, %b %d")}
+        daily[day]["temps"].append(item["main"]["temp"])
+        daily[day]["descriptions"].append(item["weather"][0]["description"])
+        daily[day]["icons"].append(item["weather"][0]["icon"])
+
+    result = []
+    for day, data in daily.items():
+        counts = {}
+        for description in data["descriptions"]:
+            counts[description] = counts.get(description, 0) + 1
+        icon_counts = {}
+        for icon in data["icons"]:
+            icon_counts[icon] = icon_counts.get(icon, 0) + 1
+        result.append({
+            "day": day,
+            "date": data["date"],
+            "avgTemp": round(sum(data["temps"]) / len(data["temps"])),
+            "description": max(counts, key=counts.get),
+            "icon": max(icon_counts, key=icon_counts.get),
+        })
+    return result[:3]
+
+
+def legacy_total(forecast):
+    legacy_summarize(forecast)
+    legacy_client_summarize(forecast)
+
+
+def check_agreement(forecast):
+    legacy = legacy_summarize(forecast)
+    current = summarize_forecast(forecast)
+    assert [row[0] for row in legacy] == [day["date"] for day in current], "day grouping differs"
+    for row, day in zip(legacy, current):
+        assert abs(row[1] - day["temp_avg"]) < 0.01
+        assert row[2] == day["temp_min"] and row[3] == day["temp_max"]
+
+
+def time_per_call(func, forecast, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(forecast)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="40,400,4000")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'':>8} {'aggregation, us':>31} {'per chat turn, us':>24}")
+    print(f"{'entries':>8} {'legacy':>10} {'current':>10} {'speedup':>9} {'legacy':>11} {'cached':>12}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        forecast = make_forecast(size)
+        check_agreement(forecast)
+        # Keep total work roughly constant across sizes
+        repeat = max(1, args.repeat * 40 // size)
+        legacy_us = time_per_call(legacy_total, forecast, repeat)
+        current_us = time_per_call(summarize_forecast, forecast, repeat)
+
+        # Per Articuno prompt: legacy re-aggregated, now the cached summary is reused
+        turn_legacy_us = time_per_call(legacy_summarize, forecast, repeat)
+        cached = dict(forecast, summary=summarize_forecast(forecast))
+        turn_cached_us = time_per_call(
+            lambda f: format_weather_data_for_gemini({"current": CURRENT, "forecast": f}, "Benchmark"), cached, repeat
+        ) - time_per_call(
+            lambda f: format_weather_data_for_gemini({"current": CURRENT}, "Benchmark"), cached, repeat
+        )
+        print(f"{size:>8} {legacy_us:>10.1f} {current_us:>10.1f} {legacy_us / current_us:>8.1f}x "
+              f"{turn_legacy_us:>11.1f} {max(turn_cached_us, 0):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""
+Offline load test for /api/chat, /api/weather and /api/transcribe.
+
+Starts the stub upstreams from stubs.py (Azure OpenAI, Gemini, OpenWeather
+and Google speech) with a configurable latency and error rate, launches the
+app against them in a subprocess and replays a traffic mix: one phase per
+endpoint, then all three interleaved. For each phase it reports throughput,
+p50/p95/p99 latency, responses by status and the server's resident memory
+(start, end and peak, sampled from /proc on Linux). Requests the app sheds
+with Retry-After (rate limits, full queues, busy upstreams) are counted as
+"shed", separately from errors. Rate limits and the per-upstream
+concurrency caps are lifted unless --keep-rate-limits /
+--keep-admission-limits are given, so the numbers show the serving mode
+rather than the admission defaults.
+
+The report is JSON (stdout, or --output FILE) and records the git commit,
+so runs can be compared between commits with --compare BASELINE.json,
+which prints the change per metric and exits 1 if any regressed by more
+than --threshold percent.
+
+Usage:
+    python benchmarks/load_test.py [--mode async|threaded] [--requests 300] [--concurrency 32]
+                                   [--upstream-latency 0.2] [--error-rate 0]
+                                   [--phases chat,weather,transcribe,mixed]
+                                   [--output results.json] [--compare baseline.json] [--threshold 10]
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stubs import StubServer, upstream_limits_env
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Per-upstream cap used when admission limits are lifted; above any load this harness generates
+UPSTREAM_LIMIT = 1024
+
+CITIES = [
+    "London", "Paris", "Tokyo", "New York", "Mumbai", "Kolkata", "Berlin", "Sydney", "Toronto", "Cairo",
+    "Lagos", "Lima", "Seoul", "Madrid", "Rome", "Dubai", "Singapore", "Chicago", "Nairobi", "Oslo"
+]
+
+CHAT_TEMPLATES = {
+    "Articuno.AI": [
+        "What's the weather in {city}?",
+        "Will it rain in {city} tomorrow?",
+        "Should I pack a jacket for {city} this weekend?",
+        "How hot is it in {city} right now?",
+    ],
+    "GPT-4o": [
+        "Explain how a {topic} works in two sentences.",
+        "Give me three tips for learning about {topic}.",
+        "Write a haiku about {topic}.",
+    ],
+    "Gemini 2.0 Flash": [
+        "Summarize the history of {topic} briefly.",
+        "What are common misconceptions about {topic}?",
+    ],
+}
+TOPICS = ["heat pump", "rainbow", "jet stream", "tide", "compiler", "glacier", "monsoon", "solar panel"]
+BOT_WEIGHTS = {"Articuno.AI": 0.5, "GPT-4o": 0.3, "Gemini 2.0 Flash": 0.2}
+
+# Metrics compared by --compare, and whether a higher value is better
+COMPARED_METRICS = {
+    "throughput_rps": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "error_rate": False,
+    "shed_rate": False,
+    "rss_peak_mb": False,
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def start_app(mode, port, env):
+    if mode == "async":
+        command = [sys.executable, "serve_async.py", "--port", str(port)]
+    else:
+        command = [sys.executable, "-c", f"from app import app; app.run(port={port}, threaded=True)"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+def make_wav(seconds, rate, channels, frequency=440.0):
+    """Builds a sine-tone WAV clip in memory"""
+    frames = bytearray()
+    for i in range(int(seconds * rate)):
+        sample = int(8000 * math.sin(2 * math.pi * frequency * i / rate)).to_bytes(2, "little", signed=True)
+        frames += sample * channels
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(bytes(frames))
+    return buffer.getvalue()
+
+
+def make_audio_clips():
+    """Voice-note sized clips; stereo 44.1 kHz clips take the FFmpeg path when FFmpeg is installed"""
+    clips = [make_wav(seconds, 16000, 1) for seconds in (1, 3, 6)]
+    if shutil.which("ffmpeg"):
+        clips += [make_wav(seconds, 44100, 2) for seconds in (2, 5)]
+    return clips
+
+
+class TrafficGenerator:
+    """Builds a reproducible stream of realistic requests for each endpoint"""
+
+    def __init__(self, seed, audio_clips):
+        self.rng = random.Random(seed)
+        self.audio_clips = audio_clips
+        self.sessions = [f"loadtest-session-{i:04d}" for i in range(40)]
+        self.lock = threading.Lock()
+
+    def chat(self, i):
+        with self.lock:
+            bot = self.rng.choices(list(BOT_WEIGHTS), weights=list(BOT_WEIGHTS.values()))[0]
+            template = self.rng.choice(CHAT_TEMPLATES[bot])
+            message = template.format(city=self.rng.choice(CITIES), topic=self.rng.choice(TOPICS))
+            # A third of the traffic is multi-turn conversations
+            session_id = self.rng.choice(self.sessions) if self.rng.random() < 0.33 else None
+        payload = {"message": message, "bot": bot}
+        if session_id:
+            payload["session_id"] = session_id
+        return "chat", "POST", "/api/chat", {"json": payload}
+
+    def weather(self, i):
+        with self.lock:
+            request_type = self.rng.choice(["current", "forecast"])
+            roll = self.rng.random()
+            if roll < 0.1:
+                # Weather modal / dashboard lookups batch several places and both types
+                locations = self.rng.sample(CITIES, self.rng.randint(1, 6))
+                return "weather_batch", "POST", "/api/weather/batch", {"json": {"locations": locations}}
+            if roll < 0.15:
+                params = {"location": "Nowhere"}
+            elif roll < 0.3:
+                params = {"lat": f"{self.rng.uniform(-60, 70):.4f}", "lon": f"{self.rng.uniform(-180, 180):.4f}"}
+            else:
+                params = {"location": self.rng.choice(CITIES)}
+        params["type"] = request_type
+        return "weather", "GET", "/api/weather", {"params": params}
+
+    def transcribe(self, i):
+        with self.lock:
+            clip = self.rng.choice(self.audio_clips)
+        return "transcribe", "POST", "/api/transcribe", {"files": {"audio": ("clip.wav", clip, "audio/wav")}}
+
+    def mixed(self, i):
+        with self.lock:
+            roll = self.rng.random()
+        if roll < 0.6:
+            return self.chat(i)
+        if roll < 0.95:
+            return self.weather(i)
+        return self.transcribe(i)
+
+
+class MemorySampler:
+    """Samples a process's resident set size from /proc while a phase runs"""
+
+    def __init__(self, pid, interval=0.05):
+        self.path = f"/proc/{pid}/status"
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss_mb(self):
+        try:
+            with open(self.path) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self.rss_mb()
+            if rss is not None:
+                self.samples.append(rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start_mb = self.rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.end_mb = self.rss_mb()
+
+    def summary(self):
+        if self.start_mb is None:
+            return {"rss_start_mb": None, "rss_end_mb": None, "rss_peak_mb": None}
+        return {
+            "rss_start_mb": round(self.start_mb, 1),
+            "rss_end_mb": round(self.end_mb, 1),
+            "rss_peak_mb": round(max(self.samples + [self.start_mb, self.end_mb]), 1),
+        }
+
+
+def percentile(samples, fraction):
+    return samples[int(fraction * (len(samples) - 1))]
+
+
+def summarize(results, elapsed):
+    """Per-endpoint throughput, latency percentiles and status counts"""
+    by_endpoint = {}
+    for endpoint, status, shed, latency in results:
+        by_endpoint.setdefault(endpoint, []).append((status, shed, latency))
+
+    summary = {}
+    for endpoint, samples in sorted(by_endpoint.items()):
+        # Other 4xx answers (unknown city) are valid responses; 5xx and connection failures are errors
+        shed = sum(1 for _, was_shed, _ in samples if was_shed)
+        errors = sum(1 for status, was_shed, _ in samples if not was_shed and (status is None or status >= 500))
+        latencies = sorted(latency for status, was_shed, latency in samples
+                           if not was_shed and status is not None and status < 500)
+        statuses = {}
+        for status, _, _ in samples:
+            key = str(status) if status is not None else "connection_error"
+            statuses[key] = statuses.get(key, 0) + 1
+        summary[endpoint] = {
+            "requests": len(samples),
+            "errors": errors,
+            "error_rate": round(errors / len(samples), 4),
+            "shed": shed,
+            "shed_rate": round(shed / len(samples), 4),
+            "statuses": statuses,
+            "throughput_rps": round(len(samples) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        }
+    return summary
+
+
+def run_phase(base_url, make_request, total, concurrency, pid):
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+
+    def one(i):
+        endpoint, method, path, kwargs = make_request(i)
+        start = time.perf_counter()
+        try:
+            response = session.request(method, base_url + path, timeout=120, **kwargs)
+            status = response.status_code
+            shed = status in (429, 503) and "Retry-After" in response.headers
+        except requests.RequestException:
+            status, shed = None, False
+        return endpoint, status, shed, time.perf_counter() - start
+
+    with MemorySampler(pid) as memory:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(total)))
+        elapsed = time.perf_counter() - start
+
+    phase = {"elapsed_s": round(elapsed, 2), "endpoints": summarize(results, elapsed)}
+    phase.update(memory.summary())
+    return phase
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(report, baseline, threshold):
+    """Prints per-metric changes against a baseline report; returns True if anything regressed"""
+    regressed = False
+    if baseline.get("config") != report["config"]:
+        print(f"warning: baseline config differs: {baseline.get('config')}", file=sys.stderr)
+    print(f"{'phase/endpoint':<24} {'metric':<16} {'baseline':>10} {'current':>10} {'change':>9}", file=sys.stderr)
+    for phase_name, phase in report["phases"].items():
+        base_phase = baseline.get("phases", {}).get(phase_name)
+        if not base_phase:
+            continue
+        rows = [(f"{phase_name}/{endpoint}", stats, base_phase["endpoints"].get(endpoint))
+                for endpoint, stats in phase["endpoints"].items()]
+        rows.append((f"{phase_name}/server", phase, base_phase))
+        for label, current, base in rows:
+            if not base:
+                continue
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                if current.get(metric) is None or base.get(metric) is None:
+                    continue
+                before, after = base[metric], current[metric]
+                change = (after - before) / before * 100 if before else (0.0 if after == before else math.inf)
+                worse = change < -threshold if higher_is_better else change > threshold
+                # Tiny error rates swing wildly in relative terms
+                if metric in ("error_rate", "shed_rate") and abs(after - before) < 0.01:
+                    worse = False
+                regressed = regressed or worse
+                print(f"{label:<24} {metric:<16} {before:>10} {after:>10} {change:>+8.1f}%{'  REGRESSION' if worse else ''}",
+                      file=sys.stderr)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against stub upstreams")
+    parser.add_argument("--mode", choices=["async", "threaded"], default="async")
+    parser.add_argument("--requests", type=int, default=300, help="requests per phase")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--upstream-latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls that fail with 503")
+    parser.add_argument("--phases", default="chat,weather,transcribe,mixed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-rate-limits", action="store_true",
+                        help="keep per-client rate limits (all load comes from one IP, so they're off by default)")
+    parser.add_argument("--keep-admission-limits", action="store_true",
+                        help="keep the app's per-upstream concurrency caps (lifted by default)")
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.upstream_latency, error_rate=args.error_rate).start()
+    env = dict(os.environ, **stub.env(), LOG_LEVEL="WARNING")
+    if not args.keep_rate_limits:
+        env.update(CHAT_RATE_LIMIT_PER_MINUTE="0", TRANSCRIBE_RATE_LIMIT_PER_MINUTE="0")
+    if not args.keep_admission_limits:
+        env.update(upstream_limits_env(UPSTREAM_LIMIT))
+
+    port = free_port()
+    process = start_app(args.mode, port, env)
+    base_url = f"http://127.0.0.1:{port}"
+    traffic = TrafficGenerator(args.seed, make_audio_clips())
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {
+            "mode": args.mode,
+            "requests_per_phase": args.requests,
+            "concurrency": args.concurrency,
+            "upstream_latency_s": args.upstream_latency,
+            "upstream_error_rate": args.error_rate,
+            "seed": args.seed,
+        },
+        "phases": {},
+    }
+    try:
+        for phase in args.phases.split(","):
+            report["phases"][phase] = run_phase(base_url, getattr(traffic, phase), args.requests,
+                                                args.concurrency, process.pid)
+        report["server_stats"] = requests.get(base_url + "/api/stats", timeout=30).json()
+    finally:
+        process.terminate()
+        process.wait()
+        stub.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
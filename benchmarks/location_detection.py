@@ -0,0 +1,129 @@
+"""
+Micro-benchmark for detect_location_from_message.
+
+Compares the original regex-only extractor against the current one
+(precompiled patterns + gazetteer trie) on a labelled corpus of chat
+messages, reporting accuracy and per-message latency for both.
+
+Usage:
+    python benchmarks/location_detection.py [--repeat 200]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import detect_location_from_message  # noqa: E402
+
+# (message, expected location or None)
+CORPUS = [
+    ("weather in London", "London"),
+    ("What's the weather like in Paris today?", "Paris"),
+    ("Tokyo weather", "Tokyo"),
+    ("Berlin", "Berlin"),
+    ("give me the weather report of Mumbai", "Mumbai"),
+    ("how is the weather in New York City", "New York City"),
+    ("will it rain in Seattle tomorrow?", "Seattle"),
+    ("temperature in Kolkata please", "Kolkata"),
+    ("what's the forecast for Chicago", "Chicago"),
+    ("Is it cold in toronto right now?", "Toronto"),
+    ("Paris, Texas weather", "Paris, Texas"),
+    ("show me humidity for Dhaka", "Dhaka"),
+    ("I'm flying to Los Angeles next week, should I pack a jacket?", "Los Angeles"),
+    ("Do I need an umbrella in Singapore", "Singapore"),
+    ("weather in Smallville", "Smallville"),
+    ("Is Sydney hotter than Melbourne?", "Sydney"),
+    ("hi articuno, tell me about the climate in Cape Town", "Cape Town"),
+    ("forecast for rio de janeiro this weekend", "Rio de Janeiro"),
+    # An explicit "weather in X" beats a place mentioned earlier
+    ("I live in Boston, what's the weather in Denver", "Denver"),
+    ("I live in Boston, what's the weather in Smallville", "Smallville"),
+    # Place names that are also person names or words only count when capitalized
+    ("weather for my trip with austin to Denver", "Denver"),
+    ("florence told me to check the forecast for Madrid", "Madrid"),
+    ("I lost the cork, is it cold in Dublin?", "Dublin"),
+    ("the phoenix app says sofia should check the weather in Cairo", "Cairo"),
+    ("weather in Charlotte this weekend", "Charlotte"),
+    ("Thanks!", None),
+    ("What should I wear today?", None),
+]
+
+# A long, location-free message to expose backtracking costs
+LONG_MESSAGE = "tell me something about the " + "very " * 400 + "long weather report thing"
+
+# Repeated "weather" with no preposition: the unbounded legacy patterns go quadratic on this
+PATHOLOGICAL_MESSAGE = "give 1 " + "weather 1 " * 3000
+
+
+def legacy_detect_location(message):
+    """The original implementation, kept here as the baseline."""
+    location_patterns = [
+        r"weather\s+(?:in|at|for)\s+([A-Za-z\s,]+)",
+        r"(?:in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",
+        r"^([A-Za-z\s,]+?)(?:\s+weather|\?|$)",
+        r"^([A-Za-z\s,]+?)$",
+        r"weather (?:of|for|in|at)\s+([A-Za-z\s,]+)",
+        r"weather(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",
+        r"(?:show|get|tell|give)(?:.+?)weather(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",
+        r"(?:show|get|tell|give)(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",
+        r"(?:how is|what is|what's)(?:.+?)weather(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+)",
+        r"(?:how's|what's)(?:.+?)(?:of|for|in|at)\s+([A-Za-z\s,]+?)(?:\s+weather|\?|$)",
+        r"(?:temperature|forecast|climate|humidity|wind|conditions)(?:.+?)(?:in|at|for)\s+([A-Za-z\s,]+)",
+        r"(?:will it rain|is it sunny|is it hot|is it cold)(?:.+?)(?:in|at)\s+([A-Za-z\s,]+)",
+        r"what's the (?:weather|temperature|forecast)(?:.+?)(?:in|at|for)\s+([A-Za-z\s,]+)"
+    ]
+    for pattern in location_patterns:
+        match = re.search(pattern, message, re.IGNORECASE)
+        if match:
+            return re.sub(r'[.,;:!?]+$', '', match.group(1).strip())
+
+    for word in message.split():
+        clean_word = re.sub(r'[.,;:!?]+$', '', word)
+        if len(clean_word) >= 3 and clean_word[0].isupper() and clean_word.lower() not in [
+            "what", "where", "when", "why", "how", "can", "could", "would",
+            "should", "will", "shall", "the", "this", "that", "these", "those",
+            "give", "show", "tell", "about", "weather", "forecast", "temperature",
+            "conditions", "articuno", "hello", "thanks", "thank", "please", "good",
+            "morning", "afternoon", "evening", "night", "today", "tomorrow", "yesterday"
+        ]:
+            return clean_word
+    return None
+
+
+def accuracy(detect):
+    correct = 0
+    for message, expected in CORPUS:
+        result = detect(message)
+        if (result or None) == expected or (result and expected and result.lower() == expected.lower()):
+            correct += 1
+    return correct / len(CORPUS)
+
+
+def time_per_call(detect, messages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in messages:
+            detect(message)
+    return (time.perf_counter() - start) / (repeat * len(messages)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    messages = [message for message, _ in CORPUS]
+    print(f"{'implementation':<10} {'accuracy':>9} {'corpus us/msg':>14} {'long msg us':>12} {'pathological ms':>16}")
+    for name, detect in (("legacy", legacy_detect_location), ("current", detect_location_from_message)):
+        print(f"{name:<10} {accuracy(detect):>9.0%} "
+              f"{time_per_call(detect, messages, args.repeat):>14.1f} "
+              f"{time_per_call(detect, [LONG_MESSAGE], max(1, args.repeat // 20)):>12.1f} "
+              # A single call: the legacy patterns take seconds on this message
+              f"{time_per_call(detect, [PATHOLOGICAL_MESSAGE], 1) / 1000:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
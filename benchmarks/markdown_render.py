@@ -0,0 +1,110 @@
+"""
+Benchmark for rendering long chat answers to HTML.
+
+One-shot rendering compares a new markdown.markdown() call per reply (the
+original behaviour) with the pooled MarkdownRenderer, cold and on a cache
+hit. Streaming compares re-rendering the whole text on every chunk with
+IncrementalMarkdownRenderer, which re-renders only the trailing block, and
+checks that the incremental output matches a full render.
+
+Usage:
+    python benchmarks/markdown_render.py [--sizes 2000,8000,32000] [--chunk 16]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markdown  # noqa: E402
+
+from app import IncrementalMarkdownRenderer, MarkdownRenderer  # noqa: E402
+
+SECTION = """## Day {n} outlook
+
+Expect **mild temperatures** around {n}°C with a light breeze from the west. Morning fog
+should lift by ten, and the afternoon stays mostly *dry* with broken clouds.
+
+- Morning: fog, {n}°C
+- Afternoon: partly cloudy
+- Evening: clear skies
+
+1. Carry a light jacket.
+
+2. Sunglasses for the afternoon.
+
+> Tip: the UV index peaks around midday, so plan outdoor time early.
+
+    forecast = fetch("day {n}")
+    print(forecast)
+
+That's all for day {n} - let me know if you want hourly details!
+
+"""
+
+
+def make_answer(size):
+    parts = []
+    n = 1
+    while sum(len(part) for part in parts) < size:
+        parts.append(SECTION.format(n=n))
+        n += 1
+    return "".join(parts)[:size]
+
+
+def chunks_of(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def time_once(func, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def stream_full(chunks):
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        markdown.markdown(text)
+
+
+def stream_incremental(chunks, renderer):
+    incremental = IncrementalMarkdownRenderer(renderer)
+    committed = ""
+    for chunk in chunks:
+        html_append, html_tail = incremental.feed(chunk)
+        committed += html_append
+    return committed + html_tail
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="2000,8000,32000")
+    parser.add_argument("--chunk", type=int, default=16, help="characters per streamed chunk")
+    args = parser.parse_args()
+
+    renderer = MarkdownRenderer(cache_entries=64)
+
+    print(f"{'':>7} {'one-shot render, ms':>34} {'streamed render, ms':>30}")
+    print(f"{'chars':>7} {'new md':>10} {'pooled':>10} {'cached':>10} {'full/chunk':>14} {'incremental':>13} {'speedup':>8}")
+    for size in (int(size) for size in args.sizes.split(",")):
+        answer = make_answer(size)
+        chunks = chunks_of(answer, args.chunk)
+
+        assert stream_incremental(chunks, renderer) == markdown.markdown(answer), "incremental output differs"
+
+        new_ms = time_once(lambda: markdown.markdown(answer), repeat=20)
+        pooled_ms = time_once(lambda: renderer.convert(answer), repeat=20)
+        renderer.render(answer)
+        cached_ms = time_once(lambda: renderer.render(answer), repeat=20)
+        full_ms = time_once(lambda: stream_full(chunks))
+        incremental_ms = time_once(lambda: stream_incremental(chunks, renderer))
+        print(f"{size:>7} {new_ms:>10.2f} {pooled_ms:>10.2f} {cached_ms:>10.3f} "
+              f"{full_ms:>14.1f} {incremental_ms:>13.1f} {full_ms / incremental_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Page weight and first-paint benchmark for the home page.
+
+Starts the app twice, serving the unbuilt static files (the original
+behaviour) and the build from build_assets.py, and loads / like a browser:
+the HTML, its local stylesheet and script, and every image the stylesheet
+references. CDN assets are the same in both and left out.
+
+- first view: empty cache, everything is downloaded
+- repeat view: assets still fresh in the cache (Cache-Control max-age)
+  are not requested; the rest are revalidated with If-None-Match /
+  If-Modified-Since
+
+Bytes are counted as sent on the wire (compressed when the server
+compressed them). First paint is modelled as the HTML plus the
+render-blocking stylesheet over a throttled link (default: 150 ms RTT,
+1.6 Mbit/s, like Lighthouse's mobile profile); "local" is the measured
+wall time for the same requests on loopback.
+
+Usage:
+    python benchmarks/page_weight.py [--rtt-ms 150] [--mbps 1.6] [--build]
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urljoin, urlsplit
+
+import requests
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCEPT_ENCODING = "br, gzip" if brotli else "gzip"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(port, env):
+    command = [sys.executable, "-c", f"from app import app; app.run(port={port}, threaded=True)"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=5)
+            return process
+        except requests.RequestException:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f"App on port {port} did not start")
+
+
+def fetch(session, url, headers=None):
+    """Returns (response, decoded body, bytes on the wire)"""
+    response = session.get(url, headers=dict(headers or {}, **{"Accept-Encoding": ACCEPT_ENCODING}), stream=True)
+    wire = response.raw.read(decode_content=False)
+    encoding = response.headers.get("Content-Encoding")
+    if encoding == "gzip":
+        body = gzip.decompress(wire)
+    elif encoding == "br":
+        body = brotli.decompress(wire)
+    else:
+        body = wire
+    return response, body, len(wire)
+
+
+def fresh_in_cache(response):
+    """Whether a browser would reuse the cached response without asking the server"""
+    cache_control = response.headers.get("Cache-Control", "")
+    match = re.search(r"max-age=(\d+)", cache_control)
+    return "no-cache" not in cache_control and match is not None and int(match.group(1)) > 0
+
+
+def load_page(base_url, cache=None):
+    """
+    Loads the home page and its local assets.
+
+    Args:
+        base_url (str): The app's root URL
+        cache (dict): Responses from an earlier view, keyed by URL; None for a first view
+
+    Returns:
+        tuple: (report dict, responses keyed by URL)
+    """
+    session = requests.Session()
+    report = {"requests": 0, "not_modified": 0, "from_cache": 0, "bytes": 0, "critical_path": []}
+    responses = {}
+
+    def get(url, critical=False):
+        cached = (cache or {}).get(url)
+        if cached is not None and fresh_in_cache(cached[0]):
+            report["from_cache"] += 1
+            responses[url] = cached
+            return cached[1]
+        headers = {}
+        if cached is not None:
+            if cached[0].headers.get("ETag"):
+                headers["If-None-Match"] = cached[0].headers["ETag"]
+            if cached[0].headers.get("Last-Modified"):
+                headers["If-Modified-Since"] = cached[0].headers["Last-Modified"]
+        response, body, wire = fetch(session, url, headers)
+        report["requests"] += 1
+        report["bytes"] += wire
+        if response.status_code == 304:
+            report["not_modified"] += 1
+            responses[url] = cached
+            body = cached[1]
+        else:
+            responses[url] = (response, body)
+        if critical:
+            report["critical_path"].append(wire)
+        return body
+
+    start = time.perf_counter()
+    html = get(base_url + "/", critical=True).decode("utf-8")
+    stylesheets = re.findall(r'<link rel="stylesheet" href="(/[^"]+)"', html)
+    scripts = re.findall(r'<script src="(/[^"]+)"', html)
+    for href in stylesheets:
+        css = get(base_url + href, critical=True).decode("utf-8")
+        for image in sorted(set(re.findall(r"""url\(['"]?([^'")]+)['"]?\)""", css))):
+            get(urljoin(base_url + href, image))
+    local_ms = (time.perf_counter() - start) * 1000
+    for src in scripts:
+        get(base_url + src)
+
+    report["local_first_paint_ms"] = round(local_ms, 1)
+    report["assets"] = sorted(urlsplit(url).path for url in responses)
+    return report, responses
+
+
+def modelled_paint_ms(critical_path, rtt_ms, mbps):
+    """First paint over a throttled link: one round trip plus transfer time per critical request"""
+    return round(sum(rtt_ms + size * 8 / (mbps * 1000) for size in critical_path), 1)
+
+
+def measure(env, rtt_ms, mbps):
+    port = free_port()
+    process = start_app(port, env)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        first, responses = load_page(base_url)
+        repeat, _ = load_page(base_url, cache=responses)
+    finally:
+        process.terminate()
+        process.wait()
+
+    result = {}
+    for name, view in (("first_view", first), ("repeat_view", repeat)):
+        critical_path = view.pop("critical_path")
+        view["modelled_first_paint_ms"] = modelled_paint_ms(critical_path, rtt_ms, mbps)
+        result[name] = view
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rtt-ms", type=float, default=150)
+    parser.add_argument("--mbps", type=float, default=1.6)
+    parser.add_argument("--build", action="store_true", help="run build_assets.py first")
+    args = parser.parse_args()
+
+    if args.build:
+        subprocess.run([sys.executable, "build_assets.py"], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    report = {
+        "link": {"rtt_ms": args.rtt_ms, "mbps": args.mbps},
+        # Without a manifest in ASSET_DIR the app falls back to plain static files
+        "unbuilt": measure(dict(env, ASSET_DIR=os.path.join(ROOT, "benchmarks", "no-such-build")), args.rtt_ms, args.mbps),
+        "built": measure(env, args.rtt_ms, args.mbps),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
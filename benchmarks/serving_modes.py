@@ -0,0 +1,132 @@
+"""
+Load-test comparison of the serving modes:
+
+- threaded: `python app.py`'s default, Werkzeug with a thread per request
+- sync: Werkzeug with one request per process (--sync-processes)
+- async: gevent, serve_async.py
+
+Starts a stub Azure OpenAI upstream with a fixed latency, launches the app
+in each mode pointed at it, fires concurrent /api/chat requests and prints
+throughput and latency percentiles per mode as JSON. Requests the app sheds
+with Retry-After (rate limits, busy upstreams) are counted as "shed",
+separately from errors; rate limits and the per-upstream concurrency caps
+are lifted so every mode is measured on the same terms.
+
+Usage:
+    python benchmarks/serving_modes.py [--requests 400] [--concurrency 100]
+                                       [--upstream-latency 0.5] [--sync-processes 4]
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stubs import StubServer, upstream_limits_env
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Per-upstream cap for every mode; above any concurrency this benchmark uses
+UPSTREAM_LIMIT = 1024
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def start_app(mode, port, env, sync_processes):
+    if mode == "async":
+        command = [sys.executable, "serve_async.py", "--port", str(port)]
+    elif mode == "threaded":
+        command = [sys.executable, "-c", f"from app import app; app.run(port={port}, threaded=True)"]
+    else:
+        command = [sys.executable, "-c",
+                   f"from app import app; app.run(port={port}, threaded=False, processes={sync_processes})"]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process
+
+
+def percentile(samples, fraction):
+    return samples[int(fraction * (len(samples) - 1))]
+
+
+def run_load(port, total, concurrency):
+    url = f"http://127.0.0.1:{port}/api/chat"
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            # Unique messages so request coalescing doesn't hide upstream calls
+            response = requests.post(url, json={"message": f"load test {i}", "bot": "GPT-4o"}, timeout=120)
+            status = response.status_code
+            shed = status in (429, 503) and "Retry-After" in response.headers
+        except requests.RequestException:
+            status, shed = None, False
+        return status, shed, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for status, _, latency in results if status == 200)
+    return {
+        "requests": total,
+        "errors": sum(1 for status, shed, _ in results if status != 200 and not shed),
+        "shed": sum(1 for _, shed, _ in results if shed),
+        "throughput_rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the threaded, sync and async serving modes")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--upstream-latency", type=float, default=0.5)
+    parser.add_argument("--sync-processes", type=int, default=4)
+    parser.add_argument("--modes", default="threaded,sync,async")
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.upstream_latency).start()
+    # All load comes from one IP, so per-client rate limits are switched off, and the
+    # per-upstream caps are lifted so no mode is limited by admission defaults
+    env = dict(os.environ, **stub.env(services=("azure",)), **upstream_limits_env(UPSTREAM_LIMIT),
+               CHAT_RATE_LIMIT_PER_MINUTE="0")
+
+    report = {"upstream_latency_s": args.upstream_latency, "concurrency": args.concurrency, "modes": {}}
+    for mode in args.modes.split(","):
+        port = free_port()
+        process = start_app(mode, port, env, args.sync_processes)
+        try:
+            report["modes"][mode] = run_load(port, args.requests, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+
+    stub.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Cold-start benchmark for app.py.
+
+Each run starts a fresh interpreter and records:
+
+- import_ms: time to `import app`, plus which heavy modules it loaded
+- first_<route>_ms: time to the first response of each route through the
+  Flask test client, with the upstreams pointed at a local stub (the
+  first call of a route pays for any module it loads lazily)
+- server_ready_ms: time from spawning `app.run()` to the first 200 on /
+
+Runs are repeated and the median is reported. --repo measures another
+checkout (e.g. a worktree of the previous commit) for a before/after:
+
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/startup_time.py --repo /tmp/before
+
+Usage:
+    python benchmarks/startup_time.py [--runs 5] [--repo PATH] [--no-server]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+from stubs import StubServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that dominate import time; reported as loaded or not after `import app`
+HEAVY_MODULES = ["google.generativeai", "speech_recognition", "pydub", "markdown", "requests"]
+
+# Runs in the child interpreter: times the import, then the first call of each route
+CHILD_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+result = {"import_ms": (time.perf_counter() - start) * 1000}
+result["loaded"] = [name for name in %(heavy)r if name in sys.modules]
+client = app.app.test_client()
+calls = [
+    ("index", lambda: client.get("/")),
+    ("weather", lambda: client.get("/api/weather?location=London")),
+    ("chat_azure", lambda: client.post("/api/chat", json={"message": "hi", "bot": "GPT-4o"})),
+    ("chat_gemini", lambda: client.post("/api/chat", json={"message": "hi", "bot": "gemini"})),
+]
+for name, call in calls:
+    start = time.perf_counter()
+    status = call().status_code
+    result["first_%%s_ms" %% name] = (time.perf_counter() - start) * 1000
+    result["first_%%s_status" %% name] = status
+result["loaded_after_routes"] = [name for name in %(heavy)r if name in sys.modules]
+print(json.dumps(result))
+""" % {"heavy": HEAVY_MODULES}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_in_process(repo, env):
+    output = subprocess.run([sys.executable, "-c", CHILD_SCRIPT], cwd=repo, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_server(repo, env, timeout=60):
+    port = free_port()
+    command = [sys.executable, "-c", f"from app import app; app.run(port={port}, threaded=True)"]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=repo, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + timeout
+        while time.perf_counter() < deadline:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/", timeout=5).status_code == 200:
+                    return (time.perf_counter() - start) * 1000
+            except requests.RequestException:
+                time.sleep(0.01)
+        raise RuntimeError(f"Server on port {port} did not answer within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--repo", default=ROOT, help="checkout to measure (default: this one)")
+    parser.add_argument("--no-server", action="store_true", help="skip the spawn-to-first-response measurement")
+    args = parser.parse_args()
+
+    stub = StubServer(latency=0).start()
+    env = dict(os.environ, **stub.env(services=("azure", "gemini", "openweather")),
+               CHAT_RATE_LIMIT_PER_MINUTE="0", LOG_LEVEL="WARNING", PYTHONDONTWRITEBYTECODE="1")
+
+    runs = [measure_in_process(args.repo, env) for _ in range(args.runs)]
+    report = {"repo": os.path.abspath(args.repo), "runs": args.runs}
+    for key in runs[0]:
+        if key.endswith("_ms"):
+            report[key] = round(statistics.median(run[key] for run in runs), 1)
+        else:
+            report[key] = runs[-1][key]
+    if not args.no_server:
+        report["server_ready_ms"] = round(statistics.median(
+            measure_server(args.repo, env) for _ in range(args.runs)
+        ), 1)
+
+    stub.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
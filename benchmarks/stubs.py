@@ -0,0 +1,285 @@
+"""
+Local stub upstreams for offline benchmarks.
+
+StubServer answers like every API app.py talks to, with a configurable
+delay and error rate, so the app can be load-tested without spending quota:
+
+- Azure OpenAI chat completions (plain and streamed)
+- Gemini generateContent / streamGenerateContent (REST transport)
+- OpenWeather /weather and /forecast, with deterministic data per city
+- Google speech recognition (speech-api/v2/recognize)
+
+StubServer.env() returns the environment variables that point app.py at
+the stub. The speech recognizer's URL is fixed, so its requests are routed
+to the stub as an HTTP proxy (http_proxy) while no_proxy keeps the other
+local calls direct.
+
+Set fail_status on a running stub (stub.fail_status = 503) to make every
+request fail, e.g. to exercise the chat circuit breakers, or error_rate to
+fail that fraction of requests at random.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+WEATHER_CONDITIONS = [
+    (800, "Clear", "clear sky", "01"),
+    (801, "Clouds", "few clouds", "02"),
+    (803, "Clouds", "broken clouds", "04"),
+    (500, "Rain", "light rain", "10"),
+    (501, "Rain", "moderate rain", "10"),
+    (600, "Snow", "light snow", "13"),
+    (741, "Fog", "fog", "50"),
+]
+
+# Place names the OpenWeather stub answers 404 for
+UNKNOWN_CITIES = {"nowhere", "atlantis"}
+
+# Upstreams with a concurrency limiter in app.py
+LIMITED_UPSTREAMS = ("GEMINI", "AZURE", "OPENWEATHER", "SPEECH")
+
+
+def upstream_limits_env(limit):
+    """Returns environment variables setting every upstream's concurrency cap (and a queue of twice that)"""
+    env = {}
+    for upstream in LIMITED_UPSTREAMS:
+        env[f"{upstream}_MAX_CONCURRENCY"] = str(limit)
+        env[f"{upstream}_MAX_QUEUE"] = str(limit * 2)
+    return env
+
+
+def city_weather(query, now):
+    """Builds deterministic current conditions and a 5-day / 3-hour forecast for a city query"""
+    seed = int(hashlib.md5(query.lower().encode()).hexdigest()[:8], 16)
+    rng = random.Random(seed)
+    name = query.split(",")[0].strip().title() or "Stubville"
+    city_id = seed % 10000000
+    timezone = rng.choice([-18000, 0, 3600, 19800, 32400])
+    base_temp = rng.uniform(-5, 30)
+    # Observation times move every 10 minutes like the real API's
+    observed = now - now % 600
+    condition = rng.choice(WEATHER_CONDITIONS)
+
+    current = {
+        "coord": {"lon": round(rng.uniform(-180, 180), 4), "lat": round(rng.uniform(-60, 70), 4)},
+        "weather": [{"id": condition[0], "main": condition[1], "description": condition[2], "icon": condition[3] + "d"}],
+        "base": "stations",
+        "main": {
+            "temp": round(base_temp, 2),
+            "feels_like": round(base_temp - 1.5, 2),
+            "temp_min": round(base_temp - 2, 2),
+            "temp_max": round(base_temp + 2, 2),
+            "pressure": rng.randint(995, 1030),
+            "humidity": rng.randint(30, 95)
+        },
+        "visibility": 10000,
+        "wind": {"speed": round(rng.uniform(0, 12), 2), "deg": rng.randint(0, 359)},
+        "clouds": {"all": rng.randint(0, 100)},
+        "dt": observed,
+        "sys": {"country": "ST", "sunrise": observed - 6 * 3600, "sunset": observed + 6 * 3600},
+        "timezone": timezone,
+        "id": city_id,
+        "name": name,
+        "cod": 200
+    }
+
+    start = observed - observed % 10800 + 10800
+    items = []
+    for i in range(40):
+        dt = start + i * 10800
+        temp = base_temp + rng.uniform(-4, 4)
+        code, main, description, icon = rng.choice(WEATHER_CONDITIONS)
+        items.append({
+            "dt": dt,
+            "main": {
+                "temp": round(temp, 2),
+                "feels_like": round(temp - 1, 2),
+                "temp_min": round(temp - rng.uniform(0, 2), 2),
+                "temp_max": round(temp + rng.uniform(0, 2), 2),
+                "pressure": rng.randint(995, 1030),
+                "humidity": rng.randint(30, 95)
+            },
+            "weather": [{"id": code, "main": main, "description": description, "icon": icon + "d"}],
+            "clouds": {"all": rng.randint(0, 100)},
+            "wind": {"speed": round(rng.uniform(0, 12), 2), "deg": rng.randint(0, 359)},
+            "visibility": 10000,
+            "pop": round(rng.random(), 2),
+            "dt_txt": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(dt))
+        })
+    forecast = {
+        "cod": "200",
+        "message": 0,
+        "cnt": len(items),
+        "list": items,
+        "city": {"id": city_id, "name": name, "country": "ST", "timezone": timezone, "coord": current["coord"]}
+    }
+    return current, forecast
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def failure_status(self):
+        """Returns the status to fail this request with, or None to answer normally"""
+        if self.server.fail_status:
+            return self.server.fail_status
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            return 503
+        return None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        time.sleep(self.server.latency)
+
+        status = self.failure_status()
+        if status:
+            self.send_json(status, {"cod": status, "message": "stub failure"})
+        elif url.path.endswith("/weather") or url.path.endswith("/forecast"):
+            if "q" in query:
+                city = query["q"][0]
+            else:
+                city = f"{query.get('lat', ['0'])[0]},{query.get('lon', ['0'])[0]}"
+            if city.split(",")[0].strip().lower() in UNKNOWN_CITIES:
+                self.send_json(404, {"cod": "404", "message": "city not found"})
+                return
+            current, forecast = city_weather(city, int(time.time()))
+            self.send_json(200, forecast if url.path.endswith("/forecast") else current)
+        else:
+            self.send_json(404, {"error": "unknown stub route"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        time.sleep(self.server.latency)
+
+        status = self.failure_status()
+        if status:
+            self.send_json(status, {"error": {"code": status, "message": "stub failure"}})
+        elif "/speech-api/v2/recognize" in self.path:
+            # Google answers with one JSON object per line, the first one empty
+            result = {"result": [{"alternative": [{"transcript": f"stub transcript of {len(body)} bytes",
+                                                   "confidence": 0.92}], "final": True}], "result_index": 0}
+            payload = ('{"result":[]}\n' + json.dumps(result) + "\n").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        elif "/chat/completions" in self.path:
+            request = json.loads(body or b"{}")
+            user_message = request.get("messages", [{}])[-1].get("content", "")
+            reply = f"## Stub reply\n\nYou said: {user_message}"
+            if request.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for text in ("## Stub reply\n\n", f"You said: {user_message}"):
+                    event = {"choices": [{"delta": {"content": text}}]}
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+            else:
+                self.send_json(200, {"choices": [{"message": {"content": reply}}]})
+        elif ":generateContent" in self.path or ":streamGenerateContent" in self.path:
+            request = json.loads(body or b"{}")
+            parts = request.get("contents", [{}])[-1].get("parts", [])
+            user_message = " ".join(part["text"] for part in parts if "text" in part)
+            chunks = ["## Stub reply\n\n", f"You said: {user_message}"]
+            candidates = [
+                {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}]}
+                for text in chunks
+            ]
+            candidates[-1]["candidates"][0]["finishReason"] = "STOP"
+            if ":streamGenerateContent" in self.path:
+                # The REST transport reads streamed responses as one JSON array
+                self.send_json(200, candidates)
+            else:
+                self.send_json(200, {"candidates": [{
+                    "content": {"parts": [{"text": "".join(chunks)}], "role": "model"},
+                    "finishReason": "STOP",
+                    "index": 0
+                }]})
+        else:
+            self.send_json(404, {"error": "unknown stub route"})
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Large listen backlog so connection bursts aren't refused by the stub itself
+    request_queue_size = 1024
+
+
+class StubServer:
+    """Runs the stub upstream on a background thread"""
+
+    def __init__(self, latency=0.5, error_rate=0.0, host="127.0.0.1", port=0):
+        self.httpd = StubHTTPServer((host, port), StubHandler)
+        self.httpd.latency = latency
+        self.httpd.error_rate = error_rate
+        self.httpd.fail_status = None
+
+    @property
+    def latency(self):
+        return self.httpd.latency
+
+    @latency.setter
+    def latency(self, seconds):
+        self.httpd.latency = seconds
+
+    @property
+    def error_rate(self):
+        return self.httpd.error_rate
+
+    @error_rate.setter
+    def error_rate(self, fraction):
+        self.httpd.error_rate = fraction
+
+    @property
+    def fail_status(self):
+        return self.httpd.fail_status
+
+    @fail_status.setter
+    def fail_status(self, status):
+        self.httpd.fail_status = status
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self, services=("azure", "gemini", "openweather", "speech")):
+        """Returns environment variables pointing app.py's upstreams at this stub"""
+        env = {}
+        if "azure" in services:
+            env.update(AZURE_OPENAI_ENDPOINT=self.url, AZURE_OPENAI_MODEL="stub", AZURE_OPENAI_API_KEY="stub-azure-key")
+        if "gemini" in services:
+            env.update(GEMINI_TRANSPORT="rest", GEMINI_API_ENDPOINT=self.url, GEMINI_API_KEY="stub-gemini-key")
+        if "openweather" in services:
+            env.update(OPENWEATHER_BASE_URL=self.url + "/data/2.5", OPENWEATHER_API_KEY="stub-openweather-key")
+        if "speech" in services:
+            env.update(http_proxy=self.url, HTTP_PROXY=self.url, no_proxy="127.0.0.1,localhost", NO_PROXY="127.0.0.1,localhost")
+        return env
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
@@ -0,0 +1,65 @@
+"""
+Bytes and server time for weather responses.
+
+Runs app.py in-process against the stub OpenWeather (benchmarks/stubs.py),
+warms the weather cache, then measures each endpoint in its full and slim
+projection: body size uncompressed, gzipped and brotli-compressed (when
+the brotli package is installed), and the server time of a plain 200
+versus a revalidation answered with 304.
+
+Usage:
+    python benchmarks/weather_payload.py [--repeat 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stubs import StubServer  # noqa: E402
+
+CASES = [
+    ("current", "/api/weather?location=London&fields={fields}"),
+    ("forecast", "/api/weather?location=London&type=forecast&fields={fields}"),
+    ("batch", "/api/weather/batch?location=London&types=current,forecast&fields={fields}"),
+]
+
+
+def time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    stub = StubServer(latency=0).start()
+    os.environ.update(stub.env(services=("openweather",)), LOG_LEVEL="WARNING")
+    import app
+
+    client = app.app.test_client()
+    encodings = ["identity", "gzip"] + (["br"] if app.brotli else [])
+
+    print(f"{'endpoint':<10} {'fields':<6} " + " ".join(f"{encoding + ' B':>11}" for encoding in encodings)
+          + f" {'200 ms':>8} {'304 ms':>8}")
+    for name, url in CASES:
+        for fields in app.WEATHER_FIELDS:
+            path = url.format(fields=fields)
+            # The first call fills the weather cache, so the rest measure the app alone
+            etag = client.get(path).headers["ETag"]
+            sizes = [len(client.get(path, headers={"Accept-Encoding": encoding}).data) for encoding in encodings]
+            full_ms = time_per_call(lambda: client.get(path, headers={"Accept-Encoding": "gzip"}), args.repeat)
+            not_modified_ms = time_per_call(lambda: client.get(path, headers={"If-None-Match": etag}), args.repeat)
+            print(f"{name:<10} {fields:<6} " + " ".join(f"{size:>11,}" for size in sizes)
+                  + f" {full_ms:>8.3f} {not_modified_ms:>8.3f}")
+
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Prompt-size report for the Articuno weather context.
+
+Renders the weather context for a set of synthetic cities with the original
+format_weather_data_for_gemini (kept below as the baseline) and with the
+current compact, per-city cached context, and reports prompt tokens per
+request for both plus the per-request formatting time.
+
+Tokens are estimated at four characters per token (app.estimate_tokens).
+Pass --gemini to count them with the Gemini API instead (needs
+GEMINI_API_KEY).
+
+Usage:
+    python benchmarks/weather_prompt_tokens.py [--gemini] [--repeat 2000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from forecast_summary import make_forecast  # noqa: E402
+
+CITIES = [
+    # (name, country, city id, UTC offset in seconds, temp, wind deg)
+    ("London", "GB", 2643743, 0, 11.4, 225),
+    ("Kolkata", "IN", 1275004, 19800, 31.2, 180),
+    ("New York", "US", 5128581, -14400, 18.7, 290),
+    ("Tokyo", "JP", 1850147, 32400, 22.9, 45),
+    ("Sydney", "AU", 2147714, 36000, 16.3, 135),
+]
+
+
+def make_weather(name, country, city_id, utc_offset, temp, wind_deg, seed):
+    forecast = make_forecast(40, seed=seed)
+    forecast["city"]["timezone"] = utc_offset
+    current = {
+        "id": city_id,
+        "dt": forecast["list"][0]["dt"] - 1800,
+        "timezone": utc_offset,
+        "name": name,
+        "main": {"temp": temp, "feels_like": temp - 1.3, "humidity": 64, "pressure": 1013},
+        "weather": [{"main": "Clouds", "description": "scattered clouds"}],
+        "wind": {"speed": 4.6, "deg": wind_deg},
+        "visibility": 10000,
+        "sys": {"country": country, "sunrise": forecast["list"][0]["dt"] - 20000, "sunset": forecast["list"][0]["dt"] + 22000},
+    }
+    # As fetched through the weather cache, the forecast carries its summary
+    forecast["summary"] = app.summarize_forecast(forecast)
+    return {"current": current, "forecast": forecast}
+
+
+def legacy_format_weather_data(weather_data, location):
+    """
+    The original prompt formatter, kept here as the baseline.
+    
+    Args:
+        weather_data (dict): Weather data from OpenWeather API
+        location (str): The location name
+        
+    Returns:
+        str: Formatted weather data prompt
+    """
+    if "error" in weather_data:
+        return f"Error: {weather_data['error']}"
+    
+    try:
+        current = weather_data["current"]
+        
+        # Extract current weather data
+        temp = current["main"]["temp"]
+        feels_like = current["main"]["feels_like"]
+        humidity = current["main"]["humidity"]
+        weather_desc = current["weather"][0]["description"]
+        weather_main = current["weather"][0]["main"]
+        wind_speed = current["wind"]["speed"]
+        
+        # Get pressure and visibility if available
+        pressure = current["main"].get("pressure", "N/A")
+        visibility = current.get("visibility", "N/A")
+        if visibility != "N/A":
+            visibility = visibility / 1000  # Convert from meters to kilometers
+        
+        # Extract sunrise and sunset times if available
+        sunrise = sunset = "N/A"
+        if "sys" in current and "sunrise" in current["sys"] and "sunset" in current["sys"]:
+            sunrise_timestamp = current["sys"]["sunrise"]
+            sunset_timestamp = current["sys"]["sunset"]
+            from datetime import datetime
+            sunrise = datetime.fromtimestamp(sunrise_timestamp).strftime('%H:%M')
+            sunset = datetime.fromtimestamp(sunset_timestamp).strftime('%H:%M')
+        
+        # Extract location data
+        city_name = current["name"]
+        country = current["sys"]["country"]
+        
+        # Extract forecast if available
+        forecast_text = ""
+        if "forecast" in weather_data:
+            forecast = weather_data["forecast"]
+            forecast_text = "\n\nForecast for next few days:\n"
+            
+            # Group forecast by day
+            day_forecasts = {}
+            for item in forecast["list"]:
+                date = item["dt_txt"].split(" ")[0]
+                
+                if date not in day_forecasts:
+                    day_forecasts[date] = []
+                
+                day_forecasts[date].append(item)
+            
+            # Generate a summary for each day
+            for date, items in list(day_forecasts.items())[:3]:  # Limit to 3 days
+                # Calculate average temp for the day
+                avg_temp = sum(item["main"]["temp"] for item in items) / len(items)
+                
+                # Calculate min and max temps
+                min_temp = min(item["main"]["temp_min"] for item in items)
+                max_temp = max(item["main"]["temp_max"] for item in items)
+                
+                # Find most common weather condition
+                conditions = [item["weather"][0]["main"] for item in items]
+                most_common_condition = max(set(conditions), key=conditions.count)
+                
+                # Get detailed description of most common condition
+                condition_desc = next((item["weather"][0]["description"] for item in items 
+                                      if item["weather"][0]["main"] == most_common_condition), most_common_condition)
+                
+                # Calculate average precipitation probability if available
+                precipitation_prob = 0
+                precipitation_count = 0
+                for item in items:
+                    if "pop" in item:
+                        precipitation_prob += item["pop"]
+                        precipitation_count += 1
+                
+                if precipitation_count > 0:
+                    avg_precipitation_prob = (precipitation_prob / precipitation_count) * 100  # Convert to percentage
+                    precipitation_text = f", {avg_precipitation_prob:.0f}% chance of precipitation"
+                else:
+                    precipitation_text = ""
+                
+                forecast_text += f"- {date}: {min_temp:.1f}°C to {max_temp:.1f}°C (avg: {avg_temp:.1f}°C), {condition_desc}{precipitation_text}\n"
+        
+        # Format the weather data as a prompt for Gemini
+        prompt = f"""Weather data for {city_name}, {country} (User asked about: {location}):
+        
+Current conditions:
+- Temperature: {temp}°C (feels like {feels_like}°C)
+- Weather: {weather_desc} ({weather_main})
+- Humidity: {humidity}%
+- Wind speed: {wind_speed} m/s
+- Air pressure: {pressure} hPa
+- Visibility: {visibility if visibility != "N/A" else "N/A"} km
+- Sunrise: {sunrise}
+- Sunset: {sunset}
+{forecast_text}
+
+Now, provide a friendly and helpful response about this weather information to the user. Be conversational and engaging. Use emojis appropriately to enhance the message. Include practical advice based on the weather conditions (what to wear, precautions to take, etc.). End with a friendly follow-up question.
+
+Remember to present the information in a well-structured way, including:
+1. A warm greeting that references the location
+2. Current weather conditions with a friendly tone
+3. Forecast information for the next few days
+4. Practical advice based on the conditions
+5. A friendly question or suggestion to keep the conversation going
+"""
+        return prompt
+    except Exception as e:
+        return f"Error formatting weather data: {str(e)}"
+
+
+
+def time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--gemini", action="store_true", help="count tokens with the Gemini API")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.gemini:
+        model = app.gemini_model("articuno")
+        count_tokens = lambda text: model.count_tokens(text).total_tokens  # noqa: E731
+    else:
+        count_tokens = app.estimate_tokens
+
+    print(f"{'city':<10} {'legacy tokens':>14} {'compact tokens':>15} {'saved':>7}")
+    totals = [0, 0]
+    for seed, city in enumerate(CITIES):
+        weather = make_weather(*city, seed=seed)
+        legacy = count_tokens(legacy_format_weather_data(weather, city[0]))
+        compact = count_tokens(app.format_weather_data_for_gemini(weather, city[0]))
+        totals[0] += legacy
+        totals[1] += compact
+        print(f"{city[0]:<10} {legacy:>14} {compact:>15} {1 - compact / legacy:>7.0%}")
+    print(f"{'total':<10} {totals[0]:>14} {totals[1]:>15} {1 - totals[1] / totals[0]:>7.0%}")
+
+    weather = make_weather(*CITIES[0], seed=0)
+    legacy_us = time_per_call(lambda: legacy_format_weather_data(weather, "London"), args.repeat)
+    cached_us = time_per_call(lambda: app.format_weather_data_for_gemini(weather, "London"), args.repeat)
+    print(f"\nformatting per request: legacy {legacy_us:.1f} us, cached {cached_us:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Static asset build for Edubyte.
+
+Writes a production copy of the front-end assets to static/dist/:
+
+- raster icons referenced from styles.css are resized (longest side
+  ASSET_ICON_MAX_DIMENSION, default 256 - twice the largest avatar) and
+  re-encoded as WebP
+- styles.css is rewritten to point at those icons, then styles.css and
+  script.js get content-hashed file names (styles.<hash>.css) so they can
+  be cached forever
+- text assets are precompressed next to the original (.gz, and .br when
+  the brotli package is installed)
+- manifest.json maps each source name to its built name; app.py reads it
+  to render the asset URLs and serves the files under /assets/
+
+Re-run after changing anything under static/. Without a manifest the app
+falls back to Flask's plain static handler.
+
+Usage:
+    python build_assets.py [--static static] [--out static/dist]
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+from dotenv import load_dotenv
+from PIL import Image
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+load_dotenv()
+
+ICON_MAX_DIMENSION = int(os.getenv("ASSET_ICON_MAX_DIMENSION", "256"))
+WEBP_QUALITY = int(os.getenv("ASSET_WEBP_QUALITY", "85"))
+
+# Text assets that get fingerprinted and precompressed
+TEXT_ASSETS = ["styles.css", "script.js"]
+RASTER_EXTENSIONS = {".png", ".jpg", ".jpeg", ".jfif", ".gif", ".bmp"}
+CSS_URL_PATTERN = re.compile(r"""url\((['"]?)([^'")]+)\1\)""")
+
+
+def fingerprint(name, data):
+    """Returns name with a content hash before its extension, e.g. styles.1a2b3c4d5e6f.css"""
+    stem, extension = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+
+
+def write_asset(out_dir, name, data, compress=False):
+    """Writes a built asset and, for text assets, its .gz/.br siblings"""
+    path = os.path.join(out_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    if compress:
+        # mtime=0 keeps the .gz bytes stable across builds
+        with open(path + ".gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + ".br", "wb") as f:
+                f.write(brotli.compress(data, quality=11))
+
+
+def build_icon(source_path, max_dimension, quality):
+    """Returns the icon resized to fit max_dimension and encoded as WebP"""
+    with Image.open(source_path) as img:
+        img.thumbnail((max_dimension, max_dimension))
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        output = io.BytesIO()
+        img.save(output, format="WEBP", quality=quality, method=6)
+    return output.getvalue()
+
+
+def build(static_dir, out_dir, icon_max_dimension=ICON_MAX_DIMENSION, webp_quality=WEBP_QUALITY):
+    """
+    Builds every asset into out_dir and writes its manifest.
+
+    Args:
+        static_dir (str): The source static folder
+        out_dir (str): Where to write the built assets (replaced on every build)
+        icon_max_dimension (int): Longest side of the resized icons, in pixels
+        webp_quality (int): WebP encoder quality for the icons
+
+    Returns:
+        dict: The manifest, mapping source names to built names
+    """
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    manifest = {}
+
+    with open(os.path.join(static_dir, "styles.css"), encoding="utf-8") as f:
+        css = f.read()
+
+    # Icons referenced from the stylesheet
+    for _, url in CSS_URL_PATTERN.findall(css):
+        if url in manifest or os.path.splitext(url)[1].lower() not in RASTER_EXTENSIONS:
+            continue
+        data = build_icon(os.path.join(static_dir, url), icon_max_dimension, webp_quality)
+        manifest[url] = fingerprint(os.path.splitext(url)[0] + ".webp", data)
+        write_asset(out_dir, manifest[url], data)
+
+    # Point the stylesheet at the built icons; both live in out_dir so relative URLs still resolve
+    sources = {"styles.css": CSS_URL_PATTERN.sub(
+        lambda match: f"url({match.group(1)}{manifest.get(match.group(2), match.group(2))}{match.group(1)})", css
+    ).encode("utf-8")}
+    for name in TEXT_ASSETS:
+        if name not in sources:
+            with open(os.path.join(static_dir, name), "rb") as f:
+                sources[name] = f.read()
+
+    for name in TEXT_ASSETS:
+        manifest[name] = fingerprint(name, sources[name])
+        write_asset(out_dir, manifest[name], sources[name], compress=True)
+
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main():
+    root = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Build fingerprinted, precompressed static assets")
+    parser.add_argument("--static", default=os.path.join(root, "static"))
+    parser.add_argument("--out", default=os.path.join(root, "static", "dist"))
+    args = parser.parse_args()
+
+    manifest = build(args.static, args.out)
+    for source, built in sorted(manifest.items()):
+        source_size = os.path.getsize(os.path.join(args.static, source))
+        built_size = os.path.getsize(os.path.join(args.out, built))
+        print(f"{source:<32} {source_size:>9,} -> {built:<44} {built_size:>8,}")
+    if brotli is None:
+        print("brotli is not installed; only .gz variants were written")
+
+
+if __name__ == "__main__":
+    main()
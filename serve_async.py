@@ -0,0 +1,62 @@
+"""
+Async serving mode for Edubyte.
+
+Runs the same Flask app and routes on gevent. Sockets, DNS, subprocesses and
+locks are monkey-patched to be cooperative, so one process can hold hundreds
+of concurrent chats while they wait on OpenWeather, Gemini, Azure OpenAI or
+Google speech. Gemini is switched to its REST transport because the default
+gRPC transport does not yield to gevent.
+
+Usage:
+    python serve_async.py [--host 127.0.0.1] [--port 5000] [--max-connections 1000] [--backlog 1024]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+
+from dotenv import load_dotenv  # noqa: E402
+
+# Load .env before the defaults below so settings made there still win
+load_dotenv()
+
+# Greenlets are cheap, so let upstream pools grow with the connection limit
+os.environ.setdefault("GEMINI_TRANSPORT", "rest")
+os.environ.setdefault("UPSTREAM_POOL_SIZE", "256")
+os.environ.setdefault("UPSTREAM_HTTP_POOL_SIZE", "256")
+
+# The per-upstream caps in app.py are sized for the threaded server; one gevent
+# process holds hundreds of chats, so raise them to match the pools above
+for upstream, limit in (("GEMINI", 256), ("AZURE", 256), ("OPENWEATHER", 256), ("SPEECH", 32)):
+    os.environ.setdefault(f"{upstream}_MAX_CONCURRENCY", str(limit))
+    os.environ.setdefault(f"{upstream}_MAX_QUEUE", str(limit * 2))
+
+from gevent.pool import Pool  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+from app import app  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Edubyte on gevent")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "5000")))
+    parser.add_argument("--max-connections", type=int, default=int(os.getenv("MAX_CONNECTIONS", "1000")))
+    parser.add_argument("--backlog", type=int, default=int(os.getenv("LISTEN_BACKLOG", "1024")))
+    args = parser.parse_args()
+
+    server = WSGIServer(
+        (args.host, args.port),
+        app,
+        spawn=Pool(args.max_connections),
+        backlog=args.backlog,
+        log=None
+    )
+    print(f"Serving Edubyte (gevent) on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
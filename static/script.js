@@ -134,6 +134,12 @@ const botDescriptions = {
 // Variable to store the currently selected image
 let selectedImage = null;
 
+// Server-side conversation session; a new one starts whenever the assistant changes
+let chatSessionId = newChatSessionId();
+
+// Hashes of images the server has acknowledged, so they can be referenced instead of re-uploaded
+const uploadedImageHashes = new Set();
+
 // Variables for audio recording
 let mediaRecorder = null;
 let audioChunks = [];
@@ -310,6 +316,9 @@ function switchActiveModel(name, avatarId) {
     assistantProfile.name = name;
     assistantProfile.avatar = avatarId;
     
+    // Each assistant gets its own conversation context
+    chatSessionId = newChatSessionId();
+    
     // Update the chat input header
     const chatInputHeader = document.querySelector('.chat-input-header');
     if (chatInputHeader) {
@@ -511,54 +520,163 @@ async function sendMessage() {
     // Prepare the request payload
     const payload = { 
         message: message,
-        bot: assistantProfile.name // Include the bot name in the request
+        bot: assistantProfile.name, // Include the bot name in the request
+        session_id: chatSessionId
     };
     
-    // Add image data if an image is selected
-    if (selectedImage) {
-        payload.image = {
-            data: selectedImage.dataUrl,
-            format: selectedImage.format
-        };
-        
-        // Clear the selected image after sending
-        clearSelectedImage();
-    }
+    // Take the selected image and clear the preview
+    const image = selectedImage;
+    if (image) clearSelectedImage();
 
     try {
-        console.log("Sending request to /api/chat with payload:", payload);
+        console.log("Sending request to /api/chat/stream with payload:", payload);
         
-        // Fetch AI response
-        const response = await fetch("/api/chat", {
-            method: "POST",
-            headers: {
-                "Content-Type": "application/json"
-            },
-            body: JSON.stringify(payload)
-        });
-
-        const data = await response.json();
-        console.log("Received response:", data);
-
-        // Remove loading indicator
-        chatbotChatHistory.removeChild(loadingContainer);
+        // Images the server already has are referenced by hash instead of re-uploaded
+        const imageHash = image ? await hashImageFile(image.file) : null;
+        let response = await postChatRequest(payload, image, imageHash, !uploadedImageHashes.has(imageHash));
+        
+        // The server may have evicted the image - upload it again
+        if (response.status === 404 && imageHash && uploadedImageHashes.has(imageHash)) {
+            const data = await response.clone().json();
+            if (data.image_missing) {
+                uploadedImageHashes.delete(imageHash);
+                response = await postChatRequest(payload, image, imageHash, true);
+            }
+        }
+        if (response.ok && imageHash) {
+            uploadedImageHashes.add(imageHash);
+        }
 
-        if (data.error) {
+        // Errors raised before streaming starts come back as plain JSON
+        if (!response.ok || !response.body) {
+            const data = await response.json();
             console.error("API returned an error:", data.error);
+            chatbotChatHistory.removeChild(loadingContainer);
             addAIMessageToHistory("Error: " + data.error, chatbotChatHistory);
-        } else {
-            // Add AI response to chat
-            addAIMessageToHistory(data.response, chatbotChatHistory);
+            return;
         }
+
+        await renderChatStream(response, loadingContainer);
     } catch (error) {
         console.error("Error communicating with server:", error);
         // Remove loading indicator and show error
-        chatbotChatHistory.removeChild(loadingContainer);
+        if (loadingContainer.parentNode) {
+            chatbotChatHistory.removeChild(loadingContainer);
+        }
         addAIMessageToHistory("Error: Unable to connect to the server. Please try again.", chatbotChatHistory);
     }
 }
 
-// Check if message contains email-related commands
+// Post a chat request, as JSON or (with an image) as a multipart upload
+function postChatRequest(payload, image, imageHash, includeFile) {
+    let requestBody = JSON.stringify(payload);
+    let requestHeaders = { "Content-Type": "application/json" };
+    if (image) {
+        // Images are sent as a binary multipart upload instead of base64 JSON
+        const formData = new FormData();
+        formData.append("message", payload.message);
+        formData.append("bot", payload.bot);
+        formData.append("session_id", payload.session_id);
+        formData.append("image_format", image.format);
+        if (includeFile || !imageHash) {
+            formData.append("image", image.file, image.name);
+        } else {
+            formData.append("image_hash", imageHash);
+        }
+        requestBody = formData;
+        requestHeaders = {}; // Let the browser set the multipart boundary
+    }
+    
+    // Stream the AI response as Server-Sent Events
+    return fetch("/api/chat/stream", {
+        method: "POST",
+        headers: requestHeaders,
+        body: requestBody
+    });
+}
+
+// Random id for a server-side chat session
+function newChatSessionId() {
+    // crypto.randomUUID is only available in secure contexts (https or localhost)
+    if (window.crypto && window.crypto.randomUUID) {
+        return window.crypto.randomUUID();
+    }
+    return Date.now().toString(36) + Math.random().toString(36).slice(2, 12);
+}
+
+// SHA-256 of an image file as hex, matching the server's image store key
+async function hashImageFile(file) {
+    // crypto.subtle is only available in secure contexts (https or localhost)
+    if (!window.crypto || !window.crypto.subtle) return null;
+    const digest = await window.crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, "0")).join("");
+}
+
+// Render a streamed (SSE) chat response progressively
+async function renderChatStream(response, loadingContainer) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const startTime = performance.now();
+    let buffer = "";
+    let messageDiv = null;
+    let markdownText = "";
+    let committedHtml = "";
+
+    // Swap the loading indicator for the AI message on the first event
+    const ensureMessageDiv = () => {
+        if (!messageDiv) {
+            chatbotChatHistory.removeChild(loadingContainer);
+            messageDiv = addAIMessageToHistory("", chatbotChatHistory);
+            console.log(`Time to first token: ${Math.round(performance.now() - startTime)}ms`);
+        }
+        return messageDiv;
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = "message";
+            let eventData = "";
+            rawEvent.split("\n").forEach(line => {
+                if (line.startsWith("event:")) eventName = line.slice(6).trim();
+                else if (line.startsWith("data:")) eventData += line.slice(5).trim();
+            });
+            if (!eventData) continue;
+            const data = JSON.parse(eventData);
+
+            if (eventName === "delta") {
+                // Finished blocks arrive rendered once; only the open block is re-sent
+                markdownText += data.text;
+                committedHtml += data.html_append;
+                ensureMessageDiv().innerHTML = committedHtml + data.html_tail;
+            } else if (eventName === "done") {
+                ensureMessageDiv().innerHTML = data.response;
+                console.log(`Stream finished: first token ${data.ttft_ms}ms, total ${data.total_ms}ms`);
+            } else if (eventName === "error") {
+                console.error("API returned an error:", data.error);
+                const div = ensureMessageDiv();
+                div.style.whiteSpace = "pre-wrap";
+                div.textContent = (markdownText ? markdownText + "\n\n" : "") + "Error: " + data.error;
+            }
+            chatbotChatHistory.scrollTop = chatbotChatHistory.scrollHeight;
+        }
+    }
+
+    // Stream closed without any events
+    if (!messageDiv) {
+        chatbotChatHistory.removeChild(loadingContainer);
+        addAIMessageToHistory("Error: The server closed the connection without a response.", chatbotChatHistory);
+    }
+}
+
 function containsEmailCommand(message) {
     const emailCommands = [
         /\bemail\b/i,
@@ -652,23 +770,20 @@ function handleImageSelect(event) {
         return;
     }
     
-    const reader = new FileReader();
-    reader.onload = function(e) {
-        const dataUrl = e.target.result;
-        const format = file.type.split('/')[1];
-        
-        // Store the selected image
-        selectedImage = {
-            dataUrl: dataUrl,
-            format: format,
-            name: file.name
-        };
-        
-        // Show image preview
-        showImagePreview(dataUrl, file.name);
+    // Preview through an object URL - the file itself is uploaded as binary
+    const dataUrl = URL.createObjectURL(file);
+    const format = file.type.split('/')[1];
+    
+    // Store the selected image
+    selectedImage = {
+        dataUrl: dataUrl,
+        format: format,
+        name: file.name,
+        file: file
     };
     
-    reader.readAsDataURL(file);
+    // Show image preview
+    showImagePreview(dataUrl, file.name);
 }
 
 // Function to show image preview
@@ -812,7 +927,12 @@ async function processAudio() {
             body: formData
         });
         
-        const data = await response.json();
+        let data = await response.json();
+
+        // Long recordings may still be queued or running - poll until they finish
+        if (response.status === 202 && data.status_url) {
+            data = await pollTranscriptionJob(data.status_url);
+        }
         
         if (data.error) {
             alert('Error transcribing audio: ' + data.error);
@@ -831,6 +951,18 @@ async function processAudio() {
     }
 }
 
+// Poll a queued transcription job until it is done or failed
+async function pollTranscriptionJob(statusUrl, intervalMs = 1000) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+        const response = await fetch(statusUrl);
+        const data = await response.json();
+        if (response.status !== 202) {
+            return data;
+        }
+    }
+}
+
 // Show recording indicator
 function showRecordingIndicator() {
     // Add a recording indicator to the mic button
@@ -998,6 +1130,8 @@ function addAIMessageToHistory(htmlContent, targetChatHistory = chatHistory) {
 
     targetChatHistory.appendChild(messageContainer);
     targetChatHistory.scrollTop = targetChatHistory.scrollHeight;
+
+    return messageDiv;
 }
 
 // Handle send button click
@@ -1112,144 +1246,56 @@ function hideWeatherModal() {
 // The API key is now managed by the backend using environment variables
 const weatherApiBaseUrl = 'https://api.openweathermap.org/data/2.5';
 
-// Get current weather data from OpenWeatherMap API
-async function fetchCurrentWeather(location) {
+// Get current weather and forecast in one round trip through the batch endpoint.
+// `query` is a location name or {lat, lon}. The request is a GET so the browser
+// cache can revalidate it (ETag / 304), and 'slim' asks only for the fields the
+// weather cards use.
+async function fetchWeatherAndForecast(query) {
     try {
-        console.log(`Fetching weather for location: ${location}`);
-        // Use our backend API to fetch weather data instead of directly calling OpenWeatherMap
-        const response = await fetch(`/api/weather?location=${encodeURIComponent(location)}&type=current`);
-        
-        if (!response.ok) {
-            const errorData = await response.json();
-            console.error('Weather API error response:', errorData);
-            throw new Error(`Weather API error: ${response.status} - ${errorData.message || 'Unknown error'}`);
-        }
-        
-        return await response.json();
-    } catch (error) {
-        console.error('Error fetching current weather:', error);
-        throw error;
-    }
-}
-
-// Get forecast data from OpenWeatherMap API
-async function fetchForecast(location) {
-    try {
-        console.log(`Fetching forecast for location: ${location}`);
-        // Use our backend API to fetch forecast data instead of directly calling OpenWeatherMap
-        const response = await fetch(`/api/weather?location=${encodeURIComponent(location)}&type=forecast`);
-        
-        if (!response.ok) {
-            const errorData = await response.json();
-            console.error('Forecast API error response:', errorData);
-            throw new Error(`Forecast API error: ${response.status} - ${errorData.message || 'Unknown error'}`);
+        console.log('Fetching weather and forecast for:', query);
+        const params = new URLSearchParams({ types: 'current,forecast', fields: 'slim' });
+        if (typeof query === 'string') {
+            params.set('location', query);
+        } else {
+            params.set('lat', query.lat);
+            params.set('lon', query.lon);
         }
-        
-        return await response.json();
-    } catch (error) {
-        console.error('Error fetching forecast:', error);
-        throw error;
-    }
-}
-
-// Get weather by coordinates from OpenWeatherMap API
-async function fetchWeatherByCoords(lat, lon) {
-    try {
-        console.log(`Fetching weather for coordinates: lat=${lat}, lon=${lon}`);
-        // Use our backend API to fetch weather data by coordinates
-        const response = await fetch(`/api/weather?lat=${lat}&lon=${lon}&type=current`);
+        const response = await fetch(`/api/weather/batch?${params}`);
+        const data = await response.json();
         
         if (!response.ok) {
-            const errorData = await response.json();
-            console.error('Weather API error response:', errorData);
-            throw new Error(`Weather API error: ${response.status} - ${errorData.message || 'Unknown error'}`);
+            console.error('Weather API error response:', data);
+            throw new Error(`Weather API error: ${response.status} - ${data.error || 'Unknown error'}`);
         }
         
-        return await response.json();
-    } catch (error) {
-        console.error('Error fetching weather by coordinates:', error);
-        throw error;
-    }
-}
-
-// Get forecast by coordinates from OpenWeatherMap API
-async function fetchForecastByCoords(lat, lon) {
-    try {
-        console.log(`Fetching forecast for coordinates: lat=${lat}, lon=${lon}`);
-        // Use our backend API to fetch forecast data by coordinates
-        const response = await fetch(`/api/weather?lat=${lat}&lon=${lon}&type=forecast`);
-        
-        if (!response.ok) {
-            const errorData = await response.json();
-            console.error('Forecast API error response:', errorData);
-            throw new Error(`Forecast API error: ${response.status} - ${errorData.message || 'Unknown error'}`);
+        // Each location carries its own data or error per type
+        const result = data.results[0];
+        const errors = result.errors || {};
+        for (const type of ['current', 'forecast']) {
+            if (!result[type]) {
+                const error = errors[type] || errors.query || {};
+                console.error(`Weather API ${type} error:`, error);
+                throw new Error(`Weather API error: ${error.status} - ${error.error || 'Unknown error'}`);
+            }
         }
         
-        return await response.json();
+        return { weatherData: result.current, forecastData: result.forecast };
     } catch (error) {
-        console.error('Error fetching forecast by coordinates:', error);
+        console.error('Error fetching weather:', error);
         throw error;
     }
 }
 
 // Process forecast data to get a simplified 3-day forecast
 function processForcastData(forecastData) {
-    const forecasts = forecastData.list;
-    const dailyForecasts = {};
-    
-    // Group forecasts by day
-    forecasts.forEach(forecast => {
-        const date = new Date(forecast.dt * 1000);
-        const day = date.toLocaleDateString('en-US', { weekday: 'short' });
-        
-        if (!dailyForecasts[day]) {
-            dailyForecasts[day] = {
-                temps: [],
-                descriptions: [],
-                icons: [],
-                date: date.toLocaleDateString('en-US', { weekday: 'long', month: 'short', day: 'numeric' })
-            };
-        }
-        
-        dailyForecasts[day].temps.push(forecast.main.temp);
-        dailyForecasts[day].descriptions.push(forecast.weather[0].description);
-        dailyForecasts[day].icons.push(forecast.weather[0].icon);
-    });
-    
-    // Calculate average temp and most common description for each day
-    const result = Object.keys(dailyForecasts).map(day => {
-        const dayData = dailyForecasts[day];
-        
-        // Calculate average temperature
-        const avgTemp = dayData.temps.reduce((a, b) => a + b, 0) / dayData.temps.length;
-        
-        // Find most common description
-        const descCounts = {};
-        dayData.descriptions.forEach(desc => {
-            descCounts[desc] = (descCounts[desc] || 0) + 1;
-        });
-        const mostCommonDesc = Object.keys(descCounts).reduce((a, b) => 
-            descCounts[a] > descCounts[b] ? a : b);
-            
-        // Find most common icon
-        const iconCounts = {};
-        dayData.icons.forEach(icon => {
-            iconCounts[icon] = (iconCounts[icon] || 0) + 1;
-        });
-        const mostCommonIcon = Object.keys(iconCounts).reduce((a, b) => 
-            iconCounts[a] > iconCounts[b] ? a : b);
-        
-        return {
-            day,
-            date: dayData.date,
-            avgTemp: Math.round(avgTemp),
-            description: mostCommonDesc,
-            icon: mostCommonIcon
-        };
-    });
-    
-    // Return only the first 3 days
-    return result.slice(0, 3);
+    // The server aggregates the 3-hourly entries into daily summaries (see summarize_forecast)
+    return (forecastData.summary || []).slice(0, 3).map(day => ({
+        day: day.day,
+        date: day.date_label,
+        avgTemp: Math.round(day.temp_avg),
+        description: day.description,
+        icon: day.icon
+    }));
 }
 
 // Get current location using browser's geolocation API
@@ -1291,8 +1337,8 @@ function useCurrentLocation() {
             
             console.log(`Fetching weather for coordinates: lat=${lat}, lon=${lon}`);
             
-            // Fetch current weather data
-            const weatherData = await fetchWeatherByCoords(lat, lon);
+            // Fetch current weather and forecast data
+            const { weatherData, forecastData } = await fetchWeatherAndForecast({ lat, lon });
             console.log("Weather data received:", weatherData);
             
             // Update location input with the city name from API
@@ -1304,11 +1350,6 @@ function useCurrentLocation() {
                 console.error("Location input field not found");
             }
             
-            // Fetch forecast data
-            console.log("Fetching forecast data");
-            const forecastData = await fetchForecastByCoords(lat, lon);
-            console.log("Forecast data received");
-            
             // Update weather cards with real data
             updateWeatherCardsWithAPIData(weatherData, forecastData);
             console.log("Weather cards updated");
@@ -1445,9 +1486,8 @@ async function startWeatherAnalysis() {
     analyzeBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Analyzing...';
     
     try {
-        // Fetch weather data from API
-        const weatherData = await fetchCurrentWeather(location);
-        const forecastData = await fetchForecast(location);
+        // Fetch weather and forecast data from the API in one request
+        const { weatherData, forecastData } = await fetchWeatherAndForecast(location);
         
         // Store the current weather data for email use
         currentWeatherData = {